@@ -8,3 +8,29 @@ class UndecodableContentError(ValueError):
     """
     Raised when the content downloaded for diffing could not be decoded.
     """
+
+class DiffBudgetExceededError(Exception):
+    """
+    Raised when a diff uses more CPU time or memory than it is allowed to.
+
+    Parameters
+    ----------
+    resource : str
+        The resource that was used up: ``'cpu_time'`` (in seconds) or
+        ``'memory'`` (in bytes).
+    limit : int or float
+        The maximum amount of the resource the diff was allowed to use.
+    used : int or float
+        How much of the resource the diff had used when it was stopped.
+    """
+    def __init__(self, resource, limit, used):
+        self.resource = resource
+        self.limit = limit
+        self.used = used
+        units = 'seconds' if resource == 'cpu_time' else 'bytes'
+        super().__init__(f'Diff exceeded its {resource} budget of {limit} '
+                         f'{units} (used {used:.2f} {units})')
+
+    def __reduce__(self):
+        # Keep the attributes when this is sent between processes.
+        return (type(self), (self.resource, self.limit, self.used))
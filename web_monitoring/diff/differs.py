@@ -4,6 +4,8 @@ from ..utils import get_color_palette
 from htmldiffer.diff import HTMLDiffer
 import htmltreediff
 import html5_parser
+from .parsing import parse_html_document
+from .timing import timed
 import re
 import sys
 
@@ -27,12 +29,10 @@ def identical_bytes(a_body, b_body):
     return {'diff': a_body == b_body}
 
 
-def _get_text(html):
-    "Extract textual content from HTML."
-    soup = html5_parser.parse(html, treebuilder='soup', return_root=False)
-    [element.extract() for element in
-     soup.find_all(string=lambda text: isinstance(text, Comment))]
-    return soup.find_all(text=True)
+def _get_text(soup):
+    "Extract textual content from a parsed HTML document."
+    return [text for text in soup.find_all(text=True)
+            if not isinstance(text, Comment)]
 
 
 INVISIBLE_TAGS = set(['style', 'script', '[document]', 'head', 'title'])
@@ -50,30 +50,35 @@ def _is_visible(element):
 
 
 def _get_visible_text(html):
-    text = ' '.join(filter(_is_visible, _get_text(html)))
+    "Extract the visible text from HTML source or a parsed HTML document."
+    soup = parse_html_document(html) if isinstance(html, str) else html
+    text = ' '.join(filter(_is_visible, _get_text(soup)))
     return REPEATED_BLANK_LINES.sub('\n\n', text).strip()
 
 
-def side_by_side_text(a_text, b_text):
+def side_by_side_text(a_text, b_text, a_soup=None, b_soup=None):
     "Extract the visible text from both response bodies."
-    return {'diff': {'a_text': _get_visible_text(a_text),
-                     'b_text': _get_visible_text(b_text)}}
+    a_soup = a_soup if a_soup is not None else parse_html_document(a_text)
+    b_soup = b_soup if b_soup is not None else parse_html_document(b_text)
+    return {'diff': {'a_text': _get_visible_text(a_soup),
+                     'b_text': _get_visible_text(b_soup)}}
 
 
 def compute_dmp_diff(a_text, b_text, timelimit=4):
-    if (isinstance(a_text, str) and isinstance(b_text, str)):
-        changes = diff(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True, counts_only=False)
-    elif (isinstance(a_text, bytes) and isinstance(b_text, bytes)):
-        changes = diff_bytes(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True,
-                             counts_only=False)
-    else:
-        raise TypeError("Both the texts should be either of type 'str' or 'bytes'.")
+    with timed('match'):
+        if (isinstance(a_text, str) and isinstance(b_text, str)):
+            changes = diff(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True, counts_only=False)
+        elif (isinstance(a_text, bytes) and isinstance(b_text, bytes)):
+            changes = diff_bytes(a_text, b_text, checklines=False, timelimit=timelimit, cleanup_semantic=True,
+                                 counts_only=False)
+        else:
+            raise TypeError("Both the texts should be either of type 'str' or 'bytes'.")
 
     result = [(diff_codes[change[0]], change[1]) for change in changes]
     return result
 
 
-def html_text_diff(a_text, b_text):
+def html_text_diff(a_text, b_text, a_soup=None, b_soup=None):
     """
     Diff the visible textual content of an HTML document.
 
@@ -84,8 +89,10 @@ def html_text_diff(a_text, b_text):
     [[-1, 'Delet'], [1, 'Add'], [0, 'ed Unchanged']]
     """
 
-    t1 = _get_visible_text(a_text)
-    t2 = _get_visible_text(b_text)
+    a_soup = a_soup if a_soup is not None else parse_html_document(a_text)
+    b_soup = b_soup if b_soup is not None else parse_html_document(b_text)
+    t1 = _get_visible_text(a_soup)
+    t2 = _get_visible_text(b_soup)
 
     TIMELIMIT = 2  # seconds
     res = compute_dmp_diff(t1, t2, timelimit=TIMELIMIT)
@@ -14,7 +14,8 @@ For now, you can mentally divide this module into two sections:
    depends on some parts of the LXML module, but that could change. (The entry
    point for this is _htmldiff)
 """
-from bs4 import BeautifulSoup, Comment
+from array import array
+from bs4 import BeautifulSoup, Comment, Doctype, Tag
 from collections import Counter, namedtuple
 from enum import Enum
 from functools import lru_cache
@@ -27,6 +28,10 @@ import logging
 import re
 from .content_type import raise_if_not_diffable_html
 from .differs import compute_dmp_diff
+from .parsing import parse_html_document
+from .sequence_diff import (get_algorithm, get_matching_blocks,
+                            get_segmented_matching_blocks)
+from .timing import timed
 
 # Imports only used in forked tokenization code; may be ripe for removal:
 from lxml import etree
@@ -161,6 +166,9 @@ no_change_children_tags = set([
 # page. When viewing a combined diff, these elements need to be "deactivated"
 # so their old and new versions don't compete.
 ACTIVE_ELEMENTS = ('script', 'style')
+ACTIVE_ELEMENT_PATTERN = re.compile(r'<(%s)[\s>].*?</\1\s*>'
+                                    % '|'.join(ACTIVE_ELEMENTS),
+                                    re.IGNORECASE | re.DOTALL)
 
 # This diff is fundamentally a word-by-word diff, which attempts to re-assemble
 # the tags that were present before or after a word after diffing the text.
@@ -184,12 +192,35 @@ EMPTY_HTML = '''<html>
     </body>
 </html>'''
 
+# Ways to split documents up before diffing them (see `html_diff_render()`).
+SEGMENTATIONS = ('blocks', 'none')
+
 # Maximum number of spacer tokens to add to a token stream for a document.
 # Adding too many can cause SequenceMatcher to choke.
 MAX_SPACERS = 2500
 
 
-class WaybackUrlComparator:
+# Maximum number of URLs each kind of comparator remembers the canonical form
+# of. Pages commonly have a few thousand links and images.
+CANONICAL_URL_CACHE_SIZE = 16384
+
+
+class UrlComparator:
+    """
+    Base class for URL comparators. A comparator reduces each URL to a
+    canonical form with ``canonicalize()``, and URLs with the same canonical
+    form are equivalent. Because the canonical form is an ordinary string, it
+    can also be hashed or used as a dict key.
+    """
+    @classmethod
+    def canonicalize(cls, url):
+        return url
+
+    def compare(self, url_a, url_b):
+        return self.canonicalize(url_a) == self.canonicalize(url_b)
+
+
+class WaybackUrlComparator(UrlComparator):
     """
     Compares Wayback Machine links from multiple timeframes as if they are the
     same. For example, these two URLs would be equivalent:
@@ -197,15 +228,22 @@ class WaybackUrlComparator:
     - http://web.archive.org/web/20181231224558/https://www.noaa.gov/
     """
     matcher = re.compile(r'web/\d{14}(im_|js_|cs_)?/(https?://)?(www.)?')
+    # Prefixed to the canonical form of archived URLs, so they are only equal
+    # to other archived URLs, not to an ordinary URL like ``noaa.gov/``.
+    marker = '\x00wayback:'
 
-    def compare(self, url_a, url_b):
-        match_a = self.matcher.search(url_a)
-        match_b = self.matcher.search(url_b)
-        if match_a and match_b:
-            url_a = url_a[match_a.end():]
-            url_b = url_b[match_b.end():]
-            return url_a == url_b
-        return url_a == url_b
+    @classmethod
+    @lru_cache(maxsize=CANONICAL_URL_CACHE_SIZE)
+    def canonicalize(cls, url):
+        """
+        Get the part of an archived URL after the timestamp and the original
+        URL's scheme and ``www.`` (e.g. ``noaa.gov/``), prefixed with
+        ``marker``. Other URLs are returned as-is.
+        """
+        match = cls.matcher.search(url)
+        if match:
+            return cls.marker + url[match.end():]
+        return url
 
 
 class WaybackUkUrlComparator(WaybackUrlComparator):
@@ -216,9 +254,10 @@ class WaybackUkUrlComparator(WaybackUrlComparator):
     - https://www.webarchive.org.uk/wayback/en/archive/20181231224558/https://www.example.gov/
     """
     matcher = re.compile(r'https://www\.webarchive\.org\.uk/wayback/en/archive/\d{14}(mp_|im_)?/(https?://)?(www.)?')
+    marker = '\x00wayback-uk:'
 
 
-class ServletSessionUrlComparator:
+class ServletSessionUrlComparator(UrlComparator):
     """
     Ignores Java Servlet session IDs in URLs when comparing. (Servlets may
     store session IDs in the URL instead of cookies.) For example, these two
@@ -230,30 +269,32 @@ class ServletSessionUrlComparator:
     """
     matcher = re.compile(r';jsessionid=[^;]+')
 
-    def compare(self, url_a, url_b):
-        match_a = self.matcher.sub('', url_a, count=1)
-        match_b = self.matcher.sub('', url_b, count=1)
-        return match_a == match_b
+    @classmethod
+    @lru_cache(maxsize=CANONICAL_URL_CACHE_SIZE)
+    def canonicalize(cls, url):
+        "Remove the session ID from a URL."
+        return cls.matcher.sub('', url, count=1)
 
 
-class CompoundComparator:
+class CompoundComparator(UrlComparator):
     """
-    Compares URLs using multiple comparators. If any of the comparators claim
-    a URL is equivalent, the final result is that the URLs are equal.
+    Compares URLs using multiple comparators. A URL's canonical form is the
+    result of canonicalizing it with each comparator in turn, so URLs that
+    any one of the comparators considers equivalent are equal, as are URLs
+    that only differ in ways each comparator ignores (e.g. a session ID *and*
+    an archive timestamp).
 
     Parameters
     ----------
-    comparators : list of Comparator
+    comparators : list of UrlComparator
     """
     def __init__(self, comparators):
         self.comparators = comparators
 
-    def compare(self, url_a, url_b):
+    def canonicalize(self, url):
         for comparator in self.comparators:
-            if comparator.compare(url_a, url_b):
-                return True
-
-        return False
+            url = comparator.canonicalize(url)
+        return url
 
 
 class UrlRules:
@@ -266,19 +307,36 @@ class UrlRules:
              'wayback': WaybackUrlComparator,
              'wayback_uk': WaybackUkUrlComparator}
 
+    @classmethod
+    def canonicalize(cls, url, comparator):
+        """
+        Get the canonical form of a URL according to a comparator (or the URL
+        itself if there is no comparator).
+        """
+        if comparator:
+            return comparator.canonicalize(url)
+        return url
+
     @classmethod
     def compare_array(cls, url_list_a, url_list_b, comparator):
-        for url_a in url_list_a:
-            for url_b in url_list_b:
-                if comparator:
-                    if comparator.compare(url_a, url_b):
-                        return True
-                elif url_a == url_b:
-                    return True
-        return False
+        """
+        Determine whether any URL in one list is equivalent to any URL in
+        another.
+        """
+        if comparator:
+            canonical_a = set(map(comparator.canonicalize, url_list_a))
+            return any(comparator.canonicalize(url) in canonical_a
+                       for url in url_list_b)
+        return not set(url_list_a).isdisjoint(url_list_b)
 
     @classmethod
+    @lru_cache(maxsize=64)
     def get_comparator(cls, mode):
+        """
+        Get a comparator for a comma-separated list of rule names (e.g.
+        ``'jsessionid,wayback'``). Comparators are cached and shared, so
+        calling this again with the same rules is cheap.
+        """
         if not mode:
             return None
 
@@ -292,7 +350,8 @@ class UrlRules:
 
 def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
                      include='combined', content_type_options='normal',
-                     url_rules='jsessionid'):
+                     url_rules='jsessionid', diff_algorithm='difflib',
+                     segmentation='none', a_soup=None, b_soup=None):
     """
     HTML Diff for rendering. This is focused on visually highlighting portions
     of a page’s text that have been changed. It does not do much to show how
@@ -355,6 +414,33 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
         You can also combine multiple comparison rules with a comma,
         e.g. `jsessionid,wayback`. Use None or an empty string for exact
         comparisons. (Default: `jsessionid`)
+    diff_algorithm : string
+        Algorithm to use for finding the matching parts of the documents.
+        Possible values are:
+        - `difflib` uses Python's `difflib.SequenceMatcher`.
+        - `myers` finds a minimal diff in O(ND) time. It is faster than
+          `difflib` when there aren't many changes.
+        - `patience` anchors the diff on words that only appear once in each
+          document. It is fast on long pages with lots of repetition.
+        - `histogram` is like `patience`, but anchors on the least common
+          words instead of only unique ones.
+        (Default: `difflib`)
+    segmentation : string
+        How to split the documents up before diffing. Possible values are:
+        - `none` runs `diff_algorithm` on the whole documents.
+        - `blocks` splits the documents where block-level elements (like
+          `<p>` or `<li>`) start, matches up the blocks that are exactly the
+          same in both, and only runs `diff_algorithm` on the rest. This makes
+          diffing large pages with small changes much faster, but can
+          occasionally produce slightly different results on heavily
+          changed pages.
+        (Default: `none`)
+    a_soup : bs4.BeautifulSoup
+        Already parsed version of `a_text` (see `parse_html_document()`). It
+        will not be modified. If not set, `a_text` will be parsed.
+    b_soup : bs4.BeautifulSoup
+        Already parsed version of `b_text` (see `parse_html_document()`). It
+        will not be modified. If not set, `b_text` will be parsed.
 
     Example
     -------
@@ -370,78 +456,89 @@ def html_diff_render(a_text, b_text, a_headers=None, b_headers=None,
         content_type_options)
 
     comparator = UrlRules.get_comparator(url_rules)
+    # Fail early if the algorithm or segmentation is not valid.
+    get_algorithm(diff_algorithm)
+    if segmentation not in SEGMENTATIONS:
+        raise ValueError(f'{segmentation} is an invalid segmentation. Use '
+                         f'one of: {", ".join(SEGMENTATIONS)}')
 
-    soup_old = html5_parser.parse(a_text.strip() or EMPTY_HTML,
-                                  treebuilder='soup', return_root=False)
-    soup_new = html5_parser.parse(b_text.strip() or EMPTY_HTML,
-                                  treebuilder='soup', return_root=False)
+    with timed('parse'):
+        soup_old = _parse_diffable_document(a_text, a_soup)
+        soup_new = _parse_diffable_document(b_text, b_soup)
 
-    # Remove comment nodes since they generally don't affect display.
+    # Diffing skips comments since they generally don't affect display.
     # NOTE: This could affect display if the removed are conditional comments,
     # but it's unclear how we'd meaningfully visualize those anyway.
-    [element.extract() for element in
-     soup_old.find_all(string=lambda text:isinstance(text, Comment))]
-    [element.extract() for element in
-     soup_new.find_all(string=lambda text:isinstance(text, Comment))]
-
-    soup_old = _cleanup_document_structure(soup_old)
-    soup_new = _cleanup_document_structure(soup_new)
-
-    results, diff_bodies = diff_elements(soup_old.body, soup_new.body, comparator, include)
-
-    for diff_type, diff_body in diff_bodies.items():
-        soup = None
-        if diff_type == 'deletions':
-            soup = copy.copy(soup_old)
-        elif diff_type == 'insertions':
-            soup = copy.copy(soup_new)
-        else:
-            soup = copy.copy(soup_new)
-            title_meta = soup.new_tag(
-                'meta',
-                content=_diff_title(soup_old, soup_new))
-            title_meta.attrs['name'] = 'wm-diff-title'
-            soup.head.append(title_meta)
-
-            old_head = soup.new_tag('template', id='wm-diff-old-head')
-            if soup_old.head:
-                for node in soup_old.head.contents.copy():
-                    old_head.append(copy.copy(node))
-            soup.head.append(old_head)
-
-        change_styles = soup.new_tag(
-            "style",
-            type="text/css",
-            id='wm-diff-style')
-
-        color_palette = get_color_palette()
-        change_styles.string = f'''
+    results, diff_bodies = diff_elements(soup_old.body, soup_new.body,
+                                         comparator, include, diff_algorithm,
+                                         segmentation)
+
+    # The output documents are assembled directly as strings from the diffs
+    # and the serialized parts of the original documents. (The original
+    # documents may be shared with other differs, so they must not be
+    # modified.)
+    color_palette = get_color_palette()
+    change_styles = f'''<style id="wm-diff-style" type="text/css">
             ins.wm-diff, ins.wm-diff > * {{background-color:
                 {color_palette['differ_insertion']} !important;
                 all: unset;}}
             del.wm-diff, del.wm-diff > * {{background-color:
                 {color_palette['differ_deletion']} !important;
                 all: unset;}}
-            script {{display: none !important;}}'''
-        soup.head.append(change_styles)
-
-        soup.body.replace_with(diff_body)
-        # The method we use above to append HTML strings (the diffs) to the soup
-        # results in a non-navigable soup. So we serialize and re-parse :(
-        # (Note we use no formatter for this because proper encoding escapes
-        # the tags our differ generated.)
-        soup = html5_parser.parse(soup.prettify(formatter=None),
-                                  treebuilder='soup', return_root=False)
-        runtime_scripts = soup.new_tag('script', id='wm-diff-script')
-        runtime_scripts.string = UPDATE_CONTRAST_SCRIPT
-        soup.body.append(runtime_scripts)
-        if diff_type == 'combined':
-            _deactivate_deleted_active_elements(soup)
-        results[diff_type] = soup.prettify(formatter='minimal')
+            script {{display: none !important;}}</style>'''
+    runtime_scripts = (f'<script id="wm-diff-script">{UPDATE_CONTRAST_SCRIPT}'
+                       '</script>')
+
+    # With `include='all'`, each document's <head> is used more than once, so
+    # only serialize them once.
+    heads = {}
+
+    def head_html(soup):
+        if id(soup) not in heads:
+            heads[id(soup)] = _html_contents(soup.head)
+        return heads[id(soup)]
+
+    for diff_type, diff_body in diff_bodies.items():
+        with timed('assemble'):
+            soup = soup_old if diff_type == 'deletions' else soup_new
+            head = [head_html(soup)]
+            if diff_type == 'combined':
+                title = html.escape(_diff_title(soup_old, soup_new))
+                head.append(f'<meta content="{title}" name="wm-diff-title">')
+                head.append('<template id="wm-diff-old-head">'
+                            f'{head_html(soup_old)}</template>')
+            head.append(change_styles)
+
+            results[diff_type] = ''.join((
+                _html_doctype(soup),
+                _html_start_tag(soup.html),
+                _html_start_tag(soup.head),
+                *head,
+                '</head>',
+                _html_start_tag(soup.body),
+                diff_body,
+                runtime_scripts,
+                '</body></html>'))
 
     return results
 
 
+def _parse_diffable_document(text, soup=None):
+    """
+    Get a parsed document to diff, parsing it from ``text`` if ``soup`` was
+    not already provided. Empty documents are replaced with placeholder
+    content.
+    """
+    if not text or text.isspace():
+        soup = parse_html_document(EMPTY_HTML)
+    elif soup is None:
+        soup = parse_html_document(text)
+
+    if not soup.head or not soup.body:
+        soup = _cleanup_document_structure(copy.copy(soup))
+    return soup
+
+
 def _cleanup_document_structure(soup):
     """Ensure a BeautifulSoup document has a <head> and <body>"""
     if not soup.head:
@@ -453,14 +550,40 @@ def _cleanup_document_structure(soup):
     return soup
 
 
-def _deactivate_deleted_active_elements(soup):
-    for element in soup.find_all(ACTIVE_ELEMENTS):
-        if element.find_parent('del'):
-            wrapper = soup.new_tag('template')
-            wrapper['class'] = 'wm-diff-deleted-inert'
-            element.wrap(wrapper)
+def _copy_without_comments(element):
+    """
+    Make a copy of a Beautiful Soup element with all the comments removed.
+    """
+    element = copy.copy(element)
+    for comment in element.find_all(string=lambda text: isinstance(text, Comment)):
+        comment.extract()
+    return element
 
-    return soup
+
+def _html_doctype(soup):
+    "Get the HTML for a Beautiful Soup document's doctype (if it has one)."
+    for node in soup.contents:
+        if isinstance(node, Doctype):
+            return node.output_ready()
+    return ''
+
+
+def _html_start_tag(element):
+    "Get the HTML for just the start tag of a Beautiful Soup element."
+    attributes = []
+    for name, value in element.attrs.items():
+        # Multi-valued attributes (like `class`) are lists in Beautiful Soup.
+        if isinstance(value, list):
+            value = ' '.join(value)
+        attributes.append(f' {name}="{html.escape(value)}"')
+    return f'<{element.name}{"".join(attributes)}>'
+
+
+def _html_contents(element):
+    "Get the HTML for a Beautiful Soup element's contents without comments."
+    if element.find(string=lambda text: isinstance(text, Comment)):
+        element = _copy_without_comments(element)
+    return element.decode_contents(formatter='minimal')
 
 
 def get_title(soup):
@@ -488,107 +611,174 @@ def _diff_title(old, new):
     return ''.join(map(_html_for_dmp_operation, diff))
 
 
-def diff_elements(old, new, comparator, include='all'):
+def diff_elements(old, new, comparator, include='all', algorithm='difflib',
+                  segmentation='none'):
+    """
+    Diff the contents of two Beautiful Soup elements. Returns a tuple of
+    metadata about the changes and a dict with HTML strings of the diffs of
+    each type in `include`. `algorithm` is the name of the sequence matching
+    algorithm to use (see `web_monitoring.diff.sequence_diff`), and
+    `segmentation` is how to split the elements up before matching (see
+    `html_diff_render()`).
+    """
     if not old:
         old = BeautifulSoup().new_tag('div')
     if not new:
         new = BeautifulSoup().new_tag('div')
 
-    def fill_element(element, diff):
-        result_element = copy.copy(element)
-        result_element.clear()
-        result_element.append(diff)
-        return result_element
-
-    results = {}
-    metadata, raw_diffs = _htmldiff(_diffable_fragment(old),
-                                    _diffable_fragment(new),
-                                    comparator,
-                                    include)
-
-    for diff_type, diff in raw_diffs.items():
-        element = diff_type == 'deletions' and old or new
-        results[diff_type] = fill_element(element, diff)
-
-    return metadata, results
-
-
-def _diffable_fragment(element):
-    """
-    Convert a beautiful soup element into an HTML fragment string with just the
-    element's *contents* that is ready for diffing.
-    """
-    # FIXME: we have to remove <ins> and <del> tags because *we* use them to
-    # indicate changes that we find. We probably shouldn't do that:
-    # https://github.com/edgi-govdata-archiving/web-monitoring-processing/issues/69#issuecomment-321424897
-    for edit_tag in element.find_all(_is_ins_or_del):
-        edit_tag.unwrap()
-    # Create a fragment string of just the element's contents
-    return ''.join(map(str, element.children))
+    return _htmldiff(old, new, comparator, include, algorithm, segmentation)
 
 
 def _is_ins_or_del(tag):
     return tag.name == 'ins' or tag.name == 'del'
 
 
-# FIXME: this should take two BeautifulSoup elements to diff (since we've
-# already parsed and generated those), not two HTML fragment strings that have
-# to get parsed again.
-def _htmldiff(old, new, comparator, include='all'):
+def _htmldiff(old, new, comparator, include='all', algorithm='difflib',
+              segmentation='none'):
     """
     A slightly customized version of htmldiff that uses different tokens.
+
+    ``old`` and ``new`` are the Beautiful Soup elements whose contents should
+    be diffed. (HTML fragment strings also work, but have to be parsed.)
     """
-    old_tokens = tokenize(old, comparator)
-    new_tokens = tokenize(new, comparator)
-    # old_tokens = [_customize_token(token) for token in old_tokens]
-    # new_tokens = [_customize_token(token) for token in new_tokens]
-    old_tokens = _limit_spacers(_customize_tokens(old_tokens), MAX_SPACERS)
-    new_tokens = _limit_spacers(_customize_tokens(new_tokens), MAX_SPACERS)
+    with timed('tokenize'):
+        old_tokens = tokenize(old, comparator, customize=True,
+                              max_spacers=MAX_SPACERS)
+        new_tokens = tokenize(new, comparator, customize=True,
+                              max_spacers=MAX_SPACERS)
     # result = htmldiff_tokens(old_tokens, new_tokens)
     # result = diff_tokens(old_tokens, new_tokens) #, include='delete')
     logger.debug('CUSTOMIZED!')
 
-    # HACK: The whole "spacer" token thing above in this code triggers the
-    # `autojunk` mechanism in SequenceMatcher, so we need to explicitly turn
-    # that off. That's probably not great, but I don't have a better approach.
-    matcher = InsensitiveSequenceMatcher(a=old_tokens, b=new_tokens, autojunk=False)
-    # matcher = SequenceMatcher(a=old_tokens, b=new_tokens, autojunk=False)
-    opcodes = matcher.get_opcodes()
+    with timed('match'):
+        # Match on integer IDs instead of the tokens themselves. The opcodes
+        # index into the ID sequences the same way they would the tokens.
+        old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+        segments = None
+        if segmentation == 'blocks':
+            segments = (_segment_starts(old_tokens),
+                        _segment_starts(new_tokens))
+
+        # HACK: The whole "spacer" token thing above in this code triggers the
+        # `autojunk` mechanism in SequenceMatcher, so we need to explicitly
+        # turn that off. That's probably not great, but I don't have a better
+        # approach.
+        matcher = InsensitiveSequenceMatcher(a=old_ids, b=new_ids,
+                                             autojunk=False,
+                                             algorithm=algorithm,
+                                             segments=segments)
+        # matcher = SequenceMatcher(a=old_tokens, b=new_tokens, autojunk=False)
+        opcodes = matcher.get_opcodes()
 
     metadata = _count_changes(opcodes)
     diffs = {}
 
-    def render_diff(diff_type):
-        diff = assemble_diff(old_tokens, new_tokens, opcodes, diff_type)
-        # return fixup_ins_del_tags(''.join(diff).strip())
-        result = ''.join(diff).strip().replace('</li> ', '</li>')
-        return result
-
-    if include == 'all' or include == 'combined':
-        diffs['combined'] = render_diff('combined')
-    if include == 'all' or include == 'insertions':
-        diffs['insertions'] = render_diff('insertions')
-    if include == 'all' or include == 'deletions':
-        diffs['deletions'] = render_diff('deletions')
+    with timed('assemble'):
+        diff_types = [diff_type for diff_type in DIFF_TYPES
+                      if include == 'all' or include == diff_type]
+        assembled = assemble_diffs(old_tokens, new_tokens, opcodes, diff_types)
+        for diff_type, diff in assembled.items():
+            # return fixup_ins_del_tags(''.join(diff).strip())
+            diffs[diff_type] = ''.join(diff).strip().replace('</li> ', '</li>')
 
     return metadata, diffs
 
 
-# FIXME: this is utterly ridiculous -- the crazy spacer token solution we came
-# up with can add so much extra stuff to some kinds of pages that
-# SequenceMatcher chokes on it. This strips out excess spacers. We should
-# really re-examine the whole spacer token concept now that we control the
-# tokenization phase, though.
-def _limit_spacers(tokens, max_spacers):
-    limited_tokens = []
-    for token in tokens:
-        if isinstance(token, SpacerToken):
-            if max_spacers <= 0:
-                continue
-            max_spacers -= 1
-        limited_tokens.append(token)
+# Matches the start tag of a block-level element.
+BLOCK_START_TAG_PATTERN = re.compile(
+    r'<(?:%s)[\s/>]' % '|'.join(sorted(block_level_tags)))
+
+
+def _segment_starts(tokens):
+    """
+    Get the indexes of the tokens in a TokenTable that start a block-level
+    element. Pages can be diffed in segments divided at these points.
+    """
+    strings = tokens.strings
+    tag_ids = tokens.tag_ids
+    offsets = tokens.tag_offsets
+    block_tags = {}
+    starts = [0]
+    for index in range(1, len(tokens)):
+        for tag_index in range(offsets[2 * index], offsets[2 * index + 1]):
+            tag_id = tag_ids[tag_index]
+            is_block = block_tags.get(tag_id)
+            if is_block is None:
+                is_block = block_tags[tag_id] = bool(
+                    BLOCK_START_TAG_PATTERN.match(strings[tag_id]))
+            if is_block:
+                starts.append(index)
+                break
+    return starts
+
+
+def _intern_tokens(old_tokens, new_tokens):
+    """
+    Map two TokenTables to arrays of integer IDs, where equal tokens have the
+    same ID. (Images can also share an ID with images they aren't directly
+    equal to; see below.)
+
+    Link and image tokens compare their URLs with a comparator (see
+    ``UrlRules``), so equal tokens don't necessarily have equal hashes and
+    can't be matched up by SequenceMatcher's hash-based index. Giving every
+    equivalent token the same ID fixes that, and comparing integers is much
+    faster than comparing strings.
+
+    Links are equal if their URLs have the same canonical form (see
+    ``UrlComparator.canonicalize()``), so they are simply keyed by it. Images
+    are equal if *any* of their URLs are, which isn't transitive, so an image
+    token gets the ID of the first image it is equal to, and any of its URLs
+    that haven't been seen yet are given that ID, too. That way, if image A
+    has URL x, B has x and y, and C has y, B and C are still equal (though A
+    and C now are, too).
+
+    Parameters
+    ----------
+    old_tokens : TokenTable
+    new_tokens : TokenTable
+
+    Returns
+    -------
+    (array, array)
+        Integer IDs for ``old_tokens`` and ``new_tokens``.
+    """
+    ids = {}
+    # The ID of the first image with each canonical URL.
+    image_ids = {}
+    comparator = old_tokens.comparator
+    href_kinds = (TokenType.href.value, TokenType.minimal_href.value)
+    img_kind = TokenType.img.value
+
+    def intern_table(tokens):
+        token_ids = array('i')
+        for index, kind in enumerate(tokens.kinds):
+            text = tokens.text(index)
+            if kind in href_kinds:
+                key = ('href', UrlRules.canonicalize(text, comparator))
+            elif kind == img_kind:
+                key = ('img', tuple(tokens.image_sources[index]))
+            else:
+                # Other tokens all use plain string equality.
+                key = text
+
+            token_id = ids.get(key)
+            if token_id is None:
+                if kind == img_kind:
+                    urls = set(UrlRules.canonicalize(url, comparator)
+                               for url in key[1])
+                    matches = [image_ids[url] for url in urls
+                               if url in image_ids]
+                    token_id = min(matches) if matches else len(ids)
+                    for url in urls:
+                        image_ids.setdefault(url, token_id)
+                else:
+                    token_id = len(ids)
+                ids[key] = token_id
 
-    return limited_tokens
+            token_ids.append(token_id)
+        return token_ids
+
+    return intern_table(old_tokens), intern_table(new_tokens)
 
 
 def _count_changes(opcodes):
@@ -604,20 +794,44 @@ def _count_changes(opcodes):
 # The following tokenization-related code is more-or-less copied from
 # lxml.html.diff. We plan to change it significantly.
 
-def expand_tokens(tokens, equal=False):
-    """Given a list of tokens, return a generator of the chunks of
-    text for the data in the tokens.
+def expand_tokens(tokens, start=0, stop=None, equal=False, inert=False):
+    """Given a TokenTable, return a generator of the chunks of
+    text for the data in the tokens from `start` to `stop`.
+
+    If `inert` is true, any active elements (e.g. <script>) in the tokens are
+    made inert so they don't run when the result is rendered.
     """
-    for token in tokens:
-        for pre in token.pre_tags:
-            yield pre
-        if not equal or not token.hide_when_equal:
-            if token.trailing_whitespace:
-                yield token.html() + token.trailing_whitespace
+    if stop is None:
+        stop = len(tokens)
+    strings = tokens.strings
+    tag_ids = tokens.tag_ids
+    offsets = tokens.tag_offsets
+    for index in range(start, stop):
+        tag_index = offsets[2 * index]
+        text_tag_index = offsets[2 * index + 1]
+        end_tag_index = offsets[2 * index + 2]
+        while tag_index < text_tag_index:
+            yield strings[tag_ids[tag_index]]
+            tag_index += 1
+
+        kind = tokens.kinds[index]
+        if kind in _HIDDEN_TOKEN_KINDS and equal:
+            pass
+        elif kind in _EMPTY_TOKEN_KINDS:
+            yield strings[tokens.whitespace_ids[index]]
+        else:
+            text = strings[tokens.text_ids[index]]
+            if kind == _HREF_KIND:
+                token_html = ' Link: %s' % text
+            elif inert and kind == _UNDIFFABLE_KIND:
+                token_html = _inert_html(text)
             else:
-                yield token.html()
-        for post in token.post_tags:
-            yield post
+                token_html = text
+            yield token_html + strings[tokens.whitespace_ids[index]]
+
+        while tag_index < end_tag_index:
+            yield strings[tag_ids[tag_index]]
+            tag_index += 1
 
 
 class DiffToken(str):
@@ -631,7 +845,10 @@ class DiffToken(str):
     We also keep track of whether the word was originally followed by
     whitespace, even though we do not want to treat the word as
     equivalent to a similar word that does not have a trailing
-    space."""
+    space.
+
+    While diffing, tokens are stored compactly in a TokenTable instead of as
+    instances of this class (see ``TokenTable``)."""
 
     # When this is true, the token will be eliminated from the
     # displayed diff if no change has occurred:
@@ -661,6 +878,13 @@ class DiffToken(str):
     def html(self):
         return str(self)
 
+    def inert_html(self):
+        """
+        The HTML for this token, but with any active elements (e.g. <script>)
+        made inert.
+        """
+        return self.html()
+
 
 class tag_token(DiffToken):
 
@@ -713,27 +937,190 @@ class href_token(DiffToken):
         # the href element solving false positive cases
         if not isinstance(other, href_token):
             return False
-        if self.comparator:
-            return self.comparator.compare(str(self), str(other))
-        return super().__eq__(other)
+        return self.canonical_url() == other.canonical_url()
 
     def __hash__(self):
-        return super().__hash__()
+        return hash(self.canonical_url())
+
+    def canonical_url(self):
+        return UrlRules.canonicalize(str(self), self.comparator)
 
     def html(self):
         return ' Link: %s' % self
 
 
 class UndiffableContentToken(DiffToken):
-    pass
+
+    def inert_html(self):
+        return _inert_html(str(self))
 
 
-# FIXME: this should be adapted to work off a BeautifulSoup element instead of
-# an etree/lxml element, since we already have that and could avoid re-parsing
-# the whole document a second time.
-def tokenize(html, comparator, include_hrefs=True):
+def _inert_html(source):
     """
-    Parse the given HTML and returns token objects (words with attached tags).
+    Make every active element (e.g. <script>) in some undiffable content's
+    source inert, including ones nested inside other elements.
+    """
+    # Active elements are wrapped in a <template> so they are parsed, but
+    # not run or applied to the page.
+    return ACTIVE_ELEMENT_PATTERN.sub(
+        r'<template class="wm-diff-deleted-inert">\g<0></template>',
+        source)
+
+
+class TokenTable:
+    """
+    A compact, column-oriented list of diffable tokens.
+
+    Pages can have hundreds of thousands of tokens, and storing each one as a
+    ``DiffToken`` object (with its own lists of tags) takes a lot of memory.
+    Instead, each token is a row across several parallel arrays:
+
+    - ``kinds`` holds each token's ``TokenType`` value.
+    - ``text_ids`` and ``whitespace_ids`` hold the IDs of each token's text and
+      trailing whitespace in ``strings``.
+    - ``tag_ids`` is a single run of the IDs of every token's pre- and
+      post-tags, in document order. ``tag_offsets`` marks where each token's
+      tags are in it: token ``i``'s pre-tags are
+      ``tag_ids[tag_offsets[2 * i]:tag_offsets[2 * i + 1]]`` and its
+      post-tags are ``tag_ids[tag_offsets[2 * i + 1]:tag_offsets[2 * i + 2]]``.
+    - ``image_sources`` maps the index of each image token to the list of
+      URLs it displays.
+
+    All the strings in a table are stored once in its ``strings`` list.
+    Tables derived from another table (see ``derive()``) share its strings.
+
+    Use ``table[index]`` to get a token as a ``DiffToken`` object, which is
+    handy for debugging.
+
+    Parameters
+    ----------
+    comparator : Comparator, optional
+        Used to compare the URLs in link and image tokens. (See ``UrlRules``.)
+    """
+    def __init__(self, comparator=None):
+        self.comparator = comparator
+        self.kinds = array('B')
+        self.text_ids = array('i')
+        self.whitespace_ids = array('i')
+        self.tag_ids = array('i')
+        self.tag_offsets = array('i', [0])
+        self.image_sources = {}
+        self.strings = []
+        self._string_ids = {}
+
+    def derive(self):
+        """
+        Create a new, empty table that shares this table's strings.
+        """
+        table = TokenTable(self.comparator)
+        table.strings = self.strings
+        table._string_ids = self._string_ids
+        return table
+
+    def string_id(self, string):
+        """Get the ID of a string, adding it to the table's strings."""
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(string)
+            self._string_ids[string] = string_id
+        return string_id
+
+    def append(self, kind, text, pre_tags=(), post_tags=(),
+               trailing_whitespace='', image_sources=None):
+        """
+        Add a token to the end of the table.
+
+        Parameters
+        ----------
+        kind : TokenType
+        text : string
+            For images, this is the HTML source of the ``<img>`` tag.
+        pre_tags : list of string, optional
+        post_tags : list of string, optional
+        trailing_whitespace : string, optional
+        image_sources : list of string, optional
+            For images, the list of URLs the image displays.
+        """
+        self.append_ids(kind.value,
+                        self.string_id(text),
+                        self.string_id(trailing_whitespace),
+                        [self.string_id(tag) for tag in pre_tags],
+                        [self.string_id(tag) for tag in post_tags],
+                        image_sources)
+
+    def append_ids(self, kind, text_id, whitespace_id, pre_tag_ids=(),
+                   post_tag_ids=(), image_sources=None):
+        """
+        Add a token to the end of the table using the raw values stored in
+        the table's arrays instead of strings.
+        """
+        if image_sources is not None:
+            self.image_sources[len(self.kinds)] = image_sources
+        self.kinds.append(kind)
+        self.text_ids.append(text_id)
+        self.whitespace_ids.append(whitespace_id)
+        self.tag_ids.extend(pre_tag_ids)
+        self.tag_offsets.append(len(self.tag_ids))
+        self.tag_ids.extend(post_tag_ids)
+        self.tag_offsets.append(len(self.tag_ids))
+
+    def append_post_tag(self, tag):
+        """Add a tag to the end of the last token's post-tags."""
+        self.tag_ids.append(self.string_id(tag))
+        self.tag_offsets[-1] += 1
+
+    def pre_tag_ids(self, index):
+        offsets = self.tag_offsets
+        return self.tag_ids[offsets[2 * index]:offsets[2 * index + 1]]
+
+    def post_tag_ids(self, index):
+        offsets = self.tag_offsets
+        return self.tag_ids[offsets[2 * index + 1]:offsets[2 * index + 2]]
+
+    def text(self, index):
+        return self.strings[self.text_ids[index]]
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('token index out of range')
+
+        kind = TokenType(self.kinds[index])
+        text = self.text(index)
+        strings = self.strings
+        attributes = dict(
+            pre_tags=[strings[tag] for tag in self.pre_tag_ids(index)],
+            post_tags=[strings[tag] for tag in self.post_tag_ids(index)],
+            trailing_whitespace=strings[self.whitespace_ids[index]])
+        if kind == TokenType.word:
+            return DiffToken(text, **attributes)
+        elif kind == TokenType.undiffable:
+            return UndiffableContentToken(text, **attributes)
+        elif kind == TokenType.spacer:
+            return SpacerToken(text, **attributes)
+        elif kind == TokenType.href:
+            return href_token(text, self.comparator, **attributes)
+        elif kind == TokenType.minimal_href:
+            return MinimalHrefToken(text, self.comparator, **attributes)
+        elif kind == TokenType.img:
+            return ImgTagToken('img', self.image_sources[index], text,
+                               self.comparator, **attributes)
+        raise ValueError(f'Unknown token type: {kind}')
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+
+def tokenize(html, comparator, include_hrefs=True, customize=False,
+             max_spacers=None):
+    """
+    Parse the given HTML and returns a TokenTable of tokens (words with
+    attached tags).
 
     This parses only the content of a page; anything in the head is
     ignored, and the <head> and <body> elements are themselves
@@ -745,15 +1132,26 @@ def tokenize(html, comparator, include_hrefs=True):
     that gets confusing.
 
     If include_hrefs is true, then the href attribute of <a> tags is
-    included as a special kind of diffable token."""
-    if etree.iselement(html):
-        body_el = html
+    included as a special kind of diffable token.
+
+    If `html` is a Beautiful Soup element, its contents are tokenized directly
+    from the tree instead of being parsed again.
+
+    If `customize` is true, spacer tokens are added while tokenizing, like
+    `_customize_tokens()` would, stopping after `max_spacers` spacers."""
+    if isinstance(html, Tag):
+        chunks = flatten_soup_contents(html, include_hrefs=include_hrefs)
     else:
-        body_el = parse_html(html)
-    # Then we split the document into text chunks for each tag, word, and end tag:
-    chunks = flatten_el(body_el, skip_tag=True, include_hrefs=include_hrefs)
+        if etree.iselement(html):
+            body_el = html
+        else:
+            body_el = parse_html(html)
+        # Then we split the document into text chunks for each tag, word, and
+        # end tag:
+        chunks = flatten_el(body_el, skip_tag=True, include_hrefs=include_hrefs)
     # Finally re-joining them into token objects:
-    return fixup_chunks(chunks, comparator)
+    return fixup_chunks(chunks, comparator, customize=customize,
+                        max_spacers=max_spacers)
 
 def parse_html(html):
     """
@@ -777,61 +1175,97 @@ class TokenType(Enum):
     word = 3
     href = 4
     img = 5
+    # These are only created when customizing tokens (see _customize_tokens).
+    spacer = 6
+    minimal_href = 7
+
 
+# Kinds of tokens with special handling in expand_tokens().
+_HREF_KIND = TokenType.href.value
+_UNDIFFABLE_KIND = TokenType.undiffable.value
+# Tokens that are hidden when unchanged (see `DiffToken.hide_when_equal`).
+_HIDDEN_TOKEN_KINDS = (TokenType.href.value, TokenType.minimal_href.value)
+# Tokens that are never rendered (see `MinimalHrefToken` and `SpacerToken`).
+_EMPTY_TOKEN_KINDS = (TokenType.minimal_href.value, TokenType.spacer.value)
 
-def fixup_chunks(chunks, comparator):
+
+def fixup_chunks(chunks, comparator, customize=False, max_spacers=None):
     """
-    This function takes a list of chunks and produces a list of tokens.
+    This function takes a list of chunks and produces a TokenTable of tokens.
+
+    Tags are balanced as they are read, so that a token of text is surrounded
+    by the opening and closing tags of the element it's in. For example:
+
+       <p><a>Hello!</a></p><div>…there.</div>
+
+    Becomes:
+
+       [('Hello!', pre=['<p>','<a>'], post=['</a>','</p>']),
+        ('…there.', pre=[<div>'], post=['</div>'])]
+
+    That is, end tags are a token's post-tags until a start tag or another
+    token comes along; everything after that is the next token's pre-tags.
+
+    If ``customize`` is true, spacer tokens are added as the tokens are read
+    (see ``_TokenCustomizer``), stopping after ``max_spacers`` spacers.
     """
+    result = TokenTable(comparator)
+    string_id = result.string_id
+    if customize:
+        add_token = _TokenCustomizer(result, max_spacers).append
+    else:
+        add_token = result.append_ids
+
+    # A token's post-tags aren't known until the next token (or start tag)
+    # comes along, so the latest token is held here until then.
+    token = None
     tag_accum = []
-    cur_word = None
-    result = []
     for chunk in chunks:
         current_token = chunk[0]
+        if current_token == TokenType.start_tag:
+            tag_accum.append(string_id(chunk[1]))
+            continue
+
+        elif current_token == TokenType.end_tag:
+            if tag_accum:
+                tag_accum.append(string_id(chunk[1]))
+            else:
+                assert token, (
+                    "Weird state, no current word for chunk %r of %r"
+                    % (chunk, chunks))
+                token[4].append(string_id(chunk[1]))
+            continue
+
+        if token:
+            add_token(*token)
+
         if current_token == TokenType.img:
-            src = chunk[1]
             tag, trailing_whitespace = split_trailing_whitespace(chunk[2])
-            cur_word = ImgTagToken('img', data=src, html_repr=tag,
-                                   comparator=comparator, pre_tags=tag_accum,
-                                   trailing_whitespace=trailing_whitespace)
-            tag_accum = []
-            result.append(cur_word)
+            token = [TokenType.img.value, string_id(tag),
+                     string_id(trailing_whitespace), tag_accum, [], chunk[1]]
 
         elif current_token == TokenType.href:
-            href = chunk[1]
-            cur_word = href_token(href, comparator=comparator, pre_tags=tag_accum, trailing_whitespace=" ")
-            tag_accum = []
-            result.append(cur_word)
+            token = [TokenType.href.value, string_id(chunk[1]),
+                     string_id(' '), tag_accum, [], None]
 
         elif current_token == TokenType.undiffable:
-            cur_word = UndiffableContentToken(chunk[1], pre_tags=tag_accum)
-            tag_accum = []
-            result.append(cur_word)
+            token = [TokenType.undiffable.value, string_id(chunk[1]),
+                     string_id(''), tag_accum, [], None]
 
         elif current_token == TokenType.word:
-            chunk, trailing_whitespace = split_trailing_whitespace(chunk[1])
-            cur_word = DiffToken(chunk, pre_tags=tag_accum, trailing_whitespace=trailing_whitespace)
-            tag_accum = []
-            result.append(cur_word)
-
-        elif current_token == TokenType.start_tag:
-            tag_accum.append(chunk[1])
-
-        elif current_token == TokenType.end_tag:
-            if tag_accum:
-                tag_accum.append(chunk[1])
-            else:
-                assert cur_word, (
-                    "Weird state, cur_word=%r, result=%r, chunks=%r of %r"
-                    % (cur_word, result, chunk, chunks))
-                cur_word.post_tags.append(chunk[1])
+            text, trailing_whitespace = split_trailing_whitespace(chunk[1])
+            token = [TokenType.word.value, string_id(text),
+                     string_id(trailing_whitespace), tag_accum, [], None]
         else:
             assert(0)
+        tag_accum = []
 
-    if not result:
-        return [DiffToken('', pre_tags=tag_accum)]
+    if not token:
+        token = [TokenType.word.value, string_id(''), string_id(''),
+                 tag_accum, [], None]
     else:
-        result[-1].post_tags.extend(tag_accum)
+        token[4].extend(tag_accum)
+    add_token(*token)
 
     return result
 
@@ -876,6 +1310,104 @@ def flatten_el(el, include_hrefs, skip_tag=False):
         for word in end_words:
             yield (TokenType.word, html_escape(word))
 
+
+def flatten_soup_contents(el, include_hrefs):
+    """
+    Generate all the text chunks for the contents of a Beautiful Soup element
+    (usually a document's <body>). This is like calling
+    `flatten_el(el, include_hrefs, skip_tag=True)` on an lxml element.
+    """
+    text, children = _soup_text_and_children(el)
+    for word in split_words(text):
+        yield (TokenType.word, html_escape(word))
+    for child, tail in children:
+        yield from flatten_soup_el(child, include_hrefs, tail)
+
+
+def flatten_soup_el(el, include_hrefs, tail=''):
+    """
+    Like `flatten_el`, but for a Beautiful Soup element. Beautiful Soup
+    doesn't track the text following an element as part of it the way lxml
+    does, so that needs to be passed in as `tail`.
+
+    Comments are skipped and <ins> and <del> tags are eliminated (their
+    contents are treated as part of their parent).
+    """
+    text, children = _soup_text_and_children(el)
+    if el.name == 'img':
+        src_array = []
+        el_src = el.get('src')
+        if el_src is not None:
+            src_array.append(el_src)
+        srcset = el.get('srcset')
+        if srcset is not None:
+            for src in srcset.split(','):
+                src_array.append(src.split(' ', maxsplit=1)[0])
+        yield (TokenType.img, src_array, soup_start_tag(el))
+    elif el.name in undiffable_content_tags:
+        if el.find(_is_comment_or_ins_del):
+            el = copy.copy(el)
+            for node in el.find_all(_is_comment_or_ins_del):
+                if isinstance(node, Tag):
+                    node.unwrap()
+                else:
+                    node.extract()
+        element_source = str(el) + html_escape(tail, False)
+        yield (TokenType.undiffable, element_source)
+        return
+    else:
+        yield (TokenType.start_tag, soup_start_tag(el))
+    if el.name in void_tags and not text and not children and not tail:
+        return
+    for word in split_words(text):
+        yield (TokenType.word, html_escape(word))
+    for child, child_tail in children:
+        yield from flatten_soup_el(child, include_hrefs, child_tail)
+    if el.name == 'a' and el.get('href') and include_hrefs:
+        yield (TokenType.href, el.get('href'))
+    yield (TokenType.end_tag, soup_end_tag(el, tail))
+    for word in split_words(tail):
+        yield (TokenType.word, html_escape(word))
+
+
+def _soup_text_and_children(el):
+    """
+    Get the text at the start of a Beautiful Soup element (like lxml's `text`)
+    and a list of its child elements paired with the text following each of
+    them (like lxml's `tail`).
+    """
+    text = []
+    children = []
+    tail = text
+    for node in _diffable_soup_children(el):
+        if isinstance(node, Tag):
+            tail = []
+            children.append((node, tail))
+        else:
+            tail.append(node)
+
+    return ''.join(text), [(child, ''.join(tail)) for child, tail in children]
+
+
+def _diffable_soup_children(el):
+    # FIXME: we have to skip <ins> and <del> tags because *we* use them to
+    # indicate changes that we find. We probably shouldn't do that:
+    # https://github.com/edgi-govdata-archiving/web-monitoring-processing/issues/69#issuecomment-321424897
+    for node in el.children:
+        if isinstance(node, Tag):
+            if _is_ins_or_del(node):
+                yield from _diffable_soup_children(node)
+            else:
+                yield node
+        elif not isinstance(node, Comment):
+            yield node
+
+
+def _is_comment_or_ins_del(node):
+    return isinstance(node, Comment) or (isinstance(node, Tag)
+                                         and _is_ins_or_del(node))
+
+
 split_words_re = re.compile(r'\S+(?:\s+|$)', re.U)
 
 def split_words(text):
@@ -897,6 +1429,43 @@ def start_tag(el):
         el.tag, ''.join([' %s="%s"' % (name, html_escape(value, True))
                          for name, value in el.attrib.items()]))
 
+def soup_start_tag(el):
+    """
+    The text representation of the start tag for a Beautiful Soup element.
+    """
+    return '<%s%s>' % (
+        el.name, ''.join([' %s="%s"' % (name, html_escape(value, True))
+                          for name, value in _soup_attributes(el)]))
+
+def _soup_attributes(el):
+    """
+    Get a sorted list of (name, value) pairs for the attributes of a Beautiful
+    Soup element, matching the attributes lxml would have for it.
+    """
+    attributes = {}
+    for name, value in el.attrs.items():
+        # Multi-valued attributes (like `class`) are lists in Beautiful Soup.
+        if isinstance(value, list):
+            value = ' '.join(value)
+        attributes.setdefault(_xml_attribute_name(name), value)
+    return sorted(attributes.items())
+
+valid_xml_attribute_re = re.compile(r'^[a-z_][a-z0-9._\-]*$')
+invalid_xml_attribute_bytes_re = re.compile(rb'[^a-z0-9._\-]')
+
+def _xml_attribute_name(name):
+    """
+    Make an attribute name valid in XML the way html5-parser does for lxml
+    trees: every byte (in UTF-8) that isn't allowed is replaced with `_`.
+    """
+    if valid_xml_attribute_re.match(name):
+        return name
+    name = invalid_xml_attribute_bytes_re.sub(b'_', name.encode('utf-8'))
+    name = name.decode('ascii')
+    if not name[0].isalpha() and name[0] != '_':
+        name = '_' + name[1:]
+    return name
+
 def end_tag(el):
     """ The text representation of an end tag for a tag.  Includes
     trailing whitespace when appropriate.  """
@@ -906,6 +1475,17 @@ def end_tag(el):
         extra = ''
     return '</%s>%s' % (el.tag, extra)
 
+def soup_end_tag(el, tail):
+    """
+    The text representation of the end tag for a Beautiful Soup element.
+    Includes trailing whitespace when `tail` starts with whitespace.
+    """
+    if tail and start_whitespace_re.search(tail):
+        extra = ' '
+    else:
+        extra = ''
+    return '</%s>%s' % (el.name, extra)
+
 
 # ------------------ END lxml.html.diff Tokenization ------------------------
 
@@ -980,106 +1560,150 @@ class ImgTagToken(tag_token):
 
     def __eq__(self, other):
         if isinstance(other, ImgTagToken):
-            return UrlRules.compare_array(self.data, other.data, self.comparator)
+            return not self.canonical_urls().isdisjoint(other.canonical_urls())
         return False
 
+    def canonical_urls(self):
+        return set(UrlRules.canonicalize(url, self.comparator)
+                   for url in self.data)
+
     def __hash__(self):
-        return super().__hash__()
+        # Images are equal if *any* of their URLs match, so two equal images
+        # can have entirely different sets of URLs. The only hash consistent
+        # with that is one shared by all images.
+        return hash(ImgTagToken)
 
 
-def _customize_tokens(tokens):
-    SPACER_STRING = '\nSPACER'
+def _customize_tokens(tokens, max_spacers=None):
+    """
+    Create a new TokenTable with the tokens of ``tokens`` plus spacer tokens.
+    (See ``_TokenCustomizer``.) ``tokenize(..., customize=True)`` does this
+    while tokenizing, which is faster; this is for tables that already exist.
 
-    # Balance out pre- and post-tags so that a token of text is surrounded by
-    # the opening and closing tags of the element it's in. For example:
-    #
-    #    <p><a>Hello!</a></p><div>…there.</div>
-    #
-    # Currently parses as:
-    #    [('Hello!', pre=['<p>','<a>'], post=[]),
-    #     ('…there.', pre=['</a>','</p>','<div>'], post=['</div>'])]
-    #    (Note the '</div>' post tag is only present at the end of the doc)
-    #
-    # But this attempts make it more like:
-    #
-    #    [('Hello!', pre=['<p>','<a>'], post=['</a>','</p>']),
-    #     ('…there.', pre=[<div>'], post=['</div>'])]
-    #
-    # TODO: when we get around to also forking the parse/tokenize part of this
-    # diff, do this as part of the original tokenization instead.
-    for token_index, token in enumerate(tokens):
-        # logger.debug(f'Handling token {token_index}: {token}')
-        if token_index == 0:
-            continue
-        previous = tokens[token_index - 1]
-        previous_post_complete = False
-        for post_index, tag in enumerate(previous.post_tags):
-            if not tag.startswith('</'):
-                # TODO: should we attempt to fill pure-structure tags here with
-                # spacers? e.g. should we take the "<p><em></em></p>" here and
-                # wrap a spacer token in it instead of moving to "next-text's"
-                # pre_tags? "text</p><p><em></em></p><p>next-text"
-                token.pre_tags = previous.post_tags[post_index:] + token.pre_tags
-                previous.post_tags = previous.post_tags[:post_index]
-                previous_post_complete = True
-                break
+    The tags in ``tokens`` must already be balanced like ``fixup_chunks()``
+    balances them.
+    """
+    result = tokens.derive()
+    customizer = _TokenCustomizer(result, max_spacers)
+    for index in range(len(tokens)):
+        customizer.append(tokens.kinds[index],
+                          tokens.text_ids[index],
+                          tokens.whitespace_ids[index],
+                          tokens.pre_tag_ids(index),
+                          tokens.post_tag_ids(index),
+                          tokens.image_sources.get(index))
+    return result
 
-        if not previous_post_complete:
-            for pre_index, tag in enumerate(token.pre_tags):
-                if not tag.startswith('</'):
-                    if pre_index > 0:
-                        previous.post_tags.extend(token.pre_tags[:pre_index])
-                        token.pre_tags = token.pre_tags[pre_index:]
-                    break
-            else:
-                previous.post_tags.extend(token.pre_tags)
-                token.pre_tags = []
-
-
-        # logger.debug(f'  Result...\n    pre: {token.pre_tags}\n    token: "{token}"\n    post: {token.post_tags}')
-
-    result = []
-    # for token in tokens:
-    for token_index, token in enumerate(tokens):
-        # if str(token).lower().startswith('impacts'):
-        # if str(token).lower().startswith('although'):
-        #     logger.debug(f'SPECIAL TAG!\n  pre: {token.pre_tags}\n  token: "{token}"\n  post: {token.post_tags}')
-
-        # hahaha, this is crazy. But anyway, insert "spacers" that have
-        # identical text the diff algorithm can latch onto as an island of
-        # unchangedness. We do this anywhere a SEPARATABLE_TAG is opened.
-        # Basically, this lets us create a sort of "wall" between changes,
-        # ensuring a continuous insertion or deletion can't spread across
-        # list items, major page sections, etc.
-        # See farther down in this same method for a repeat of this with
-        # `post_tags`
-        try_splitting = len(token.pre_tags) > 0
-        split_start = 0
-        while try_splitting:
-            for tag_index, tag in enumerate(token.pre_tags[split_start:]):
-                split_here = False
-                for name in SEPARATABLE_TAGS:
-                    if tag.startswith(f'<{name}'):
-                        split_here = True
-                        break
-                if split_here:
-                    # new_token = SpacerToken(SPACER_STRING, pre_tags=token.pre_tags[0:tag_index + 1])
-                    # token.pre_tags = token.pre_tags[tag_index + 1:]
-
-                    new_token = SpacerToken(SPACER_STRING, pre_tags=token.pre_tags[0:tag_index + split_start])
-                    token.pre_tags = token.pre_tags[tag_index + split_start:]
-
-                    # tokens.insert(token_index + 1, token)
-                    # token = new_token
-                    result.append(new_token)
-                    result.append(SpacerToken(SPACER_STRING))
-                    result.append(SpacerToken(SPACER_STRING))
-                    try_splitting = len(token.pre_tags) > 1
-                    split_start = 1
-                    break
-                else:
-                    try_splitting = False
 
+# One would *think* including `<h#>` tags here would make sense, but it turns
+# out we've seen a variety of real-world situations where tags flip from inline
+# markup to headings or headings nested by themselves (!) in other structural
+# markup, making them cause frequent problems if included here.
+SEPARATABLE_TAGS = set(['blockquote', 'section', 'article', 'header',
+                        'footer', 'pre', 'ul', 'ol', 'li', 'table', 'p'])
+HEADING_TAGS = set(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+# Note these match tag name *prefixes*, so `<p` also matches `<pre>` and
+# `<param>`. We've always matched tags this way, and changing it would change
+# where diffs are split.
+SEPARATABLE_START_TAG_PATTERN = re.compile(
+    '<(?:%s)' % '|'.join(sorted(SEPARATABLE_TAGS)))
+SEPARATABLE_TAG_PATTERN = re.compile(
+    '</?(?:%s)' % '|'.join(sorted(SEPARATABLE_TAGS)))
+HEADING_TAG_PATTERN = re.compile(
+    '</?(?:%s)' % '|'.join(sorted(HEADING_TAGS)))
+
+SPACER_STRING = '\nSPACER'
+
+# Flags describing how `_TokenCustomizer` treats a tag.
+_SEPARATES = 1
+_OPENS_LINK = 2
+_CLOSES_LINK = 4
+_CLOSES_LIST = 8
+
+
+def _customization_flags(tag):
+    flags = 0
+    if SEPARATABLE_START_TAG_PATTERN.match(tag):
+        flags |= _SEPARATES
+    if tag.startswith('<a'):
+        flags |= _OPENS_LINK
+    elif tag.startswith('</a'):
+        flags |= _CLOSES_LINK
+    if tag.startswith('</ul>'):
+        flags |= _CLOSES_LIST
+    return flags
+
+
+class _TokenCustomizer:
+    """
+    Adds tokens to a TokenTable, inserting "spacer" tokens around them.
+
+    Spacers have identical text the diff algorithm can latch onto as an
+    island of unchangedness. We add them anywhere a SEPARATABLE_TAG is opened.
+    Basically, this lets us create a sort of "wall" between changes, ensuring
+    a continuous insertion or deletion can't spread across list items, major
+    page sections, etc. Links are also changed to ``minimal_href`` tokens,
+    which are diffed, but not rendered.
+
+    Tokens are customized one at a time, so this can be used while tokenizing
+    (see ``fixup_chunks()``). How tags are handled only depends on the tag, so
+    it is worked out once for each distinct tag in the table.
+
+    Parameters
+    ----------
+    table : TokenTable
+        The table to add tokens to.
+    max_spacers : int, optional
+        Stop adding spacers after this many. The crazy spacer token solution
+        can add so much extra stuff to some kinds of pages that
+        SequenceMatcher chokes on it.
+    """
+    def __init__(self, table, max_spacers=None):
+        self.table = table
+        self.spacers_left = max_spacers
+        self._flags = {}
+        self._spacer_id = table.string_id(SPACER_STRING)
+        self._no_whitespace = table.string_id('')
+        self._previous_texts = (None, None)
+
+    def _tag_flags(self, tag_id):
+        flags = self._flags.get(tag_id)
+        if flags is None:
+            flags = self._flags[tag_id] = _customization_flags(
+                self.table.strings[tag_id])
+        return flags
+
+    def _add_spacer(self, text_id=None, pre_tags=(), post_tags=()):
+        if self.spacers_left is not None:
+            if self.spacers_left <= 0:
+                return
+            self.spacers_left -= 1
+        if text_id is None:
+            text_id = self._spacer_id
+        self.table.append_ids(TokenType.spacer.value, text_id,
+                              self._no_whitespace, pre_tags, post_tags)
+
+    def append(self, kind, text_id, whitespace_id, pre_tags=(), post_tags=(),
+               image_sources=None):
+        """
+        Add a token (and any spacers around it) to the table. The arguments
+        are the same as ``TokenTable.append_ids()``.
+        """
+        tag_flags = self._tag_flags
+        strings = self.table.strings
+
+        # Split the pre-tags before each separatable tag, with a spacer
+        # holding the tags in between. (See below for a repeat of this with
+        # `post_tags`.)
+        split_start = 0
+        for index, tag in enumerate(pre_tags):
+            if tag_flags(tag) & _SEPARATES:
+                self._add_spacer(None, pre_tags[split_start:index])
+                self._add_spacer()
+                self._add_spacer()
+                split_start = index
+        if split_start:
+            pre_tags = pre_tags[split_start:]
 
         # This is a CRITICAL scenario, but should probably be generalized and
         # a bit better understood. The case is empty elements that are fully
@@ -1090,117 +1714,62 @@ def _customize_tokens(tokens):
         # All the tags preceeding `Text!` get set as pre_tags for `Text!` and,
         # later, when stuff gets rebalanced, `Text!` gets moved down inside the
         # <div> that completely precedes it.
-        for index, tag in enumerate(token.pre_tags):
-            if tag.startswith('<a') and len(token.pre_tags) > index + 1:
-                next_tag = token.pre_tags[index + 1]
-                if next_tag and next_tag.startswith('</a'):
-                    result.append(SpacerToken('~EMPTY~', pre_tags=token.pre_tags[0:index], post_tags=token.pre_tags[index:]))
-                    token.pre_tags = []
-
-        # if _has_separation_tags(token.pre_tags):
-        #     # result.append(SpacerToken(SPACER_STRING, token.pre_tags))
-        #     # token.pre_tags = []
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-
-        customized = _customize_token(token)
-        result.append(customized)
-
-        if str(customized) == "Posts" and str(tokens[token_index - 1]) == 'Other' and str(tokens[token_index - 2]) == 'and': # and str(tokens[token_index - 3]) == 'posts':
-            logger.debug(f'SPECIAL TAG!\n  pre: {token.pre_tags}\n  token: "{token}"\n  post: {token.post_tags}')
-            next_token = tokens[token_index + 1]
-            logger.debug(f'SPECIAL TAG!\n  pre: {next_token.pre_tags}\n  token: "{next_token}"\n  post: {next_token.post_tags}')
-            for tag_index, tag in enumerate(customized.post_tags):
-                if tag.startswith('</ul>'):
-                    new_token = SpacerToken(SPACER_STRING)
-                    result.append(new_token)
-                    new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index:])
-                    result.append(new_token)
-                    customized.post_tags = customized.post_tags[:tag_index]
-
-        # if isinstance(customized, ImgTagToken):
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     result.append(SpacerToken(SPACER_STRING))
-        #     logger.debug(f'IMAGE TOKEN:')
-        #     logger.debug(f'  pre: {customized.pre_tags}\n  token: "{customized}"\n  post: {customized.post_tags}')
-
-        # if len(customized.post_tags) > 0:
-        #     result.append(SpacerToken('', post_tags=customized.post_tags))
-        #     customized.post_tags = []
-
-        # if (_has_separation_tags(customized.post_tags)):
-        #     result.append(SpacerToken(SPACER_STRING, pre_tags=customized.post_tags))
-        #     # result.append(SpacerToken(SPACER_STRING, post_tags=customized.post_tags, trailing_whitespace=customized.trailing_whitespace))
-        #     customized.post_tags = []
-        #     # customized.trailing_whitespace = ''
-        for tag_index, tag in enumerate(customized.post_tags):
-            split_here = False
-            for name in SEPARATABLE_TAGS:
-                if tag.startswith(f'<{name}'):
-                    split_here = True
-                    break
-            if split_here:
-                # new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index + 1:])
-                # customized.post_tags = customized.post_tags[0:tag_index + 1]
-
-                # new_token = SpacerToken(SPACER_STRING, pre_tags=customized.post_tags[tag_index:])
-                # customized.post_tags = customized.post_tags[0:tag_index]
-
-                new_token = SpacerToken(SPACER_STRING, post_tags=customized.post_tags[tag_index:])
-                customized.post_tags = customized.post_tags[0:tag_index]
-
-                # tokens.insert(token_index + 1, token)
-                # token = new_token
-                result.append(new_token)
-                result.append(SpacerToken(SPACER_STRING))
-                result.append(SpacerToken(SPACER_STRING))
+        for index in range(len(pre_tags) - 1):
+            if (tag_flags(pre_tags[index]) & _OPENS_LINK
+                    and tag_flags(pre_tags[index + 1]) & _CLOSES_LINK):
+                self._add_spacer(self.table.string_id('~EMPTY~'),
+                                 pre_tags[0:index], pre_tags[index:])
+                pre_tags = ()
                 break
 
-    return result
+        # Links are diffed, but not rendered.
+        if kind == TokenType.href.value:
+            kind = TokenType.minimal_href.value
+
+        # Any spacers that need to follow this token. (Its post-tags need to
+        # be settled before it's added to the table.)
+        following = []
+        text = strings[text_id]
+        if text == 'Posts' and self._previous_texts == ('and', 'Other'):
+            logger.debug(f'SPECIAL TAG!\n  token: {text!r}')
+            for index, tag in enumerate(list(post_tags)):
+                if tag_flags(tag) & _CLOSES_LIST:
+                    following.append((self._spacer_id, ()))
+                    following.append((self._spacer_id, post_tags[index:]))
+                    post_tags = post_tags[:index]
+        self._previous_texts = (self._previous_texts[1], text)
+
+        split_post_tags = None
+        for index, tag in enumerate(post_tags):
+            if tag_flags(tag) & _SEPARATES:
+                split_post_tags = post_tags[index:]
+                post_tags = post_tags[0:index]
+                break
+
+        self.table.append_ids(kind, text_id, whitespace_id, pre_tags,
+                              post_tags, image_sources)
+        for spacer_text_id, pre in following:
+            self._add_spacer(spacer_text_id, pre)
+        if split_post_tags is not None:
+            self._add_spacer(None, (), split_post_tags)
+            self._add_spacer()
+            self._add_spacer()
 
 
-# One would *think* including `<h#>` tags here would make sense, but it turns
-# out we've seen a variety of real-world situations where tags flip from inline
-# markup to headings or headings nested by themselves (!) in other structural
-# markup, making them cause frequent problems if included here.
-SEPARATABLE_TAGS = set(['blockquote', 'section', 'article', 'header',
-                        'footer', 'pre', 'ul', 'ol', 'li', 'table', 'p'])
-HEADING_TAGS = set(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
 def _has_separation_tags(tag_list):
     for index, tag in enumerate(tag_list):
-        for name in SEPARATABLE_TAGS:
-            if tag.startswith(f'<{name}') or tag.startswith(f'</{name}'):
-                logger.debug(f'Separating on: {name}')
-                return True
+        match = SEPARATABLE_TAG_PATTERN.match(tag)
+        if match:
+            logger.debug(f'Separating on: {match.group()}')
+            return True
         if 'id=' in tag:
             return True
     return False
 
 def _has_heading_tags(tag_list):
     for index, tag in enumerate(tag_list):
-        for name in HEADING_TAGS:
-            if tag.startswith(f'<{name}') or tag.startswith(f'</{name}'):
-                return True
-
-
-# Seemed so nice and clean! But should probably be merged into
-# `_customize_tokens()` now. Or otherwise it needs to be able to produce more
-# than one token to replace the given token in the stream.
-def _customize_token(token):
-    """
-    Replace existing diffing tokens with customized ones for better output.
-    """
-    if isinstance(token, href_token):
-        return MinimalHrefToken(
-            str(token),
-            comparator=token.comparator,
-            pre_tags=token.pre_tags,
-            post_tags=token.post_tags,
-            trailing_whitespace=token.trailing_whitespace)
-        # return token
-    else:
-        return token
+        if HEADING_TAG_PATTERN.match(tag):
+            return True
 
 
 # TODO: merge and reconcile this with `merge_change_groups()`, which is 90%
@@ -1330,129 +1899,185 @@ def merge_changes(change_chunks, doc, tag_type='ins'):
             doc.append(f'<{nested_tag}>')
 
 
+# The kinds of diffs `assemble_diffs()` can create, in the order they are
+# created.
+DIFF_TYPES = ('combined', 'insertions', 'deletions')
+
+
 def assemble_diff(html1_tokens, html2_tokens, commands, include='combined'):
     """
     Assembles a renderable HTML string from a set of old and new tokens and a
     list of operations to perform agains them.
     """
-    include_insert = include == 'combined' or include == 'insertions'
-    include_delete = include == 'combined' or include == 'deletions'
+    return assemble_diffs(html1_tokens, html2_tokens, commands,
+                          (include,))[include]
+
+
+def assemble_diffs(html1_tokens, html2_tokens, commands,
+                   include=DIFF_TYPES):
+    """
+    Assemble several kinds of diffs (see ``DIFF_TYPES``) from a set of old and
+    new tokens and a list of operations to perform against them. This makes
+    a single pass through the operations, and the tokens for each one are
+    only expanded once, no matter how many kinds of diffs are assembled.
+
+    Parameters
+    ----------
+    html1_tokens : TokenTable
+    html2_tokens : TokenTable
+    commands : list of tuple
+        Opcodes, like those from ``SequenceMatcher.get_opcodes()``.
+    include : sequence of str, optional
+        Which kinds of diffs to assemble. Defaults to all of them.
+
+    Returns
+    -------
+    dict
+        The assembled list of HTML chunks for each kind of diff in
+        ``include``, keyed by kind.
+    """
+    combined = [] if 'combined' in include else None
+    insertions = [] if 'insertions' in include else None
+    deletions = [] if 'deletions' in include else None
+    needs_old = combined is not None or deletions is not None
+    needs_new = combined is not None or insertions is not None
 
     # Generating a combined diff view is a relatively complicated affair. We
     # keep track of all the consecutive insertions and deletions in buffers
     # until we find a portion of the document that is unchanged, at which point
     # we reconcile the DOM structures of the changes before inserting the
     # unchanged parts.
-    result = []
     insert_buffer = []
     delete_buffer = []
 
     for command, i1, i2, j1, j2 in commands:
         if command == 'equal':
-            # When encountering an unchanged series of tokens, we first expand
-            # them to include the HTML elements that are attached to the
-            # tokenized text. Then we find the changed HTML tags before and
-            # after the unchanged text and add them to the previous buffer of
-            # changes and the next buffer of changes, respectively. This
-            # ensures that the reconciliation routine that handles differences
-            # in DOM structure is used on them, while portions that are exactly
-            # the same are simply inserted as-is.
-            #
-            # TODO: this splitting approach could probably be handled better if
-            # it was part of or better integrated with expanding the tokens, so
-            # we could just look at the first token's `pre_tags` and the last
-            # token's `post_tags` instead of having to reverse engineer them.
-            equal_buffer_delete = []
-            equal_buffer_insert = []
-            equal_buffer_delete_next = []
-            equal_buffer_insert_next = []
-            if include_insert and include_delete:
-                merge_change_groups(
-                    expand_tokens(html1_tokens[i1:i2], equal=True),
-                    equal_buffer_delete,
-                    tag_type=None)
-                merge_change_groups(
-                    expand_tokens(html2_tokens[j1:j2], equal=True),
-                    equal_buffer_insert,
-                    tag_type=None)
-
-                first_delete_group = -1
-                first_insert_group = -1
-                for token_index, token in enumerate(equal_buffer_delete):
-                    if isinstance(token, list):
-                        first_delete_group = token_index
-                        break
-                for token_index, token in enumerate(equal_buffer_insert):
-                    if isinstance(token, list):
-                        first_insert_group = token_index
-                        break
-                # In theory we should always find both, but sanity check anyway
-                if first_delete_group > -1 and first_insert_group > -1:
-                    max_index = min(first_delete_group, first_insert_group)
-                    unequal_reverse_index = max_index
-                    for reverse_index in range(max_index):
-                        delete_token = equal_buffer_delete[first_delete_group - 1 - reverse_index]
-                        insert_token = equal_buffer_insert[first_insert_group - 1 - reverse_index]
-                        if delete_token != insert_token:
-                            unequal_reverse_index = reverse_index
-                            break
-                    delete_buffer.extend(equal_buffer_delete[:first_delete_group - unequal_reverse_index])
-                    equal_buffer_delete = equal_buffer_delete[first_delete_group - unequal_reverse_index:]
-                    insert_buffer.extend(equal_buffer_insert[:first_insert_group - unequal_reverse_index])
-                    equal_buffer_insert = equal_buffer_insert[first_insert_group - unequal_reverse_index:]
-
-                last_delete_group = -1
-                last_insert_group = -1
-                # FIXME: totally inefficient; should go backward
-                for token_index, token in enumerate(equal_buffer_delete):
-                    if isinstance(token, list):
-                        last_delete_group = token_index
-                for token_index, token in enumerate(equal_buffer_insert):
-                    if isinstance(token, list):
-                        last_insert_group = token_index
-
-                # In theory we should always find both, but sanity check anyway
-                if last_delete_group > -1 and last_insert_group > -1:
-                    max_range = min(len(equal_buffer_delete) - last_delete_group, len(equal_buffer_insert) - last_insert_group)
-                    unequal_index = max(1, max_range)
-                    for index in range(1, max_range):
-                        delete_token = equal_buffer_delete[last_delete_group + index]
-                        insert_token = equal_buffer_insert[last_insert_group + index]
-                        if delete_token != insert_token:
-                            unequal_index = index
-                            break
-                    equal_buffer_delete_next = equal_buffer_delete[last_delete_group + unequal_index:]
-                    equal_buffer_delete = equal_buffer_delete[:last_delete_group + unequal_index]
-                    equal_buffer_insert_next = equal_buffer_insert[last_insert_group + unequal_index:]
-                    equal_buffer_insert = equal_buffer_insert[:last_insert_group + unequal_index]
-
-            if insert_buffer or delete_buffer:
-                reconcile_change_groups(insert_buffer, delete_buffer, result)
-
-            if include_insert and include_delete:
-                result.extend(flatten_groups(equal_buffer_insert))
-                delete_buffer.extend(equal_buffer_delete_next)
-                insert_buffer.extend(equal_buffer_insert_next)
-            elif include_insert:
-                result.extend(expand_tokens(html2_tokens[j1:j2], equal=True))
-            else:
-                result.extend(expand_tokens(html1_tokens[i1:i2], equal=True))
+            if needs_old:
+                old_equal = list(expand_tokens(html1_tokens, i1, i2,
+                                               equal=True))
+            if needs_new:
+                new_equal = list(expand_tokens(html2_tokens, j1, j2,
+                                               equal=True))
+            if combined is not None:
+                _assemble_unchanged(old_equal, new_equal, insert_buffer,
+                                    delete_buffer, combined)
+            if insertions is not None:
+                insertions.extend(new_equal)
+            if deletions is not None:
+                deletions.extend(old_equal)
             continue
-        if (command == 'insert' or command == 'replace') and include_insert:
-            ins_tokens = expand_tokens(html2_tokens[j1:j2])
-            if include_delete:
+        if (command == 'insert' or command == 'replace') and needs_new:
+            ins_tokens = list(expand_tokens(html2_tokens, j1, j2))
+            if combined is not None:
                 merge_change_groups(ins_tokens, insert_buffer, 'ins')
-            else:
-                merge_changes(ins_tokens, result, 'ins')
-        if (command == 'delete' or command == 'replace') and include_delete:
-            del_tokens = expand_tokens(html1_tokens[i1:i2])
-            if include_insert:
-                merge_change_groups(del_tokens, delete_buffer, 'del')
-            else:
-                merge_changes(del_tokens, result, 'del')
+            if insertions is not None:
+                merge_changes(ins_tokens, insertions, 'ins')
+        if (command == 'delete' or command == 'replace') and needs_old:
+            del_tokens = list(expand_tokens(html1_tokens, i1, i2))
+            if combined is not None:
+                # Active elements are made inert in the combined view, which
+                # only changes undiffable content.
+                if _UNDIFFABLE_KIND in html1_tokens.kinds[i1:i2]:
+                    inert_tokens = expand_tokens(html1_tokens, i1, i2,
+                                                 inert=True)
+                else:
+                    inert_tokens = del_tokens
+                merge_change_groups(inert_tokens, delete_buffer, 'del')
+            if deletions is not None:
+                merge_changes(del_tokens, deletions, 'del')
+
+    results = {}
+    if combined is not None:
+        reconcile_change_groups(insert_buffer, delete_buffer, combined)
+        results['combined'] = combined
+    if insertions is not None:
+        results['insertions'] = insertions
+    if deletions is not None:
+        results['deletions'] = deletions
+    return results
 
-    reconcile_change_groups(insert_buffer, delete_buffer, result)
-    return result
+
+def _assemble_unchanged(old_equal, new_equal, insert_buffer, delete_buffer,
+                        result):
+    """
+    Add an unchanged series of tokens to a combined diff.
+
+    When encountering an unchanged series of tokens, we first expand them to
+    include the HTML elements that are attached to the tokenized text. Then we
+    find the changed HTML tags before and after the unchanged text and add
+    them to the previous buffer of changes and the next buffer of changes,
+    respectively. This ensures that the reconciliation routine that handles
+    differences in DOM structure is used on them, while portions that are
+    exactly the same are simply inserted as-is.
+
+    TODO: this splitting approach could probably be handled better if it was
+    part of or better integrated with expanding the tokens, so we could just
+    look at the first token's `pre_tags` and the last token's `post_tags`
+    instead of having to reverse engineer them.
+    """
+    equal_buffer_delete = []
+    equal_buffer_insert = []
+    equal_buffer_delete_next = []
+    equal_buffer_insert_next = []
+    merge_change_groups(old_equal, equal_buffer_delete, tag_type=None)
+    merge_change_groups(new_equal, equal_buffer_insert, tag_type=None)
+
+    first_delete_group = -1
+    first_insert_group = -1
+    for token_index, token in enumerate(equal_buffer_delete):
+        if isinstance(token, list):
+            first_delete_group = token_index
+            break
+    for token_index, token in enumerate(equal_buffer_insert):
+        if isinstance(token, list):
+            first_insert_group = token_index
+            break
+    # In theory we should always find both, but sanity check anyway
+    if first_delete_group > -1 and first_insert_group > -1:
+        max_index = min(first_delete_group, first_insert_group)
+        unequal_reverse_index = max_index
+        for reverse_index in range(max_index):
+            delete_token = equal_buffer_delete[first_delete_group - 1 - reverse_index]
+            insert_token = equal_buffer_insert[first_insert_group - 1 - reverse_index]
+            if delete_token != insert_token:
+                unequal_reverse_index = reverse_index
+                break
+        delete_buffer.extend(equal_buffer_delete[:first_delete_group - unequal_reverse_index])
+        equal_buffer_delete = equal_buffer_delete[first_delete_group - unequal_reverse_index:]
+        insert_buffer.extend(equal_buffer_insert[:first_insert_group - unequal_reverse_index])
+        equal_buffer_insert = equal_buffer_insert[first_insert_group - unequal_reverse_index:]
+
+    last_delete_group = -1
+    last_insert_group = -1
+    # FIXME: totally inefficient; should go backward
+    for token_index, token in enumerate(equal_buffer_delete):
+        if isinstance(token, list):
+            last_delete_group = token_index
+    for token_index, token in enumerate(equal_buffer_insert):
+        if isinstance(token, list):
+            last_insert_group = token_index
+
+    # In theory we should always find both, but sanity check anyway
+    if last_delete_group > -1 and last_insert_group > -1:
+        max_range = min(len(equal_buffer_delete) - last_delete_group, len(equal_buffer_insert) - last_insert_group)
+        unequal_index = max(1, max_range)
+        for index in range(1, max_range):
+            delete_token = equal_buffer_delete[last_delete_group + index]
+            insert_token = equal_buffer_insert[last_insert_group + index]
+            if delete_token != insert_token:
+                unequal_index = index
+                break
+        equal_buffer_delete_next = equal_buffer_delete[last_delete_group + unequal_index:]
+        equal_buffer_delete = equal_buffer_delete[:last_delete_group + unequal_index]
+        equal_buffer_insert_next = equal_buffer_insert[last_insert_group + unequal_index:]
+        equal_buffer_insert = equal_buffer_insert[:last_insert_group + unequal_index]
+
+    if insert_buffer or delete_buffer:
+        reconcile_change_groups(insert_buffer, delete_buffer, result)
+
+    result.extend(flatten_groups(equal_buffer_insert))
+    delete_buffer.extend(equal_buffer_delete_next)
+    insert_buffer.extend(equal_buffer_insert_next)
 
 
 # TODO: merge and reconcile this with `merge_changes()`, which is 90% the same
@@ -1822,14 +2447,36 @@ class InsensitiveSequenceMatcher(difflib.SequenceMatcher):
     """
     Acts like SequenceMatcher, but tries not to find very small equal
     blocks amidst large spans of changes
+
+    The matching blocks can optionally be found with a different algorithm
+    than SequenceMatcher's (see `web_monitoring.diff.sequence_diff`).
+
+    If `segments` is set, it should be a tuple of the indexes where segments
+    of `a` and `b` start. Segments that are the same in both are matched as a
+    whole and the algorithm only runs on the rest (see
+    `get_segmented_matching_blocks()`).
     """
 
     threshold = 2
 
+    def __init__(self, isjunk=None, a='', b='', autojunk=True,
+                 algorithm='difflib', segments=None):
+        get_algorithm(algorithm)
+        self.algorithm = algorithm
+        self.segments = segments
+        super().__init__(isjunk, a, b, autojunk)
+
     def get_matching_blocks(self):
         size = min(len(self.a), len(self.b))
         threshold = min(self.threshold, size / 4)
-        actual = difflib.SequenceMatcher.get_matching_blocks(self)
+        if self.segments:
+            actual = get_segmented_matching_blocks(self.a, self.b,
+                                                   *self.segments,
+                                                   self.algorithm)
+        elif self.algorithm == 'difflib':
+            actual = difflib.SequenceMatcher.get_matching_blocks(self)
+        else:
+            actual = get_matching_blocks(self.a, self.b, self.algorithm)
         return [item for item in actual
                 if item[2] > threshold
                 or not item[2]]
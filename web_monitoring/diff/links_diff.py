@@ -1,6 +1,8 @@
+import copy
 import html5_parser
 from .content_type import raise_if_not_diffable_html
 from .differs import compute_dmp_diff
+from .parsing import parse_html_document
 from ..utils import get_color_palette
 from difflib import SequenceMatcher
 from .html_diff_render import (get_title, _html_for_dmp_operation,
@@ -9,7 +11,7 @@ import re
 
 
 def links_diff(a_text, b_text, a_headers=None, b_headers=None,
-               content_type_options='normal'):
+               content_type_options='normal', a_soup=None, b_soup=None):
     """
     Extracts all the outgoing links from a page and produces a diff of an
     HTML document that is simply a list of the text and URL of those links.
@@ -29,8 +31,10 @@ def links_diff(a_text, b_text, a_headers=None, b_headers=None,
         b_headers,
         content_type_options)
 
-    a_soup = html5_parser.parse(a_text, treebuilder='soup', return_root=False)
-    b_soup = html5_parser.parse(b_text, treebuilder='soup', return_root=False)
+    if a_soup is None:
+        a_soup = parse_html_document(a_text)
+    if b_soup is None:
+        b_soup = parse_html_document(b_text)
 
     a_links = sorted(
         set([Link.from_element(element) for element in _find_outgoing_links(a_soup)]),
@@ -52,13 +56,13 @@ def links_diff(a_text, b_text, a_headers=None, b_headers=None,
 
 
 def links_diff_json(a_text, b_text, a_headers=None, b_headers=None,
-                    content_type_options='normal'):
+                    content_type_options='normal', a_soup=None, b_soup=None):
     """
     Generate a diff of all outgoing links (see `links_diff()`) where the `diff`
     property is formatted as a list of change codes and values.
     """
     diff = links_diff(a_text, b_text, a_headers, b_headers,
-                      content_type_options)
+                      content_type_options, a_soup, b_soup)
     return {
         'change_count': diff['change_count'],
         'diff': diff['diff']
@@ -66,13 +70,13 @@ def links_diff_json(a_text, b_text, a_headers=None, b_headers=None,
 
 
 def links_diff_html(a_text, b_text, a_headers=None, b_headers=None,
-                    content_type_options='normal'):
+                    content_type_options='normal', a_soup=None, b_soup=None):
     """
     Generate a diff of all outgoing links (see `links_diff()`) where the `diff`
     property is an HTML string. Note the actual return type is still JSON.
     """
     diff = links_diff(a_text, b_text, a_headers, b_headers,
-                      content_type_options)
+                      content_type_options, a_soup, b_soup)
     soup = _render_html_diff(diff['diff'])
 
     # Add styling and metadata
@@ -205,7 +209,9 @@ def _get_link_text(link):
     Get the "text" to diff and display for an `<a>` element.
     """
     # The content of tags like <script> and <style> shows up in the `.text`
-    # attribute, so just go ahead and remove them from the DOM
+    # attribute, so just go ahead and remove them from the DOM. (Work on a
+    # copy, since the document may be shared with other differs.)
+    link = copy.copy(link)
     for invisible_tag in link.find_all(undiffable_content_tags):
         invisible_tag.extract()
 
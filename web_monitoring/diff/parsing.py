@@ -0,0 +1,36 @@
+# Tools for parsing HTML once and sharing the parsed documents between all the
+# differs that need them.
+
+from functools import lru_cache
+import html5_parser
+
+# How many parsed documents each process keeps around for reuse. Parsed
+# documents can be quite large, so we only need enough to cover the two sides
+# of the diffs a process is currently working on.
+PARSE_CACHE_SIZE = 4
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_html_document(text):
+    """
+    Parse an HTML document into a Beautiful Soup tree.
+
+    Results are cached, so calling this multiple times with the same text (for
+    example, from several differs working on the same page) only parses it
+    once. Because of that, the returned document is shared and **must not be
+    modified**. If you need to modify it, make a copy first with
+    ``copy.copy(soup)``.
+
+    Leading and trailing whitespace in the text is ignored.
+
+    Parameters
+    ----------
+    text : string
+        Source HTML to parse.
+
+    Returns
+    -------
+    bs4.BeautifulSoup
+    """
+    return html5_parser.parse(text.strip(), treebuilder='soup',
+                              return_root=False)
@@ -0,0 +1,483 @@
+"""
+Algorithms for finding the parts of two sequences that match.
+
+Each algorithm is a function that takes two sequences of hashable items and
+returns their matching blocks in the same form as
+``difflib.SequenceMatcher.get_matching_blocks()``: a list of
+``(a_index, b_index, size)`` triples, in increasing order of both indexes,
+ending with a ``(len(a), len(b), 0)`` sentinel.
+
+- ``difflib`` is the standard library's algorithm. It repeatedly finds the
+  longest matching block, which can take roughly quadratic time on long
+  sequences with lots of repeated items (e.g. navigation lists).
+- ``myers`` finds a minimal diff in O(ND) time (where D is the number of
+  differences). Very different sequences can take a long time, so once a
+  search gets too expensive, it settles for a good, but not minimal, diff.
+- ``patience`` anchors the diff on items that appear exactly once in both
+  sequences, then diffs the gaps between them.
+- ``histogram`` is an extension of ``patience`` that anchors on the least
+  frequent items rather than only unique ones.
+
+Use ``get_matching_blocks()`` to run one of them by name. For long sequences
+that are divided into segments, ``get_segmented_matching_blocks()`` matches
+unchanged segments as a whole and only runs an algorithm on the rest. The
+windows of changes between those segments can be matched in parallel inside
+``parallel_windows()``.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from difflib import Match, SequenceMatcher
+
+# Once the Myers search for a split point has gone this many edits without
+# finding one, give up on a minimal diff and split at the furthest point it
+# reached instead.
+MYERS_MAX_COST = 256
+
+# The histogram algorithm ignores items that appear more often than this in a
+# region of the `a` sequence (these are usually things like "the" or spacers,
+# which make poor anchors).
+HISTOGRAM_MAX_OCCURRENCES = 64
+
+# Inside `parallel_windows()`, windows with at least this many items (in both
+# sequences together) are matched in other processes. Smaller ones aren't
+# worth the cost of sending them.
+PARALLEL_WINDOW_SIZE = 5000
+
+_parallel_windows = ContextVar('parallel_windows', default=None)
+
+
+@contextmanager
+def parallel_windows(apply_async, min_size=None):
+    """
+    Match large windows of changes in ``get_segmented_matching_blocks()`` in
+    parallel inside the ``with`` block. The results are exactly the same as
+    matching them one at a time.
+
+    Parameters
+    ----------
+    apply_async : callable
+        Called like ``multiprocessing.pool.Pool.apply_async(function, args)``
+        to run ``function(*args)`` in another process, and returns an object
+        with a ``get()`` method for the result. Usually this is a pool's
+        ``apply_async`` method.
+    min_size : int, optional
+        Only match windows with at least this many items in parallel. Defaults
+        to ``PARALLEL_WINDOW_SIZE``.
+
+    Examples
+    --------
+    >>> with multiprocessing.Pool(4) as pool:
+    >>>     with parallel_windows(pool.apply_async):
+    >>>         html_diff_render(a, b)
+    """
+    if min_size is None:
+        min_size = PARALLEL_WINDOW_SIZE
+    token = _parallel_windows.set((apply_async, min_size))
+    try:
+        yield
+    finally:
+        _parallel_windows.reset(token)
+
+
+def get_matching_blocks(a, b, algorithm='difflib'):
+    """
+    Find the matching blocks between two sequences.
+
+    Parameters
+    ----------
+    a : sequence
+    b : sequence
+    algorithm : string
+        Name of the algorithm to use. One of: `difflib`, `myers`, `patience`,
+        or `histogram`. (Default: `difflib`)
+
+    Returns
+    -------
+    list of difflib.Match
+    """
+    return get_algorithm(algorithm)(a, b)
+
+
+def get_segmented_matching_blocks(a, b, a_starts, b_starts,
+                                  algorithm='difflib'):
+    """
+    Find the matching blocks between two sequences that are divided into
+    segments (e.g. the block-level elements of a page). Segments that are
+    exactly the same in both sequences are matched as a whole, and the
+    algorithm only runs on the windows of items between them, so the cost
+    depends more on how much changed than on how long the sequences are.
+
+    This doesn't always find the same blocks as running the algorithm on the
+    whole sequences, since matches can't cross from a window into a segment
+    that was matched as a whole.
+
+    Parameters
+    ----------
+    a : sequence
+    b : sequence
+    a_starts : sequence of int
+        Indexes in ``a`` where each segment starts, in increasing order.
+    b_starts : sequence of int
+        Indexes in ``b`` where each segment starts, in increasing order.
+    algorithm : string
+        Name of the algorithm to use for matching segments and the windows
+        between them. (Default: `difflib`)
+
+    Returns
+    -------
+    list of difflib.Match
+    """
+    match = get_algorithm(algorithm)
+    a_bounds = _segment_bounds(a_starts, len(a))
+    b_bounds = _segment_bounds(b_starts, len(b))
+    a_keys = [tuple(a[start:end]) for start, end in a_bounds]
+    b_keys = [tuple(b[start:end]) for start, end in b_bounds]
+
+    blocks = []
+    windows = []
+    a_position = b_position = 0
+    for a_segment, b_segment, count in match(a_keys, b_keys):
+        if count:
+            a_start = a_bounds[a_segment][0]
+            b_start = b_bounds[b_segment][0]
+            a_end = a_bounds[a_segment + count - 1][1]
+        else:
+            # The sentinel; match whatever is left after the last segment.
+            a_start = a_end = len(a)
+            b_start = len(b)
+
+        if a_position < a_start and b_position < b_start:
+            windows.append((a_position, a_start, b_position, b_start))
+
+        if count:
+            blocks.append((a_start, b_start, a_end - a_start))
+            a_position = a_end
+            b_position = b_bounds[b_segment + count - 1][1]
+
+    # Send all but one of the large windows to be matched in parallel (if
+    # we can), and match the rest here while waiting for them.
+    pending = []
+    parallel = _parallel_windows.get()
+    if parallel:
+        apply_async, min_size = parallel
+        large = [window for window in windows
+                 if window[1] - window[0] + window[3] - window[2] >= min_size]
+        for alo, ahi, blo, bhi in large[1:]:
+            result = apply_async(get_matching_blocks,
+                                 (a[alo:ahi], b[blo:bhi], algorithm))
+            pending.append((alo, blo, result))
+        sent = set(large[1:])
+        windows = [window for window in windows if window not in sent]
+
+    for alo, ahi, blo, bhi in windows:
+        _add_window_blocks(blocks, match(a[alo:ahi], b[blo:bhi]), alo, blo)
+    for alo, blo, result in pending:
+        _add_window_blocks(blocks, result.get(), alo, blo)
+
+    # Blocks are sorted here, so they are in order no matter how the windows
+    # were matched.
+    return _finish_blocks(blocks, len(a), len(b))
+
+
+def _add_window_blocks(blocks, window_blocks, alo, blo):
+    "Add the blocks from a window starting at ``(alo, blo)`` to ``blocks``."
+    for i, j, size in window_blocks:
+        if size:
+            blocks.append((alo + i, blo + j, size))
+
+
+def _segment_bounds(starts, length):
+    "Get a list of ``(start, end)`` index pairs for a sequence's segments."
+    starts = [start for start in starts if 0 < start < length]
+    starts.insert(0, 0)
+    ends = starts[1:] + [length]
+    return [(start, end) for start, end in zip(starts, ends) if start < end]
+
+
+def get_algorithm(name):
+    """
+    Get the function for a matching algorithm by name. Raises ``KeyError`` if
+    there is no algorithm with that name.
+    """
+    try:
+        return ALGORITHMS[name]
+    except KeyError:
+        raise KeyError(f'{name} is an invalid diff algorithm.')
+
+
+def difflib_matching_blocks(a, b):
+    return SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks()
+
+
+def myers_matching_blocks(a, b):
+    return _solve(a, b, _myers_region)
+
+
+def patience_matching_blocks(a, b):
+    return _solve(a, b, _patience_region)
+
+
+def histogram_matching_blocks(a, b):
+    return _solve(a, b, _histogram_region)
+
+
+ALGORITHMS = {
+    'difflib': difflib_matching_blocks,
+    'myers': myers_matching_blocks,
+    'patience': patience_matching_blocks,
+    'histogram': histogram_matching_blocks,
+}
+
+
+def _solve(a, b, split_region):
+    """
+    Find matching blocks by repeatedly splitting the sequences into smaller
+    regions. ``split_region(a, alo, ahi, b, blo, bhi)`` is given a non-empty
+    region with no common prefix or suffix and returns a list of matching
+    blocks that divide it (blocks may be empty if they only mark a place to
+    split), or an empty list if the region has no matches. Each region before,
+    between, and after those blocks is then split in turn.
+    """
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+
+        # Common prefixes and suffixes are always matches.
+        start = 0
+        limit = min(ahi - alo, bhi - blo)
+        while start < limit and a[alo + start] == b[blo + start]:
+            start += 1
+        if start:
+            blocks.append((alo, blo, start))
+            alo += start
+            blo += start
+
+        end = 0
+        limit = min(ahi - alo, bhi - blo)
+        while end < limit and a[ahi - end - 1] == b[bhi - end - 1]:
+            end += 1
+        if end:
+            blocks.append((ahi - end, bhi - end, end))
+            ahi -= end
+            bhi -= end
+
+        if alo == ahi or blo == bhi:
+            continue
+
+        splits = split_region(a, alo, ahi, b, blo, bhi)
+        for i, j, size in splits:
+            if size:
+                blocks.append((i, j, size))
+            regions.append((alo, i, blo, j))
+            alo = i + size
+            blo = j + size
+        if splits:
+            regions.append((alo, ahi, blo, bhi))
+
+    return _finish_blocks(blocks, len(a), len(b))
+
+
+def _finish_blocks(blocks, a_length, b_length):
+    """
+    Sort blocks, merge any that are adjacent, and add the sentinel block, like
+    ``difflib.SequenceMatcher.get_matching_blocks()`` does.
+    """
+    blocks.sort()
+    merged = []
+    i1 = j1 = k1 = 0
+    for i2, j2, k2 in blocks:
+        if i1 + k1 == i2 and j1 + k1 == j2:
+            k1 += k2
+        else:
+            if k1:
+                merged.append(Match(i1, j1, k1))
+            i1, j1, k1 = i2, j2, k2
+    if k1:
+        merged.append(Match(i1, j1, k1))
+
+    merged.append(Match(a_length, b_length, 0))
+    return merged
+
+
+def _myers_region(a, alo, ahi, b, blo, bhi):
+    """
+    Find the "middle snake" of a region: the matching block (possibly empty)
+    in the middle of a minimal diff. See "An O(ND) Difference Algorithm and
+    Its Variations" by Eugene W. Myers.
+
+    This searches forward from the start of the region and backward from the
+    end at the same time. Each search tracks the furthest point it has reached
+    on every diagonal ``k = x - y`` with ``d`` edits, and they meet in the
+    middle. Positions in the backward search are measured from the end.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    delta = n - m
+    odd = delta & 1
+    offset = m + 1
+    # -1 marks a diagonal that hasn't been reached.
+    forward = [-1] * (n + m + 3)
+    backward = [-1] * (n + m + 3)
+    forward[offset + 1] = 0
+    backward[offset + 1] = 0
+
+    for d in range((n + m + 1) // 2 + 1):
+        # Only diagonals that pass through the region are worth searching.
+        k_min = -d if d <= m else -m + ((d - m) & 1)
+        k_max = d if d <= n else n - ((d - n) & 1)
+
+        for k in range(k_min, k_max + 1, 2):
+            x = _next_x(forward, offset, k, n, m)
+            if x < 0:
+                continue
+            y = x - k
+            start_x = x
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd:
+                reverse_x = backward[offset + delta - k]
+                if reverse_x >= 0 and x + reverse_x >= n:
+                    return [(alo + start_x, blo + start_x - k, x - start_x)]
+
+        for k in range(k_min, k_max + 1, 2):
+            x = _next_x(backward, offset, k, n, m)
+            if x < 0:
+                continue
+            y = x - k
+            start_x = x
+            while x < n and y < m and a[ahi - x - 1] == b[bhi - y - 1]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd:
+                forward_x = forward[offset + delta - k]
+                if forward_x >= 0 and forward_x + x >= n:
+                    return [(ahi - x, bhi - y, x - start_x)]
+
+        if d >= MYERS_MAX_COST:
+            # Too expensive! Split at the furthest point the forward search
+            # has reached and solve each side separately.
+            best_x, best_k = max(
+                (forward[offset + k] * 2 - k, k)
+                for k in range(k_min, k_max + 1, 2)
+                if forward[offset + k] >= 0)
+            x = (best_x + best_k) // 2
+            return [(alo + x, blo + x - best_k, 0)]
+
+    raise RuntimeError('Myers diff did not find a middle snake.')
+
+
+def _next_x(furthest, offset, k, n, m):
+    """
+    Find the furthest ``x`` a search can reach on diagonal ``k`` with one more
+    edit than it used to reach diagonals ``k - 1`` and ``k + 1``. Returns -1 if
+    neither neighbor can reach it.
+    """
+    # Moving down (an insertion) from diagonal `k + 1`...
+    down = furthest[offset + k + 1]
+    if down - k > m:
+        down = -1
+    # ...or right (a deletion) from diagonal `k - 1`.
+    right = furthest[offset + k - 1]
+    if right >= 0:
+        right += 1
+        if right > n:
+            right = -1
+    return down if down >= right else right
+
+
+def _patience_region(a, alo, ahi, b, blo, bhi):
+    """
+    Split a region on the longest increasing sequence of items that are unique
+    in both ``a`` and ``b``.
+    """
+    # item -> [count in a, count in b, index in a, index in b]
+    counts = {}
+    for i in range(alo, ahi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, 0, i, -1]
+        else:
+            entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[1] += 1
+            entry[3] = j
+
+    uniques = sorted((i, j) for a_count, b_count, i, j in counts.values()
+                     if a_count == 1 and b_count == 1)
+    if not uniques:
+        return _myers_region(a, alo, ahi, b, blo, bhi)
+
+    # Find the longest subsequence of `uniques` that is also in order in `b`
+    # with patience sorting.
+    pile_tops = []
+    pile_top_indexes = []
+    previous = [-1] * len(uniques)
+    for index, (_, j) in enumerate(uniques):
+        pile = bisect_left(pile_tops, j)
+        if pile:
+            previous[index] = pile_top_indexes[pile - 1]
+        if pile == len(pile_tops):
+            pile_tops.append(j)
+            pile_top_indexes.append(index)
+        else:
+            pile_tops[pile] = j
+            pile_top_indexes[pile] = index
+
+    anchors = []
+    index = pile_top_indexes[-1]
+    while index >= 0:
+        i, j = uniques[index]
+        anchors.append((i, j, 1))
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _histogram_region(a, alo, ahi, b, blo, bhi):
+    """
+    Split a region on the longest matching block that contains the least
+    frequently occurring item in ``a``.
+    """
+    occurrences = defaultdict(list)
+    for i in range(alo, ahi):
+        occurrences[a[i]].append(i)
+
+    best = None
+    best_count = HISTOGRAM_MAX_OCCURRENCES
+    best_size = 0
+    j = blo
+    while j < bhi:
+        next_j = j + 1
+        positions = occurrences.get(b[j])
+        if positions is not None and len(positions) <= best_count:
+            for i in positions:
+                start_i, start_j = i, j
+                while (start_i > alo and start_j > blo
+                       and a[start_i - 1] == b[start_j - 1]):
+                    start_i -= 1
+                    start_j -= 1
+                end_i, end_j = i + 1, j + 1
+                while end_i < ahi and end_j < bhi and a[end_i] == b[end_j]:
+                    end_i += 1
+                    end_j += 1
+
+                size = end_i - start_i
+                if len(positions) < best_count or size > best_size:
+                    best = (start_i, start_j, size)
+                    best_count = len(positions)
+                    best_size = size
+                # Items inside this block would only find the same block.
+                next_j = max(next_j, end_j)
+        j = next_j
+
+    if best is None:
+        return _myers_region(a, alo, ahi, b, blo, bhi)
+    return [best]
@@ -0,0 +1,69 @@
+"""
+Tools for timing the stages of a diff.
+
+Differs mark the stages of their work with ``timed()``, and whatever is
+calling them can collect how long each stage took with ``collect_timings()``.
+When nothing is collecting timings, ``timed()`` does next to nothing.
+
+Examples
+--------
+In a differ:
+
+>>> with timed('tokenize'):
+>>>     tokens = tokenize(text)
+
+Collecting the timings:
+
+>>> with collect_timings() as timings:
+>>>     result = differ(a_text, b_text)
+>>> timings
+{'tokenize': 0.0123}
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+import time
+
+_timings = ContextVar('timings', default=None)
+
+
+@contextmanager
+def collect_timings(timings=None):
+    """
+    Collect the time spent in each stage marked with ``timed()`` inside the
+    ``with`` block.
+
+    Parameters
+    ----------
+    timings : dict, optional
+        Dict to add timings to. If not set, a new dict is created.
+
+    Yields
+    ------
+    dict
+        Time in seconds spent in each stage, keyed by stage name.
+    """
+    if timings is None:
+        timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+@contextmanager
+def timed(stage):
+    """
+    Mark the ``with`` block as a stage of the work being timed. If a stage
+    happens several times, the times are added up.
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
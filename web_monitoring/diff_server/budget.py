@@ -0,0 +1,106 @@
+"""
+Tools for limiting how much CPU time and memory a diff can use.
+
+These are meant to be used inside the worker processes that actually run
+diffs, so a pathological page can't tie up a worker forever.
+"""
+from contextlib import contextmanager
+import os
+import resource
+import signal
+import sys
+import time
+from ..diff.diff_errors import DiffBudgetExceededError
+
+# How often (in seconds of CPU time) to check whether a budget has been used
+# up. Memory use is only checked this often, too.
+CHECK_INTERVAL = 0.1
+
+try:
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    PAGE_SIZE = 4096
+
+
+def current_memory():
+    """
+    Get the resident set size (RSS) of the current process, in bytes. If the
+    current RSS is not available on this platform, this is the peak RSS.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes; everybody else reports kilobytes.
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+@contextmanager
+def enforce_budget(cpu_time=None, memory=None):
+    """
+    Raise ``DiffBudgetExceededError`` from inside the ``with`` block if it
+    uses more than a given amount of CPU time or memory.
+
+    This works with a timer signal, so it must be used on the main thread,
+    and the error can be raised between any two Python instructions inside
+    the block. (Long-running C code won't be interrupted until it returns.)
+    Budgets are not enforced on platforms without ``signal.setitimer``.
+
+    Parameters
+    ----------
+    cpu_time : float, optional
+        Maximum CPU time (user + system) in seconds. If ``0`` or ``None``,
+        CPU time is not limited.
+    memory : int, optional
+        Maximum amount in bytes that the process's resident set size (RSS) can
+        grow by. If ``0`` or ``None``, memory is not limited.
+
+    Examples
+    --------
+    Don't spend more than 10 seconds on a diff:
+
+    >>> with enforce_budget(cpu_time=10):
+    >>>     html_diff_render(a, b)
+    """
+    if not (cpu_time or memory) or not hasattr(signal, 'setitimer'):
+        yield
+        return
+
+    start_time = time.process_time()
+    start_memory = current_memory() if memory else 0
+
+    def check_budget(signal_number, frame):
+        used_time = time.process_time() - start_time
+        if cpu_time and used_time > cpu_time:
+            stop_timer()
+            raise DiffBudgetExceededError('cpu_time', cpu_time, used_time)
+        if memory:
+            used_memory = current_memory() - start_memory
+            if used_memory > memory:
+                stop_timer()
+                raise DiffBudgetExceededError('memory', memory, used_memory)
+
+    interval = CHECK_INTERVAL
+    if cpu_time:
+        interval = min(interval, cpu_time)
+    previous_handler = signal.signal(signal.SIGPROF, check_budget)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        yield
+    finally:
+        stop_timer()
+        signal.signal(signal.SIGPROF, previous_handler)
+
+
+def stop_timer():
+    signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+def call_with_budget(cpu_time, memory, function, *args, **kwargs):
+    """
+    Call a function inside ``enforce_budget(cpu_time, memory)``. This is handy
+    for running a function in a process pool with a budget.
+    """
+    with enforce_budget(cpu_time, memory):
+        return function(*args, **kwargs)
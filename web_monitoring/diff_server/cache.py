@@ -0,0 +1,340 @@
+"""
+Caching tools for the diff server.
+"""
+import asyncio
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+from pathlib import Path
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+class LruCache:
+    """
+    A least-recently-used cache that is bounded by the total size of the
+    values it holds rather than by the number of entries. It can optionally
+    be backed by a second, larger tier of files on disk, which is also bounded
+    by size and survives restarts.
+
+    Values are written through to the disk tier (if there is one) when they
+    are set. When a value is not found in memory but is on disk, it is loaded
+    and promoted back into memory. Files on disk hold raw bytes (as produced
+    by ``to_bytes``), never pickles, so a shared cache directory can't be used
+    to run code in the server.
+
+    Use ``get_async()`` and ``set_async()`` from coroutines: they read and
+    write files in a thread, so big values don't block the event loop.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum total size (as measured by ``size_of``) of the values to keep
+        in memory. If ``0``, nothing is kept in memory.
+    directory : str or pathlib.Path, optional
+        Directory to keep the disk tier in. If not set, there is no disk tier.
+    max_disk_size : int, optional
+        Maximum total size (in bytes) of the files in the disk tier. If ``0``
+        or ``None``, the disk tier is unbounded.
+    size_of : callable, optional
+        Calculate the size of a value. Defaults to ``len``.
+    to_bytes : callable, optional
+        Convert a value to bytes to store in the disk tier. Defaults to
+        storing values (which must be bytes) as-is.
+    from_bytes : callable, optional
+        Convert bytes from the disk tier back to a value. Defaults to
+        returning the bytes as-is.
+
+    Examples
+    --------
+    Keep up to 1 MB of bytes in memory:
+
+    >>> cache = LruCache(1024 * 1024)
+    >>> cache.set('a', b'some bytes')
+    >>> cache.get('a')
+    b'some bytes'
+    >>> cache.get('b') is None
+    True
+    """
+    def __init__(self, max_size, directory=None, max_disk_size=None,
+                 size_of=len, to_bytes=None, from_bytes=None):
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.size_of = size_of
+        self.to_bytes = to_bytes or _unchanged
+        self.from_bytes = from_bytes or _unchanged
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+        self.directory = None
+        self.disk_size = 0
+        self._disk_entries = OrderedDict()
+        if directory:
+            self.directory = Path(directory)
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._load_disk_index()
+
+    def get(self, key, default=None):
+        """
+        Get the value for a key, or ``default`` if it is not in the cache.
+        """
+        value = self._get_memory(key)
+        if value is None:
+            name = self._find_disk(key)
+            if name:
+                value = self._promote(key, name, self._read_file(name))
+        if value is None:
+            self.misses += 1
+            return default
+        return value
+
+    async def get_async(self, key, default=None):
+        """
+        Like ``get()``, but reads from the disk tier without blocking the
+        event loop.
+        """
+        value = self._get_memory(key)
+        if value is None:
+            name = self._find_disk(key)
+            if name:
+                loop = asyncio.get_running_loop()
+                value = self._promote(key, name, await loop.run_in_executor(
+                    None, self._read_file, name))
+        if value is None:
+            self.misses += 1
+            return default
+        return value
+
+    def set(self, key, value):
+        """Add a value to the cache, evicting old values as necessary."""
+        self._set_memory(key, value)
+        if self.directory is not None:
+            name = self._disk_name(key)
+            size = self._write_file(name, value)
+            self._remove_files(self._add_disk(name, size))
+
+    async def set_async(self, key, value):
+        """
+        Like ``set()``, but writes to the disk tier without blocking the
+        event loop.
+        """
+        self._set_memory(key, value)
+        if self.directory is not None:
+            loop = asyncio.get_running_loop()
+            name = self._disk_name(key)
+            size = await loop.run_in_executor(None, self._write_file, name,
+                                              value)
+            evicted = self._add_disk(name, size)
+            if evicted:
+                await loop.run_in_executor(None, self._remove_files, evicted)
+
+    def __contains__(self, key):
+        return key in self._entries or (
+            self.directory is not None
+            and self._disk_name(key) in self._disk_entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Get a dict describing the current state of the cache and how often it
+        has been hit or missed.
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': total and self.hits / total,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'disk_entries': len(self._disk_entries),
+            'disk_size': self.disk_size,
+        }
+
+    def _get_memory(self, key):
+        try:
+            size, value = self._entries[key]
+        except KeyError:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _set_memory(self, key, value):
+        size = self.size_of(value)
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[0]
+
+        # Don't flush the whole cache for one value that will never fit.
+        if size > self.max_size:
+            return
+
+        self._entries[key] = (size, value)
+        self.size += size
+        while self.size > self.max_size:
+            _, (old_size, _) = self._entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    @staticmethod
+    def _disk_name(key):
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _load_disk_index(self):
+        files = []
+        for path in self.directory.iterdir():
+            if path.is_file() and not path.name.startswith('.'):
+                stat = path.stat()
+                files.append((stat.st_mtime, path.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._disk_entries[name] = size
+            self.disk_size += size
+
+    # The methods below that deal with the disk tier are split into ones that
+    # do file I/O (which may run in a thread) and ones that update the index
+    # of files (which must run on the event loop's thread).
+
+    def _find_disk(self, key):
+        if self.directory is None:
+            return None
+        name = self._disk_name(key)
+        return name if name in self._disk_entries else None
+
+    def _promote(self, key, name, value):
+        if value is None:
+            self.disk_size -= self._disk_entries.pop(name, 0)
+            return None
+
+        self._disk_entries.move_to_end(name)
+        self.hits += 1
+        self.disk_hits += 1
+        self._set_memory(key, value)
+        return value
+
+    def _add_disk(self, name, size):
+        """
+        Record a newly written file in the index. Returns a list of names of
+        old files that should be removed to stay under ``max_disk_size``.
+        """
+        if size is None:
+            return []
+
+        self.disk_size -= self._disk_entries.pop(name, 0)
+        self._disk_entries[name] = size
+        self.disk_size += size
+        evicted = []
+        while self.max_disk_size and self.disk_size > self.max_disk_size:
+            old_name, old_size = self._disk_entries.popitem(last=False)
+            self.disk_size -= old_size
+            evicted.append(old_name)
+        return evicted
+
+    def _read_file(self, name):
+        try:
+            with open(self.directory / name, 'rb') as file:
+                return self.from_bytes(file.read())
+        except Exception as error:
+            logger.warning(f'Could not read cache file {name}: {error}')
+            self._remove_files([name])
+            return None
+
+    def _write_file(self, name, value):
+        # Write to a temporary file and move it into place so that other
+        # processes sharing the directory never see a partial file.
+        data = self.to_bytes(value)
+        if self.max_disk_size and len(data) > self.max_disk_size:
+            return None
+
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory,
+                                                      prefix='.')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(data)
+            os.replace(temporary_path, self.directory / name)
+        except OSError as error:
+            logger.warning(f'Could not write cache file {name}: {error}')
+            self._remove_files([temporary_path])
+            return None
+
+        return len(data)
+
+    def _remove_files(self, names):
+        for name in names:
+            try:
+                os.remove(self.directory / name)
+            except OSError:
+                pass
+
+
+def _unchanged(value):
+    return value
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent work with the same key, so that only the first caller
+    actually does the work and any others that arrive while it is in progress
+    just wait for (and share) its result or exception.
+
+    This is like a cache that only lasts as long as the work it's caching is
+    in progress, so it works well in front of an actual cache.
+
+    Examples
+    --------
+    Only make one request for a URL at a time:
+
+    >>> in_flight = SingleFlight()
+    >>> async def fetch(url):
+    >>>     return await in_flight.run(url, lambda: client.fetch(url))
+    """
+    def __init__(self):
+        self.coalesced = 0
+        self._futures = {}
+
+    async def run(self, key, work):
+        """
+        Get the result of some work, sharing the result of any in-progress
+        work with the same key.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the work.
+        work : callable
+            A function that returns an awaitable for doing the work. It is only
+            called if there is no work with the same key already in progress.
+        """
+        future = self._futures.get(key)
+        if future is None:
+            future = asyncio.ensure_future(work())
+            self._futures[key] = future
+            future.add_done_callback(
+                lambda done: self._remove_future(key, done))
+        else:
+            self.coalesced += 1
+
+        # Shield the work so it isn't cancelled for everybody if one of the
+        # callers waiting for it is cancelled.
+        return await asyncio.shield(future)
+
+    def __contains__(self, key):
+        return key in self._futures
+
+    def __len__(self):
+        return len(self._futures)
+
+    def _remove_future(self, key, future):
+        if self._futures.get(key) is future:
+            del self._futures[key]
@@ -0,0 +1,234 @@
+"""
+Simple metrics for the diff server, rendered in Prometheus's text format.
+"""
+from bisect import bisect_left
+import math
+
+# Default buckets for timings, in seconds.
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                60, 120)
+
+# Default buckets for sizes, in bytes.
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216,
+                67108864)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (f'{name}="{_escape(value)}"' for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('\n', '\\n')
+                      .replace('"', '\\"'))
+
+
+class Metric:
+    """
+    Base class for metrics. A metric can have several series, each identified
+    by the values of the metric's labels.
+
+    Parameters
+    ----------
+    name : str
+    description : str
+    labels : sequence of str, optional
+        Names of the labels to identify series by.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._series = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f'{self.name} requires labels: '
+                             f'{", ".join(self.labels)}')
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        "Get the lines describing this metric in Prometheus's text format."
+        lines = [f'# HELP {self.name} {_escape(self.description)}',
+                 f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self._series.items()):
+            lines.extend(self._render_series(list(zip(self.labels, key)),
+                                             value))
+        return lines
+
+    def _render_series(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    "A value that only goes up, like the number of requests handled."
+    kind = 'counter'
+
+    def increment(self, amount=1, **labels):
+        key = self._key(labels)
+        self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    "A value that can go up or down, like the number of queued diffs."
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._series[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observed values (like durations) in buckets.
+
+    Parameters
+    ----------
+    name : str
+    description : str
+    labels : sequence of str, optional
+    buckets : sequence of float, optional
+        Upper bounds of the buckets, in increasing order. Defaults to
+        ``TIME_BUCKETS``.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            # Bucket counts, then the sum of all values.
+            series = self._series[key] = [0] * len(self.buckets) + [0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def _render_series(self, labels, series):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, series):
+            total += count
+            bucket_labels = labels + [('le', _format_value(bound))]
+            lines.append(f'{self.name}_bucket{_format_labels(bucket_labels)} '
+                         f'{total}')
+        labels = _format_labels(labels)
+        lines.append(f'{self.name}_sum{labels} {_format_value(series[-1])}')
+        lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+class DiffMetrics:
+    """
+    All the metrics for a diff server. Values that are tracked elsewhere (like
+    queue depth and cache stats) are read when the metrics are rendered.
+    """
+    def __init__(self):
+        self.fetch_seconds = Histogram(
+            'diff_fetch_seconds',
+            'Time to fetch content from upstream servers.',
+            labels=('host',))
+        self.decode_seconds = Histogram(
+            'diff_decode_seconds',
+            'Time to decode the content of both sides of a diff.')
+        self.parse_seconds = Histogram(
+            'diff_parse_seconds',
+            'Time to parse the content of both sides of a diff.')
+        self.diff_seconds = Histogram(
+            'diff_duration_seconds',
+            'Time spent running a differ (not including decoding or parsing).',
+            labels=('differ',))
+        self.serialize_seconds = Histogram(
+            'diff_serialize_seconds',
+            'Time to serialize (and compress) diff results.')
+        self.response_bytes = Histogram(
+            'diff_response_size_bytes',
+            'Size of serialized diff results.',
+            labels=('differ',), buckets=SIZE_BUCKETS)
+        self.pool_restarts = Counter(
+            'diff_pool_restarts_total',
+            'Number of times the pool of diff processes broke and was '
+            'restarted.')
+        self.pool_restarts.increment(0)
+        self.pool_recycles = Counter(
+            'diff_pool_recycles_total',
+            'Number of times the pool of diff processes was replaced because '
+            'it ran too many diffs or used too much memory.',
+            labels=('reason',))
+
+    def render(self, scheduler=None, caches=None):
+        """
+        Render all the metrics in Prometheus's text format.
+
+        Parameters
+        ----------
+        scheduler : web_monitoring.diff_server.scheduler.DiffScheduler, optional
+            Scheduler to report queue stats for.
+        caches : dict, optional
+            Caches (objects with a ``stats()`` method, like ``LruCache``) to
+            report stats for, keyed by name.
+
+        Returns
+        -------
+        str
+        """
+        metrics = [self.fetch_seconds, self.decode_seconds,
+                   self.parse_seconds, self.diff_seconds,
+                   self.serialize_seconds, self.response_bytes,
+                   self.pool_restarts, self.pool_recycles]
+
+        if scheduler is not None:
+            stats = scheduler.stats()
+            running = Gauge('diff_running', 'Number of diffs running.')
+            running.set(stats['running'])
+            concurrency = Gauge('diff_concurrency',
+                                'Maximum number of diffs that can run at once.')
+            concurrency.set(stats['concurrency'])
+            queued = Gauge('diff_queue_depth',
+                           'Number of diffs waiting for a free process.',
+                           labels=('priority',))
+            rejected = Counter('diff_rejected_total',
+                               'Number of diffs rejected because the queue '
+                               'was full.',
+                               labels=('priority',))
+            for priority, count in stats['queued'].items():
+                queued.set(count, priority=priority)
+                rejected.increment(stats['rejected'][priority],
+                                   priority=priority)
+            metrics.extend((running, concurrency, queued, rejected))
+
+        if caches:
+            hits = Counter('diff_cache_hits_total', 'Number of cache hits.',
+                           labels=('cache',))
+            misses = Counter('diff_cache_misses_total',
+                             'Number of cache misses.', labels=('cache',))
+            hit_rate = Gauge('diff_cache_hit_rate',
+                             'Portion of cache lookups that were hits.',
+                             labels=('cache',))
+            size = Gauge('diff_cache_size_bytes',
+                         'Size of values in the in-memory cache.',
+                         labels=('cache',))
+            for name, cache in caches.items():
+                stats = cache.stats()
+                hits.increment(stats['hits'], cache=name)
+                misses.increment(stats['misses'], cache=name)
+                hit_rate.set(stats['hit_rate'], cache=name)
+                size.set(stats['size'], cache=name)
+            metrics.extend((hits, misses, hit_rate, size))
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
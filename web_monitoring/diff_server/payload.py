@@ -0,0 +1,174 @@
+"""
+Slim versions of HTTP responses for sending to diff worker processes.
+
+Anything sent to a worker is pickled and copied through a pipe, which is
+expensive for large response bodies. Instead, large bodies are written to a
+"spool" file (in shared memory, if possible) that workers memory-map and read
+without copying.
+"""
+from contextlib import contextmanager
+import logging
+import mmap
+import os
+import tempfile
+from tornado.httputil import HTTPHeaders
+
+logger = logging.getLogger(__name__)
+# Bodies smaller than this (in bytes) are just sent to workers along with the
+# rest of the payload; it's not worth the overhead of a spool file.
+SPOOL_THRESHOLD = 64 * 1024
+
+
+def default_spool_directory():
+    """
+    Get the best directory for spool files. ``/dev/shm`` is memory-backed on
+    most Linux systems, so files there never touch the disk.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def _spool(body, directory):
+    "Write a body to a new spool file in ``directory`` and get its path."
+    descriptor, path = tempfile.mkstemp(prefix='wm-diff-', dir=directory)
+    try:
+        with open(descriptor, 'wb') as spool:
+            spool.write(body)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+class PayloadRequest:
+    "An HTTPRequest-like object for a payload's URL."
+    def __init__(self, url):
+        self.url = url
+
+
+class PayloadResponse:
+    """
+    An HTTPResponse-like object for a payload that has been opened in a worker
+    process. Its ``body`` may be a ``memoryview`` rather than ``bytes``, and is
+    only valid until the payload is closed.
+    """
+    def __init__(self, url, headers, body, content_hash=None):
+        self.request = PayloadRequest(url)
+        self.headers = headers
+        self.body = body
+        self.content_hash = content_hash
+        self.error = None
+
+
+class DiffPayload:
+    """
+    The parts of an HTTP response that differs need (URL, headers, and body),
+    in a form that is cheap to send to another process.
+
+    Create payloads with ``DiffPayload.from_response()``, which spools large
+    bodies to a file. The process that created a payload must call
+    ``discard()`` when it's done with it (i.e. after the diff is finished) to
+    delete that file.
+
+    Parameters
+    ----------
+    url : str
+    headers : dict
+    body : bytes, optional
+        The body of the response, if it is not spooled.
+    spool_path : str, optional
+        Path to a file containing the body of the response, if it is spooled.
+    content_hash : str, optional
+        SHA-256 hash of the body, if known. Workers use it to identify content
+        they have already worked with.
+    """
+    def __init__(self, url, headers, body=None, spool_path=None,
+                 content_hash=None):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.spool_path = spool_path
+        self.content_hash = content_hash
+
+    @classmethod
+    def from_response(cls, response, spool_directory=None, content_hash=None):
+        """
+        Create a payload from an HTTPResponse-like object. If a large body
+        can't be spooled (e.g. because the spool directory is full), it is
+        kept in the payload instead.
+
+        Parameters
+        ----------
+        response : tornado.httpclient.HTTPResponse
+        spool_directory : str, optional
+            Directory to write spool files in. If not set, uses
+            ``default_spool_directory()``.
+        content_hash : str, optional
+            SHA-256 hash of the response body, if known.
+        """
+        body = response.body
+        headers = dict(response.headers)
+        if len(body) < SPOOL_THRESHOLD:
+            return cls(response.request.url, headers, body=body,
+                       content_hash=content_hash)
+
+        try:
+            path = _spool(body, spool_directory or default_spool_directory())
+        except OSError as error:
+            # `/dev/shm` is often quite small (e.g. 64 MB in Docker), so
+            # running out of space there shouldn't fail the whole diff.
+            logger.warning(f'Could not spool response body: {error}')
+            return cls(response.request.url, headers, body=body,
+                       content_hash=content_hash)
+        return cls(response.request.url, headers, spool_path=path,
+                   content_hash=content_hash)
+
+    @contextmanager
+    def open(self):
+        """
+        Get an HTTPResponse-like object for this payload. If the body was
+        spooled, it is a ``memoryview`` of the memory-mapped spool file, which
+        is only valid inside the ``with`` block.
+
+        Examples
+        --------
+        >>> with payload.open() as response:
+        >>>     text = str(response.body, 'utf-8')
+        """
+        headers = HTTPHeaders(self.headers)
+        if self.spool_path is None:
+            yield PayloadResponse(self.url, headers, self.body,
+                                  self.content_hash)
+            return
+
+        with open(self.spool_path, 'rb') as spool:
+            size = os.fstat(spool.fileno()).st_size
+            if size == 0:
+                # Empty files can't be memory-mapped.
+                yield PayloadResponse(self.url, headers, b'',
+                                      self.content_hash)
+                return
+            mapped = mmap.mmap(spool.fileno(), size, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapped)
+        try:
+            yield PayloadResponse(self.url, headers, view, self.content_hash)
+        finally:
+            try:
+                view.release()
+                mapped.close()
+            except BufferError:
+                # Something (e.g. the traceback of an error) is still holding
+                # a slice of the body. The mapping will be closed when that is
+                # garbage-collected.
+                pass
+
+    def discard(self):
+        "Delete this payload's spool file, if it has one."
+        if self.spool_path:
+            try:
+                os.remove(self.spool_path)
+            except FileNotFoundError:
+                pass
+            self.spool_path = None
@@ -0,0 +1,152 @@
+"""
+Admission control and priority scheduling for diffs.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import heapq
+import itertools
+import math
+import time
+
+# Priority classes for diffs. Lower numbers run first.
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+PRIORITIES = {INTERACTIVE: 0, BATCH: 1}
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a diff can't be scheduled because too many others with the
+    same priority are already waiting.
+
+    Parameters
+    ----------
+    priority : str
+        Priority class of the rejected diff.
+    retry_after : int
+        Estimated number of seconds until there will be room in the queue.
+    """
+    def __init__(self, priority, retry_after):
+        self.priority = priority
+        self.retry_after = retry_after
+        super().__init__(f'Too many {priority} diffs are waiting to run. Try '
+                         f'again in {retry_after} seconds.')
+
+
+class DiffScheduler:
+    """
+    Limits how many diffs run at once and queues the rest by priority, so
+    interactive diffs never wait behind a backlog of batch diffs. Each
+    priority class has its own bounded queue; once it's full, new diffs with
+    that priority are rejected with ``QueueFullError``.
+
+    Parameters
+    ----------
+    concurrency : int
+        Maximum number of diffs to run at once. This should match the number
+        of worker processes.
+    max_queue_size : int
+        Maximum number of diffs of each priority that can wait for a slot.
+
+    Examples
+    --------
+    >>> scheduler = DiffScheduler(4, 100)
+    >>> async with scheduler.slot(BATCH):
+    >>>     await loop.run_in_executor(executor, diff, a, b)
+    """
+    def __init__(self, concurrency, max_queue_size):
+        self.concurrency = concurrency
+        self.max_queue_size = max_queue_size
+        self.running = 0
+        self.rejected = dict.fromkeys(PRIORITIES, 0)
+        self.completed = 0
+        # Running average of how long diffs take, in seconds. Used to
+        # estimate when a rejected client should retry.
+        self.average_duration = 1.0
+        self._queued = dict.fromkeys(PRIORITIES, 0)
+        self._waiting = []
+        self._sequence = itertools.count()
+
+    def check(self, priority):
+        """
+        Raise ``QueueFullError`` if a diff with the given priority would be
+        rejected right now. This is useful for rejecting requests before doing
+        any expensive work to prepare for a diff.
+        """
+        if self.running < self.concurrency and not self._waiting:
+            return
+        if self._queued[priority] >= self.max_queue_size:
+            self.rejected[priority] += 1
+            raise QueueFullError(priority, self.retry_after(priority))
+
+    def retry_after(self, priority):
+        """
+        Estimate how many seconds it will be until a diff with the given
+        priority could start.
+        """
+        ahead = sum(count for name, count in self._queued.items()
+                    if PRIORITIES[name] <= PRIORITIES[priority])
+        return max(1, math.ceil(
+            self.average_duration * (ahead + 1) / self.concurrency))
+
+    @asynccontextmanager
+    async def slot(self, priority=INTERACTIVE):
+        """
+        Wait for a free slot to run a diff in, and hold it for the duration of
+        the ``async with`` block. Raises ``QueueFullError`` if the queue for
+        this priority is full.
+        """
+        await self._acquire(priority)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            self.completed += 1
+            self.average_duration += 0.1 * (duration - self.average_duration)
+            self._release()
+
+    def stats(self):
+        "Get a dict describing the current state of the scheduler."
+        return {
+            'running': self.running,
+            'concurrency': self.concurrency,
+            'queued': dict(self._queued),
+            'max_queue_size': self.max_queue_size,
+            'rejected': dict(self.rejected),
+            'completed': self.completed,
+            'average_duration': self.average_duration,
+        }
+
+    async def _acquire(self, priority):
+        if self.running < self.concurrency and not self._waiting:
+            self.running += 1
+            return
+
+        self.check(priority)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (PRIORITIES[priority],
+                                       next(self._sequence),
+                                       priority,
+                                       future))
+        self._queued[priority] += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                # Still in the queue; `_release()` will skip it.
+                self._queued[priority] -= 1
+            else:
+                # We were handed a slot just as we were cancelled.
+                self._release()
+            raise
+
+    def _release(self):
+        # Hand the slot straight to the next waiting diff, if there is one.
+        while self._waiting:
+            _, _, priority, future = heapq.heappop(self._waiting)
+            if not future.done():
+                self._queued[priority] -= 1
+                future.set_result(None)
+                return
+        self.running -= 1
@@ -1,26 +1,48 @@
 import asyncio
+from collections import OrderedDict
 import codecs
 import concurrent.futures
 from docopt import docopt
-import hashlib
 import inspect
 import functools
+import gzip
+import importlib
+import json
 import logging
 import mimetypes
+import multiprocessing
 import os
 import re
 import cchardet
+import html5_parser
 import sentry_sdk
 import signal
 import sys
+import time
+from tornado.escape import json_encode
 import tornado.httpclient
+from tornado.httputil import HTTPHeaders, responses
+import tornado.iostream
 import tornado.ioloop
 import tornado.web
 import traceback
+from urllib.parse import urlparse
 import web_monitoring
 from ..diff import differs, html_diff_render, links_diff
-from ..diff.diff_errors import UndiffableContentError, UndecodableContentError
+from ..diff.parsing import parse_html_document
+from ..diff.sequence_diff import parallel_windows
+from ..diff.timing import collect_timings, timed
+from ..diff.diff_errors import (DiffBudgetExceededError,
+                                UndiffableContentError,
+                                UndecodableContentError)
 from ..utils import shutdown_executor_in_loop, Signal
+from .budget import call_with_budget, current_memory
+from .cache import LruCache, SingleFlight
+from .metrics import DiffMetrics
+from .payload import DiffPayload, default_spool_directory
+from .upstream import ResponseTooLargeError, StreamingFetch, UpstreamClient
+from .scheduler import (BATCH, INTERACTIVE, PRIORITIES, DiffScheduler,
+                        QueueFullError)
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +56,14 @@ sentry_sdk.integrations.logging.ignore_logger('tornado.access')
 
 DIFFER_PARALLELISM = int(os.environ.get('DIFFER_PARALLELISM', 10))
 
+# Limits on the CPU time (in seconds) and memory (in bytes the worker process's
+# RSS can grow by) a single diff can use before it is stopped. 0 means no
+# limit. If a diff goes over its budget, the server responds with an error
+# unless `DIFFER_BUDGET_FALLBACK` names a (cheaper) differ to use instead.
+DIFFER_CPU_TIME_LIMIT = float(os.environ.get('DIFFER_CPU_TIME_LIMIT', 0))
+DIFFER_MEMORY_LIMIT = int(os.environ.get('DIFFER_MEMORY_LIMIT', 0))
+DIFFER_BUDGET_FALLBACK = os.environ.get('DIFFER_BUDGET_FALLBACK', '').strip()
+
 # Map tokens in the REST API to functions in modules.
 # The modules do not have to be part of the web_monitoring package.
 DIFF_ROUTES = {
@@ -72,6 +102,18 @@ XML_PROLOG_PATTERN = re.compile(
     b'<?xml\\s[^>]*encoding=[\'"]([^\'"]+)[\'"].*\?>',
     re.IGNORECASE)
 
+# Matches either of the above, so we can look for both in one pass. (The
+# prolog part is non-greedy so it can't swallow a <meta> tag after it.)
+ENCODING_DECLARATION_PATTERN = re.compile(
+    META_TAG_PATTERN.pattern + b'|'
+    + XML_PROLOG_PATTERN.pattern.replace(b'.*\\?>', b'.*?\\?>'),
+    re.IGNORECASE)
+
+# How many decoded bodies each diff process keeps around for reuse. Like
+# parsed documents, we only need enough for the diffs a process is working on
+# (e.g. several differs or a series of diffs involving the same version).
+DECODE_CACHE_SIZE = 4
+
 MAX_BODY_SIZE = None
 try:
     MAX_BODY_SIZE = int(os.environ.get('DIFFER_MAX_BODY_SIZE', 0))
@@ -82,11 +124,86 @@ except ValueError:
     print(f'DIFFER_MAX_BODY_SIZE must be an integer', file=sys.stderr)
     sys.exit(1)
 
-# TODO: we'd like to support CurlAsyncHTTPClient, but we need to figure out how
-# to enforce something like max_body_size with it.
-tornado.httpclient.AsyncHTTPClient.configure(None,
-                                             max_body_size=MAX_BODY_SIZE)
-client = tornado.httpclient.AsyncHTTPClient()
+# Fetched content with a known hash is cached in memory (and optionally on
+# disk) so repeated requests for the same versions don't need to fetch them
+# again. Content without a hash may change, so it isn't cached. Sizes are in
+# bytes. Set `DIFFER_FETCH_CACHE_SIZE` to 0 to disable the in-memory cache.
+FETCH_CACHE_SIZE = int(os.environ.get('DIFFER_FETCH_CACHE_SIZE',
+                                      100 * 1024 * 1024))
+FETCH_CACHE_DIRECTORY = os.environ.get('DIFFER_FETCH_CACHE_DIRECTORY')
+FETCH_CACHE_DISK_SIZE = int(os.environ.get('DIFFER_FETCH_CACHE_DISK_SIZE',
+                                           1024 * 1024 * 1024))
+
+# The results of diffs are also cached, so the same diff with the same
+# parameters doesn't need to be re-computed. Results are cached as serialized
+# JSON, optionally gzip-compressed (which saves a lot of space for diffs that
+# are HTML documents).
+RESULT_CACHE_SIZE = int(os.environ.get('DIFFER_RESULT_CACHE_SIZE',
+                                       100 * 1024 * 1024))
+RESULT_CACHE_DIRECTORY = os.environ.get('DIFFER_RESULT_CACHE_DIRECTORY')
+RESULT_CACHE_DISK_SIZE = int(os.environ.get('DIFFER_RESULT_CACHE_DISK_SIZE',
+                                            1024 * 1024 * 1024))
+RESULT_CACHE_COMPRESSION = os.environ.get(
+    'DIFFER_RESULT_CACHE_COMPRESSION', 'true').strip().lower() == 'true'
+
+# Worker processes can slowly bloat as they diff lots of documents. The pool of
+# workers is replaced with a fresh one after each worker has run (on average)
+# `DIFFER_MAX_TASKS_PER_CHILD` diffs, or as soon as any worker's RSS is more
+# than `DIFFER_MAX_WORKER_MEMORY` bytes. 0 means no limit.
+DIFFER_MAX_TASKS_PER_CHILD = int(os.environ.get('DIFFER_MAX_TASKS_PER_CHILD',
+                                                0))
+DIFFER_MAX_WORKER_MEMORY = int(os.environ.get('DIFFER_MAX_WORKER_MEMORY', 0))
+
+# Each worker can match large windows of changes on a huge page in parallel
+# using a pool of this many extra processes, which the worker starts the first
+# time it needs them. 0 (the default) means windows are matched serially. The
+# results are the same either way. Each window gets its own CPU time and
+# memory budget.
+DIFFER_WINDOW_PARALLELISM = int(os.environ.get('DIFFER_WINDOW_PARALLELISM',
+                                               0))
+
+# Diffs wait in a queue for a free worker. There is a separate queue for each
+# priority ("interactive" or "batch"), and this sets the maximum size of each.
+# When a queue is full, new requests with that priority get a 503 response.
+DIFFER_QUEUE_SIZE = int(os.environ.get('DIFFER_QUEUE_SIZE', 100))
+
+# How many diffs from one request to the `/bulk` endpoint can be fetched and
+# run at the same time. (Diffs are still limited by `DIFFER_PARALLELISM`.)
+BULK_CONCURRENCY = int(os.environ.get('DIFFER_BULK_CONCURRENCY',
+                                      DIFFER_PARALLELISM))
+
+# Large response bodies are sent to diff worker processes via memory-mapped
+# files in this directory rather than through a pipe. Defaults to /dev/shm if
+# available, so the files are only ever in memory.
+SPOOL_DIRECTORY = (os.environ.get('DIFFER_SPOOL_DIRECTORY')
+                   or default_spool_directory())
+
+# Query parameters that only affect how content is fetched, scheduled, or
+# reported, and not the results of a diff on that content.
+FETCH_ONLY_PARAMS = ('a', 'b', 'a_hash', 'b_hash', 'pass_headers', 'priority',
+                     'timing')
+
+GZIP_MAGIC_NUMBER = b'\x1f\x8b'
+
+# Upstream content is fetched with either Tornado's "simple" HTTP client or
+# its "curl" client (which requires pycurl, but can keep connections open and
+# reuse them, which matters since most content comes from a few hosts).
+HTTP_CLIENT = os.environ.get('DIFFER_HTTP_CLIENT', 'simple').strip().lower()
+# Maximum number of concurrent upstream requests, overall and to one host.
+UPSTREAM_MAX_CLIENTS = int(os.environ.get('DIFFER_UPSTREAM_MAX_CLIENTS', 10))
+UPSTREAM_MAX_PER_HOST = int(os.environ.get('DIFFER_UPSTREAM_MAX_PER_HOST', 0))
+# How long to cache DNS lookups for upstream hosts, in seconds.
+DNS_CACHE_TTL = float(os.environ.get('DIFFER_DNS_CACHE_TTL', 300))
+
+try:
+    client = UpstreamClient(HTTP_CLIENT,
+                            max_clients=UPSTREAM_MAX_CLIENTS,
+                            max_per_host=UPSTREAM_MAX_PER_HOST,
+                            max_body_size=MAX_BODY_SIZE,
+                            dns_cache_ttl=DNS_CACHE_TTL)
+except ValueError as error:
+    print(f'DIFFER_HTTP_CLIENT is not valid: {error}', file=sys.stderr)
+    sys.exit(1)
 
 
 class PublicError(tornado.web.HTTPError):
@@ -110,10 +227,13 @@ class PublicError(tornado.web.HTTPError):
         interpolation.
     extra : dict, optional
         Dict of additional keys and values to include in the error response.
+    headers : dict, optional
+        Dict of additional HTTP headers to include in the error response.
     """
     def __init__(self, status_code=500, public_message=None, log_message=None,
-                 extra=None, **kwargs):
+                 extra=None, headers=None, **kwargs):
         self.extra = extra or {}
+        self.headers = headers or {}
 
         if public_message is not None:
             if 'error' not in self.extra:
@@ -161,6 +281,105 @@ class MockResponse:
         return headers
 
 
+class CachedResponse:
+    "An HTTPResponse-like object for content held in the fetch cache."
+    content_hash = None
+
+    def __init__(self, url, body, headers, content_hash=None):
+        self.request = MockRequest(url)
+        self.body = body
+        self.headers = headers
+        self.error = None
+        self.content_hash = content_hash
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.request.url, response.body,
+                   HTTPHeaders(response.headers))
+
+    @classmethod
+    def from_stream(cls, response, stream):
+        """
+        Create a response from a fetch that was received with a
+        ``StreamingFetch`` (so ``response.body`` is empty).
+        """
+        return cls(response.request.url, stream.body,
+                   HTTPHeaders(response.headers), stream.content_hash)
+
+    def cache_size(self):
+        "Approximate size of this response for cache accounting purposes."
+        return len(self.body) + sum(len(key) + len(value) for key, value
+                                    in self.headers.items())
+
+    def to_bytes(self):
+        """
+        Serialize this response for the disk tier of the fetch cache: a line
+        of JSON with the URL, headers, and hash, followed by the raw body.
+        """
+        header = json.dumps({'url': self.request.url,
+                             'headers': list(self.headers.get_all()),
+                             'content_hash': self.content_hash})
+        return header.encode('utf-8') + b'\n' + self.body
+
+    @classmethod
+    def from_bytes(cls, data):
+        "Load a response that was serialized with ``to_bytes()``."
+        header, body = data.split(b'\n', 1)
+        header = json.loads(header)
+        headers = HTTPHeaders()
+        for name, value in header['headers']:
+            headers.add(name, value)
+        return cls(header['url'], body, headers, header['content_hash'])
+
+
+def response_hash(response):
+    "Get the SHA-256 hash of a response's body, as a hex string."
+    return (getattr(response, 'content_hash', None)
+            or web_monitoring.utils.hash_content(response.body))
+
+
+def requires_html(func, query_params):
+    """
+    Determine whether a differ will reject content that isn't HTML, so we can
+    avoid fetching content with a non-HTML ``Content-Type`` header for it.
+    """
+    if 'content_type_options' not in inspect.signature(func).parameters:
+        return False
+    options = query_params.get('content_type_options', 'normal')
+    return options in ('normal', 'nosniff')
+
+
+def fetch_cache_key(url, expected_hash=None, headers=None):
+    """
+    Get the key that identifies fetched content. If the content's hash is
+    known, we use that, since it identifies the content regardless of where
+    it came from. Otherwise, we use the URL plus any headers that were sent
+    with the request, since they may affect the response. (Content without a
+    known hash is not cached, but concurrent fetches for it are shared.)
+    """
+    if expected_hash:
+        return f'sha256:{expected_hash}'
+
+    key = f'url:{url}'
+    if headers:
+        header_text = repr(sorted(headers.items())).encode('utf-8')
+        key += f'|{web_monitoring.utils.hash_content(header_text)}'
+    return key
+
+
+def result_cache_key(differ, a_hash, b_hash, query_params):
+    """
+    Get the key to cache the results of a diff under. Results are identified
+    by the differ, the content being diffed, the parameters for the differ,
+    and the version of this package (since new versions may produce
+    different results).
+    """
+    params = sorted((key, value) for key, value in query_params.items()
+                    if key not in FETCH_ONLY_PARAMS)
+    return (f'{differ}|{a_hash}|{b_hash}|{json_encode(params)}|'
+            f'{web_monitoring.__version__}')
+
+
 DEBUG_MODE = os.environ.get('DIFFING_SERVER_DEBUG', 'False').strip().lower() == 'true'
 
 VALIDATE_TARGET_CERTIFICATES = \
@@ -173,10 +392,93 @@ access_control_allow_origin_header = \
 class DiffServer(tornado.web.Application):
     terminating = False
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Number of diffs the current executor has run.
+        self.diff_executor_tasks = 0
+        # Shutdowns of executors that were replaced but may still be finishing
+        # their last diffs.
+        self.retiring_executors = set()
+
     def listen(self, port, address='', **kwargs):
         self.server = super().listen(port, address, **kwargs)
         return self.server
 
+    def get_diff_executor(self, reset=False):
+        """
+        Get the process pool for running diffs, creating it if necessary. If
+        ``reset`` is true, the current pool is assumed to be broken and is
+        replaced.
+        """
+        executor = self.settings.get('diff_executor')
+        if reset or not executor:
+            if executor:
+                self.settings['metrics'].pool_restarts.increment()
+                try:
+                    # NOTE: we don't need await this; we just want to make sure
+                    # the old executor gets cleaned up.
+                    shutdown_executor_in_loop(executor)
+                except Exception:
+                    pass
+            executor = self.start_diff_executor()
+
+        return executor
+
+    def start_diff_executor(self):
+        """
+        Create a new process pool for running diffs (replacing any current
+        pool) and start all its worker processes, so the first diffs don't
+        have to wait for them.
+        """
+        executor = concurrent.futures.ProcessPoolExecutor(
+            DIFFER_PARALLELISM, initializer=_initialize_diff_worker)
+        # Workers are only started when there's work for them, so give each
+        # something to do.
+        for _ in range(DIFFER_PARALLELISM):
+            executor.submit(os.getpid)
+        self.settings['diff_executor'] = executor
+        self.diff_executor_tasks = 0
+        return executor
+
+    def diff_finished(self, executor, worker_memory):
+        """
+        Record that a diff finished in an executor, and replace the executor
+        with a fresh one if its workers have run too many diffs or are using
+        too much memory.
+
+        Parameters
+        ----------
+        executor : concurrent.futures.ProcessPoolExecutor
+            The executor the diff ran in.
+        worker_memory : int
+            RSS of the worker process that ran the diff, in bytes.
+        """
+        if executor is not self.settings.get('diff_executor'):
+            return
+
+        self.diff_executor_tasks += 1
+        if (DIFFER_MAX_WORKER_MEMORY
+                and worker_memory > DIFFER_MAX_WORKER_MEMORY):
+            self.retire_diff_executor('memory')
+        elif (DIFFER_MAX_TASKS_PER_CHILD
+                and self.diff_executor_tasks >= (DIFFER_MAX_TASKS_PER_CHILD
+                                                 * DIFFER_PARALLELISM)):
+            self.retire_diff_executor('tasks')
+
+    def retire_diff_executor(self, reason):
+        """
+        Replace the current diff executor with a new one. Any diffs already
+        running in the old executor are allowed to finish.
+        """
+        executor = self.settings.get('diff_executor')
+        logger.info(f'Replacing diff process pool ({reason} limit reached)')
+        self.settings['metrics'].pool_recycles.increment(reason=reason)
+        self.start_diff_executor()
+        if executor:
+            shutdown = shutdown_executor_in_loop(executor)
+            self.retiring_executors.add(shutdown)
+            shutdown.add_done_callback(self.retiring_executors.discard)
+
     async def shutdown(self, immediate=False):
         """
         Shut down the server as gracefully as possible. If `immediate` is True,
@@ -190,6 +492,8 @@ class DiffServer(tornado.web.Application):
 
     async def shutdown_differs(self, immediate=False):
         """Stop all child processes used for running diffs."""
+        if self.retiring_executors:
+            await asyncio.gather(*self.retiring_executors)
         differs = self.settings.get('diff_executor')
         if differs:
             if immediate:
@@ -222,6 +526,9 @@ class DiffServer(tornado.web.Application):
 
 
 class BaseHandler(tornado.web.RequestHandler):
+    # Methods and request headers to allow in cross-origin requests.
+    cors_allowed_methods = 'GET, OPTIONS'
+    cors_allowed_headers = 'x-requested-with'
 
     def set_default_headers(self):
         if access_control_allow_origin_header is not None:
@@ -235,8 +542,10 @@ class BaseHandler(tornado.web.RequestHandler):
                 if allowed and (req_origin in allowed or '*' in allowed):
                     self.set_header('Access-Control-Allow-Origin', req_origin)
             self.set_header('Access-Control-Allow-Credentials', 'true')
-            self.set_header('Access-Control-Allow-Headers', 'x-requested-with')
-            self.set_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+            self.set_header('Access-Control-Allow-Headers',
+                            self.cors_allowed_headers)
+            self.set_header('Access-Control-Allow-Methods',
+                            self.cors_allowed_methods)
 
     def options(self):
         # no body
@@ -247,6 +556,41 @@ class BaseHandler(tornado.web.RequestHandler):
 class DiffHandler(BaseHandler):
     # subclass must define `differs` attribute
 
+    # Priority to run diffs at if the request doesn't specify one.
+    default_priority = INTERACTIVE
+
+    def prepare(self):
+        # Requests can set their priority with the `priority` query param or
+        # the `X-Diff-Priority` header.
+        priority = (self.get_query_argument('priority', None)
+                    or self.request.headers.get('X-Diff-Priority')
+                    or self.default_priority)
+        if priority not in PRIORITIES:
+            raise PublicError(400, f'Unknown priority: `{priority}`. '
+                                   f'Priority must be one of: '
+                                   f'{", ".join(PRIORITIES)}.')
+        self.priority = priority
+        # Time spent on each stage of the request (for the `Server-Timing`
+        # header) and other stats about it (for the `X-Diff-Stats` header).
+        self.timings = {}
+        self.stats = {}
+
+    def record_time(self, stage, seconds):
+        """
+        Record time spent on a stage of handling this request. Times for the
+        same stage are added together.
+        """
+        self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    def check_queue(self):
+        """
+        Raise a 503 error if there's no room to queue a diff for this request.
+        """
+        try:
+            self.settings['diff_scheduler'].check(self.priority)
+        except QueueFullError as error:
+            raise _queue_full_error(error)
+
     # If query parameters repeat, take last one.
     # Decode clean query parameters into unicode strings and cache the results.
     @functools.lru_cache()
@@ -288,6 +632,39 @@ class DiffHandler(BaseHandler):
                                    f'the `/` endpoint.')
 
         query_params = self.decode_query_params()
+        serialized = await self.fetch_and_diff(
+            differ, query_params,
+            lambda a, b, result_key: self.diff_and_serialize(
+                func, differ, a, b, query_params, result_key),
+            require_html=requires_html(func, query_params))
+        self.write_serialized_result(serialized)
+
+    async def fetch_and_diff(self, differ, query_params, diff_and_serialize,
+                             require_html=False):
+        """
+        Fetch the content to diff (unless the result is already cached), then
+        diff it. Returns the serialized result.
+
+        Parameters
+        ----------
+        differ : str
+            Name to identify results with in the result cache.
+        query_params : dict
+            Query parameters for the request. The `a`, `b`, `a_hash`, and
+            `b_hash` parameters will be removed.
+        diff_and_serialize : callable
+            Coroutine function that takes the content to diff (``a`` and
+            ``b``) and a key to cache the result under, and returns the
+            serialized result.
+        require_html : bool, optional
+            Whether the differ only works on HTML. If so, content that is
+            labeled as something else is rejected before it is downloaded.
+
+        Returns
+        -------
+        bytes
+            JSON result, possibly gzipped.
+        """
         # The logic here is a bit tortured in order to allow one or both URLs
         # to be local files, while still optimizing the common case of two
         # remote URLs that we want to fetch in parallel.
@@ -299,24 +676,171 @@ class DiffHandler(BaseHandler):
                               'as the value for both `a` and `b` query '
                               'parameters.')
 
-        # TODO: Add caching of fetched URIs.
-        requests = [self.fetch_diffable_content(url,
-                                                query_params.pop(f'{param}_hash', None),
-                                                query_params)
-                    for param, url in urls.items()]
-        content = await asyncio.gather(*requests)
-
+        hashes = {param: query_params.pop(f'{param}_hash', None)
+                  for param in ('a', 'b')}
+
+        # If we know the hashes of the content, we might be able to skip
+        # fetching it altogether.
+        result_key = None
+        if hashes['a'] and hashes['b']:
+            result_key = result_cache_key(differ, hashes['a'], hashes['b'],
+                                          query_params)
+            serialized = await self.get_cached_result(result_key)
+            if serialized is not None:
+                self.stats['cache'] = 'hit'
+                return serialized
+
+        # Don't bother fetching anything if we won't be able to diff it.
+        self.check_queue()
+
+        async def timed_fetch(param, url):
+            start = time.perf_counter()
+            try:
+                return await self.fetch_diffable_content(url, hashes[param],
+                                                         query_params,
+                                                         require_html)
+            except UndiffableContentError:
+                # Report non-HTML content the same way the differs would.
+                raise UndiffableContentError(f'`{param}` is not an HTML '
+                                             f'document')
+            finally:
+                self.record_time(f'fetch_{param}',
+                                 time.perf_counter() - start)
+
+        content = await asyncio.gather(*(timed_fetch(param, url)
+                                         for param, url in urls.items()))
+        self.stats['a_bytes'] = len(content[0].body)
+        self.stats['b_bytes'] = len(content[1].body)
+
+        if not result_key:
+            result_key = result_cache_key(
+                differ,
+                response_hash(content[0]),
+                response_hash(content[1]),
+                query_params)
+            serialized = await self.get_cached_result(result_key)
+            if serialized is not None:
+                self.stats['cache'] = 'hit'
+                return serialized
+
+        self.stats['cache'] = 'miss'
+
+        # Concurrent requests for the same diff all share one result.
+        return await self.settings['in_flight_diffs'].run(
+            result_key,
+            lambda: diff_and_serialize(content[0], content[1], result_key))
+
+    async def diff_and_serialize(self, func, differ, a, b, query_params,
+                                 result_key):
+        """
+        Diff two pieces of content and serialize the result as JSON bytes
+        (gzipped if ``RESULT_CACHE_COMPRESSION`` is on), caching the result.
+        """
         # Pass the bytes and any remaining args to the diffing function.
-        res = await self.diff(func, content[0], content[1], query_params)
+        try:
+            res, timings = await self.diff(func, a, b, query_params)
+        except DiffBudgetExceededError as error:
+            fallback = DIFFER_BUDGET_FALLBACK
+            fallback_func = self.differs.get(fallback)
+            if not fallback_func or fallback == differ:
+                raise
+            logger.warning(f'{differ} diff exceeded its budget; falling '
+                           f'back to {fallback}: {error}')
+            res, timings = await self.diff(fallback_func, a, b, query_params)
+            res['type'] = fallback
+            res['degraded'] = {'requested_type': differ,
+                               'reason': str(error),
+                               'resource': error.resource,
+                               'limit': error.limit}
+            differ = fallback
         res['version'] = web_monitoring.__version__
         # Echo the client's request unless the differ func has specified
         # somethine else.
         res.setdefault('type', differ)
-        self.write(res)
+        self.settings['metrics'].diff_seconds.observe(timings['diff'],
+                                                      differ=differ)
+        # A degraded result depends on the budget settings, which aren't part
+        # of the cache key, so don't cache it.
+        return await self.serialize_and_cache(res, result_key, differ,
+                                              cache='degraded' not in res)
+
+    async def serialize_and_cache(self, result, result_key, differ,
+                                  cache=True):
+        """
+        Serialize a diff result as JSON bytes (gzipped if
+        ``RESULT_CACHE_COMPRESSION`` is on) and cache it (unless ``cache`` is
+        false). The serialized bytes are stored in the cache's disk tier
+        as-is.
+        """
+        metrics = self.settings['metrics']
+        start = time.perf_counter()
+        serialized = json_encode(result).encode('utf-8')
+        metrics.response_bytes.observe(len(serialized), differ=differ)
+        if RESULT_CACHE_COMPRESSION:
+            serialized = gzip.compress(serialized, compresslevel=6)
+        duration = time.perf_counter() - start
+        metrics.serialize_seconds.observe(duration)
+        self.record_time('serialize', duration)
+        result_cache = self.settings.get('result_cache')
+        if cache and result_cache is not None:
+            await result_cache.set_async(result_key, serialized)
+        return serialized
+
+    async def get_cached_result(self, key):
+        """
+        Get the cached, serialized result of a diff, or `None` if there is no
+        cached result for the key.
+        """
+        cache = self.settings.get('result_cache')
+        if cache is not None:
+            return await cache.get_async(key)
 
-    async def fetch_diffable_content(self, url, expected_hash, query_params):
+    def write_serialized_result(self, serialized):
         """
-        Fetch and validate a content to diff from a given URL.
+        Write an already serialized and (optionally) gzipped diff result to the
+        response, along with headers describing how long each stage of the
+        diff took (``Server-Timing``) and other stats (``X-Diff-Stats``).
+
+        If the ``timing`` query parameter is ``true``, the stage timings (in
+        milliseconds) are also added to the result as a ``timing`` object.
+        """
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        timings = {stage: round(seconds * 1000, 3)
+                   for stage, seconds in self.timings.items()}
+        if timings:
+            self.set_header('Server-Timing', ', '.join(
+                f'{stage};dur={duration}'
+                for stage, duration in timings.items()))
+
+        if self.get_query_argument('timing', '').lower() == 'true':
+            if serialized[:2] == GZIP_MAGIC_NUMBER:
+                serialized = gzip.decompress(serialized)
+            # Splice the timings into the already serialized JSON object.
+            serialized = (serialized[:serialized.rindex(b'}')]
+                          + b', "timing": '
+                          + json_encode(timings).encode('utf-8')
+                          + b'}')
+
+        self.stats['result_bytes'] = len(serialized)
+        self.set_header('X-Diff-Stats', ', '.join(
+            f'{name}={value}' for name, value in self.stats.items()))
+
+        if serialized[:2] == GZIP_MAGIC_NUMBER:
+            # If the client accepts gzip, we can skip decompressing and then
+            # re-compressing the result. (Tornado won't compress responses
+            # that already have a `Content-Encoding`.)
+            if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+                self.set_header('Content-Encoding', 'gzip')
+            else:
+                serialized = gzip.decompress(serialized)
+        self.write(serialized)
+
+    async def fetch_diffable_content(self, url, expected_hash, query_params,
+                                     require_html=False):
+        """
+        Fetch and validate a content to diff from a given URL. If
+        ``require_html`` is true, remote content that isn't labeled as HTML is
+        rejected with an ``UndiffableContentError``.
         """
         response = None
 
@@ -343,98 +867,216 @@ class DiffHandler(BaseHandler):
                     if header_value:
                         headers[header_key] = header_value
 
+            # Concurrent requests for the same content all share one fetch.
+            # (Fetches that might be stopped early for not being HTML can't
+            # be shared with ones that won't, though.)
+            fetch_key = fetch_cache_key(url, expected_hash, headers)
+            if require_html:
+                fetch_key += '|html'
+            return await self.settings['in_flight_fetches'].run(
+                fetch_key,
+                lambda: self.fetch_remote_content(url, expected_hash, headers,
+                                                  require_html))
+
+        if expected_hash:
+            self.validate_content_hash(url, response, expected_hash)
+
+        return response
+
+    async def fetch_remote_content(self, url, expected_hash, headers,
+                                   require_html=False):
+        """
+        Fetch, validate, and cache content from a remote URL, using already
+        cached content if available. Only content with an expected hash is
+        cached, since content at a URL can change.
+        """
+        cache = None
+        if expected_hash:
+            cache = self.settings.get('fetch_cache')
+        cache_key = fetch_cache_key(url, expected_hash, headers)
+        if cache is not None:
+            cached = await cache.get_async(cache_key)
+            if cached is not None:
+                # Cached content was already validated.
+                return cached
+
+        start = time.perf_counter()
+        try:
+            response = await self.fetch_upstream(url, headers, require_html)
+        finally:
+            self.settings['metrics'].fetch_seconds.observe(
+                time.perf_counter() - start, host=urlparse(url).hostname or '')
+        if expected_hash:
+            self.validate_content_hash(url, response, expected_hash)
+
+        if cache is not None:
+            await cache.set_async(cache_key, response)
+
+        return response
+
+    def validate_content_hash(self, url, response, expected_hash):
+        actual_hash = response_hash(response)
+        if actual_hash != expected_hash:
+            raise PublicError(502,
+                              (f'Fetched content at "{url}" does not '
+                               f'match hash "{expected_hash}".'),
+                              log_message='Could not fetch upstream content',
+                              extra={'type': 'HASH_MISMATCH',
+                                     'url': url,
+                                     'expected_hash': expected_hash,
+                                     'actual_hash': actual_hash})
+
+    async def fetch_upstream(self, url, headers, require_html=False):
+        """
+        Fetch content from a remote URL, translating any errors into errors
+        that are appropriate to send back to the client. The response is
+        streamed, so it can be abandoned as soon as it is clear that it's too
+        big or (if ``require_html`` is true) not HTML.
+        """
+        stream = StreamingFetch(url, MAX_BODY_SIZE, require_html)
+        try:
             try:
-                response = await client.fetch(url, headers=headers,
-                                              validate_cert=VALIDATE_TARGET_CERTIFICATES)
-            except ValueError as error:
-                raise PublicError(400, str(error))
-            except OSError as error:
-                raise PublicError(502,
-                                  f'Could not fetch "{url}": {error}',
-                                  'Could not fetch upstream content',
-                                  extra={'url': url, 'cause': str(error)})
-            except tornado.simple_httpclient.HTTPTimeoutError:
-                raise PublicError(504,
-                                  f'Timed out while fetching "{url}"',
-                                  'Could not fetch upstream content',
-                                  extra={'url': url})
-            except tornado.simple_httpclient.HTTPStreamClosedError:
-                # Unfortunately we get pretty ambiguous info if the connection
-                # was closed because we exceeded the max size. :(
-                message = f'The connection was closed while fetching "{url}"'
-                if client.max_body_size:
-                    message += (f' -- this may have been caused by a large '
-                                f'response (the maximum diffable response is '
-                                f'{client.max_body_size} bytes)')
-                raise PublicError(502,
-                                  message,
-                                  'Connection closed while fetching upstream',
-                                  extra={'url': url,
-                                         'max_size': client.max_body_size})
-            except tornado.httpclient.HTTPError as error:
+                response = await client.fetch(
+                    url,
+                    headers=headers,
+                    header_callback=stream.header_callback,
+                    streaming_callback=stream.streaming_callback,
+                    validate_cert=VALIDATE_TARGET_CERTIFICATES)
+            except Exception as error:
+                # If we stopped the fetch, the client only knows that the
+                # connection was closed, so raise the actual reason instead.
+                if stream.error:
+                    raise stream.error from None
                 # If the response is actually coming from a web archive,
                 # allow error codes. The Memento-Datetime header indicates
                 # the response is an archived one, and not an actual failure
                 # to respond with the desired content.
-                if error.response is not None and \
-                        error.response.headers.get('Memento-Datetime') is not None:
-                    response = error.response
-                else:
-                    code = error.response and error.response.code
-                    raise PublicError(502,
-                                      (f'Received a {code or "?"} '
-                                       f'status while fetching "{url}": '
-                                       f'{error}'),
-                                      log_message='Could not fetch upstream content',
-                                      extra={'type': 'UPSTREAM_ERROR',
-                                             'url': url,
-                                             'upstream_code': code})
-
-        if response and expected_hash:
-            actual_hash = hashlib.sha256(response.body).hexdigest()
-            if actual_hash != expected_hash:
-                raise PublicError(502,
-                                  (f'Fetched content at "{url}" does not '
-                                   f'match hash "{expected_hash}".'),
-                                  log_message='Could not fetch upstream content',
-                                  extra={'type': 'HASH_MISMATCH',
-                                         'url': url,
-                                         'expected_hash': expected_hash,
-                                         'actual_hash': actual_hash})
-
-        return response
-
-    async def diff(self, func, a, b, params, tries=2):
+                response = getattr(error, 'response', None)
+                if (response is None
+                        or response.headers.get('Memento-Datetime') is None):
+                    raise
+            stream.finish(response)
+            return CachedResponse.from_stream(response, stream)
+        except UndiffableContentError:
+            raise
+        except ResponseTooLargeError as error:
+            raise PublicError(502,
+                              str(error),
+                              'Upstream response too large',
+                              extra={'type': 'RESPONSE_TOO_LARGE',
+                                     'url': url,
+                                     'max_size': error.max_size})
+        except ValueError as error:
+            raise PublicError(400, str(error))
+        except OSError as error:
+            raise PublicError(502,
+                              f'Could not fetch "{url}": {error}',
+                              'Could not fetch upstream content',
+                              extra={'url': url, 'cause': str(error)})
+        except tornado.simple_httpclient.HTTPTimeoutError:
+            raise PublicError(504,
+                              f'Timed out while fetching "{url}"',
+                              'Could not fetch upstream content',
+                              extra={'url': url})
+        except tornado.simple_httpclient.HTTPStreamClosedError:
+            # Unfortunately we get pretty ambiguous info if the connection
+            # was closed because we exceeded the max size. :(
+            message = f'The connection was closed while fetching "{url}"'
+            if client.max_body_size:
+                message += (f' -- this may have been caused by a large '
+                            f'response (the maximum diffable response is '
+                            f'{client.max_body_size} bytes)')
+            raise PublicError(502,
+                              message,
+                              'Connection closed while fetching upstream',
+                              extra={'url': url,
+                                     'max_size': client.max_body_size})
+        except tornado.httpclient.HTTPError as error:
+            code = error.response and error.response.code
+            raise PublicError(502,
+                              (f'Received a {code or "?"} '
+                               f'status while fetching "{url}": '
+                               f'{error}'),
+                              log_message='Could not fetch upstream content',
+                              extra={'type': 'UPSTREAM_ERROR',
+                                     'url': url,
+                                     'upstream_code': code})
+
+    async def diff(self, func, a, b, params, tries=2, runner=None,
+                   budget_per_differ=False):
         """
         Actually do a diff between two pieces of content, optionally retrying
         if the process pool that executes the diff breaks.
+
+        ``runner`` is the function that runs ``func`` in the worker process
+        (default: ``payload_caller``). Returns a tuple of the runner's result
+        and a dict of how long each stage of the diff took in the worker.
+
+        If ``budget_per_differ`` is true, the CPU time and memory budget is
+        passed to the runner as ``budget`` to enforce around each differ it
+        calls, rather than being enforced around the whole runner.
         """
-        executor = self.get_diff_executor()
+        runner = runner or payload_caller
         loop = asyncio.get_running_loop()
-        for attempt in range(tries):
-            try:
-                return await loop.run_in_executor(
-                    executor, functools.partial(caller, func, a, b, **params))
-            except concurrent.futures.process.BrokenProcessPool:
-                executor = self.get_diff_executor(reset=True)
+        # Only send workers the parts of the responses they need, and spool
+        # large bodies to files rather than copying them through a pipe.
+        # Spooling writes whole bodies to a file (which may be on a real disk),
+        # so do it in a thread to avoid blocking the event loop.
+        payloads = await asyncio.gather(
+            *(loop.run_in_executor(None, _make_payload, response)
+              for response in (a, b)),
+            return_exceptions=True)
+        for payload in payloads:
+            if isinstance(payload, BaseException):
+                for other in payloads:
+                    if isinstance(other, DiffPayload):
+                        other.discard()
+                raise payload
+        a, b = payloads
+        # Get the executor after spooling, since the pool may have been
+        # replaced while we waited.
+        executor = self.get_diff_executor()
+        try:
+            # Wait for a free worker, so higher priority diffs can go first.
+            async with self.settings['diff_scheduler'].slot(self.priority):
+                for attempt in range(tries):
+                    try:
+                        result, timings, memory = await loop.run_in_executor(
+                            executor, functools.partial(_run_diff_task,
+                                                        runner, func, a, b,
+                                                        params,
+                                                        DIFFER_CPU_TIME_LIMIT,
+                                                        DIFFER_MEMORY_LIMIT,
+                                                        budget_per_differ))
+                        self.application.diff_finished(executor, memory)
+                        break
+                    except concurrent.futures.process.BrokenProcessPool:
+                        executor = self.get_diff_executor(reset=True)
+                        if attempt + 1 == tries:
+                            raise
+        except QueueFullError as error:
+            raise _queue_full_error(error)
+        finally:
+            a.discard()
+            b.discard()
+
+        metrics = self.settings['metrics']
+        if 'decode' in timings:
+            metrics.decode_seconds.observe(timings['decode'])
+        if 'parse' in timings:
+            metrics.parse_seconds.observe(timings['parse'])
+        for stage, seconds in timings.items():
+            if stage == 'differs':
+                for differ, differ_seconds in seconds.items():
+                    self.record_time(f'diff_{differ}', differ_seconds)
+            else:
+                self.record_time(stage, seconds)
+        return result, timings
 
     # NOTE: this doesn't do anything async, but if we change it to do so, we
     # need to add a lock (either asyncio.Lock or tornado.locks.Lock).
     def get_diff_executor(self, reset=False):
-        executor = self.settings.get('diff_executor')
-        if reset or not executor:
-            if executor:
-                try:
-                    # NOTE: we don't need await this; we just want to make sure
-                    # the old executor gets cleaned up.
-                    shutdown_executor_in_loop(executor)
-                except Exception:
-                    pass
-            executor = concurrent.futures.ProcessPoolExecutor(
-                DIFFER_PARALLELISM)
-            self.settings['diff_executor'] = executor
-
-        return executor
+        return self.application.get_diff_executor(reset)
 
     def write_error(self, status_code, **kwargs):
         response = {'code': status_code, 'error': self._reason}
@@ -442,20 +1084,24 @@ class DiffHandler(BaseHandler):
         # Handle errors that are allowed to be public
         # TODO: this error filtering should probably be in `send_error()`
         actual_error = 'exc_info' in kwargs and kwargs['exc_info'][1] or None
-        if isinstance(actual_error, (UndiffableContentError, UndecodableContentError)):
-            response['code'] = 422
-            response['error'] = str(actual_error)
+        if not isinstance(actual_error, PublicError):
+            response.update(public_error_details(actual_error))
 
         if 'extra' in kwargs:
             response.update(kwargs['extra'])
         if isinstance(actual_error, PublicError):
             response.update(actual_error.extra)
+            for name, value in actual_error.headers.items():
+                self.set_header(name, value)
 
         # Instances of PublicError and tornado.web.HTTPError won't get tracked
         # by Sentry by default, but we do want to track unexpected, server-side
         # issues. (Usually a non-HTTPError will have been raised in this case,
         # but PublicError can be used for special status codes.)
-        if isinstance(actual_error, tornado.web.HTTPError) and response['code'] >= 500:
+        # Full queues are expected under heavy load, so don't track them.
+        if (isinstance(actual_error, tornado.web.HTTPError)
+                and response['code'] >= 500
+                and response.get('type') != 'QUEUE_FULL'):
             with sentry_sdk.push_scope() as scope:
                 # TODO: this breadcrumb should happen at the start of the
                 # request handler, but we need to test and make sure crumbs are
@@ -486,19 +1132,57 @@ class DiffHandler(BaseHandler):
         self.finish(response)
 
 
+def _queue_full_error(error):
+    """
+    Create a public 503 error from a ``QueueFullError``.
+    """
+    return PublicError(503, str(error),
+                       extra={'type': 'QUEUE_FULL',
+                              'priority': error.priority,
+                              'retry_after': error.retry_after},
+                       headers={'Retry-After': str(error.retry_after)})
+
+
+def public_error_details(error):
+    """
+    Get the details of an error that are safe to show publicly, as a dict with
+    ``code`` (the HTTP status), ``error`` (a message), and possibly other
+    keys. Returns an empty dict if the error has no public details.
+    """
+    if isinstance(error, (UndiffableContentError, UndecodableContentError)):
+        return {'code': 422, 'error': str(error)}
+    elif isinstance(error, DiffBudgetExceededError):
+        return {'code': 422,
+                'error': str(error),
+                'type': 'DIFF_BUDGET_EXCEEDED',
+                'resource': error.resource,
+                'limit': error.limit}
+    elif isinstance(error, PublicError):
+        details = {'code': error.status_code,
+                   'error': error.reason or responses.get(error.status_code,
+                                                          'Unknown')}
+        details.update(error.extra)
+        return details
+
+    return {}
+
+
 def _extract_encoding(headers, content):
     encoding = None
     content_type = headers.get('Content-Type', '').lower()
     if 'charset=' in content_type:
         encoding = content_type.split('charset=')[-1]
     if not encoding:
-        meta_tag_match = META_TAG_PATTERN.search(content, endpos=2048)
-        if meta_tag_match:
-            encoding = meta_tag_match.group(1).decode('ascii', errors='ignore')
-    if not encoding:
-        prolog_match = XML_PROLOG_PATTERN.search(content, endpos=2048)
-        if prolog_match:
-            encoding = prolog_match.group(1).decode('ascii', errors='ignore')
+        # A <meta> tag wins over an XML prolog.
+        declared = None
+        for match in ENCODING_DECLARATION_PATTERN.finditer(content, 0, 2048):
+            if match.group(1) is not None:
+                declared = match.group(1)
+                break
+            elif declared is None:
+                declared = match.group(2)
+        if declared is not None:
+            encoding = declared.decode('ascii', errors='ignore')
     if encoding:
         encoding = encoding.strip()
     if not encoding and content:
@@ -506,7 +1190,7 @@ def _extract_encoding(headers, content):
         # content for detection. Its not necessary to use the full content
         # as it could be huge. Also, if you use too little, detection is not
         # accurate.
-        detected = cchardet.detect(content[:18432])
+        detected = cchardet.detect(bytes(content[:18432]))
         if detected:
             detected_encoding = detected.get('encoding')
             if detected_encoding:
@@ -527,23 +1211,59 @@ def _extract_encoding(headers, content):
     return encoding
 
 
+# Decoded bodies, keyed by content hash and Content-Type header. Values are
+# (text, encoding, whether the text looks like binary data).
+_decoded_bodies = OrderedDict()
+
+
 def _decode_body(response, name, raise_if_binary=True):
-    encoding = _extract_encoding(response.headers, response.body)
-    text = response.body.decode(encoding, errors='replace')
+    # If we know the body's hash, we might have already decoded it.
+    content_hash = getattr(response, 'content_hash', None)
+    key = (content_hash, response.headers.get('Content-Type', ''))
+    decoded = content_hash and _decoded_bodies.get(key)
+    if decoded:
+        _decoded_bodies.move_to_end(key)
+    else:
+        decoded = _decode_text(response.headers, response.body)
+        if content_hash:
+            _decoded_bodies[key] = decoded
+            if len(_decoded_bodies) > DECODE_CACHE_SIZE:
+                _decoded_bodies.popitem(last=False)
+
+    text, encoding, is_binary = decoded
+    if raise_if_binary and is_binary:
+        raise UndecodableContentError(f'The response body of `{name}` could not be decoded as {encoding}.')
+
+    return text
+
+
+def _decode_text(headers, body):
+    """
+    Decode a response body. Returns a tuple of the text, the encoding used,
+    and whether the body was probably binary data rather than text.
+    """
+    encoding = _extract_encoding(headers, body)
+    # `body` may be any bytes-like object, e.g. a memoryview of a spool file.
+    text = str(body, encoding, errors='replace')
     text_length = len(text)
     if text_length == 0:
-        return text
-
-    # Replace null terminators; some differs (especially those written in C)
-    # don't handle them well in the middle of a string.
-    text = text.replace('\u0000', '\ufffd')
+        return text, encoding, False
 
     # If a significantly large portion of the document was totally undecodable,
-    # it's likely this wasn't text at all, but binary data.
-    if raise_if_binary and text.count('\ufffd') / text_length > 0.25:
-        raise UndecodableContentError(f'The response body of `{name}` could not be decoded as {encoding}.')
+    # it's likely this wasn't text at all, but binary data. Null terminators
+    # count as undecodable, since they are replaced below. Counting them up
+    # front means we never re-scan the text after replacing them.
+    nulls = text.count('\u0000')
+    undecodable = text.count('\ufffd') + nulls
+    is_binary = undecodable / text_length > 0.25
 
-    return text
+    # Replace null terminators; some differs (especially those written in C)
+    # don't handle them well in the middle of a string. We only copy the text
+    # if there are any.
+    if nulls:
+        text = text.replace('\u0000', '\ufffd')
+
+    return text, encoding, is_binary
 
 
 def caller(func, a, b, **query_params):
@@ -568,31 +1288,64 @@ def caller(func, a, b, **query_params):
     * a_url, b_url: URL of HTTP request
     * a_body, b_body: Raw HTTP reponse body (bytes)
     * a_text, b_text: Decoded text of HTTP response body (str)
+    * a_soup, b_soup: Parsed HTML document of the response body
+      (bs4.BeautifulSoup). These are shared between differs, so differs must
+      not modify them.
 
     Any other argument names in the signature will take their values from the
     REST query parameters.
     """
+    return _call_differ(func, a, b, query_params)
+
+
+def _call_differ(func, a, b, query_params):
+    """
+    Does the actual work of ``caller()``. Any values extracted from ``a`` and
+    ``b`` are added to ``query_params``, so differs called with the same
+    ``query_params`` dict can share them.
+
+    Decoding, parsing, and running the differ are timed as the ``decode``,
+    ``parse``, and ``diff`` stages (see ``web_monitoring.diff.timing``).
+    """
+
     # Supplement the query_parameters from the REST call with special items
     # extracted from `a` and `b`.
     query_params.setdefault('a_url', a.request.url)
     query_params.setdefault('b_url', b.request.url)
-    query_params.setdefault('a_body', a.body)
-    query_params.setdefault('b_body', b.body)
     query_params.setdefault('a_headers', a.headers)
     query_params.setdefault('b_headers', b.headers)
 
     # The differ's signature is a dependency injection scheme.
     sig = inspect.signature(func)
 
+    # Bodies may be memoryviews that are only valid during this call, so only
+    # copy them into bytes if the differ needs them.
+    if 'a_body' in sig.parameters:
+        query_params.setdefault('a_body', bytes(a.body))
+    if 'b_body' in sig.parameters:
+        query_params.setdefault('b_body', bytes(b.body))
+
     raise_if_binary = not query_params.get('ignore_decoding_errors', False)
-    if 'a_text' in sig.parameters:
-        query_params.setdefault(
-            'a_text',
-            _decode_body(a, 'a', raise_if_binary=raise_if_binary))
-    if 'b_text' in sig.parameters:
-        query_params.setdefault(
-            'b_text',
-            _decode_body(b, 'b', raise_if_binary=raise_if_binary))
+    with timed('decode'):
+        if 'a_text' in sig.parameters or 'a_soup' in sig.parameters:
+            if 'a_text' not in query_params:
+                query_params['a_text'] = _decode_body(
+                    a, 'a', raise_if_binary=raise_if_binary)
+        if 'b_text' in sig.parameters or 'b_soup' in sig.parameters:
+            if 'b_text' not in query_params:
+                query_params['b_text'] = _decode_body(
+                    b, 'b', raise_if_binary=raise_if_binary)
+
+    # Parsing is expensive, so only do it if the differ needs it. Parsed
+    # documents are cached, so differs working with the same content in this
+    # process all share one parse.
+    with timed('parse'):
+        if 'a_soup' in sig.parameters and 'a_soup' not in query_params:
+            query_params['a_soup'] = parse_html_document(
+                query_params['a_text'])
+        if 'b_soup' in sig.parameters and 'b_soup' not in query_params:
+            query_params['b_soup'] = parse_html_document(
+                query_params['b_text'])
 
     kwargs = dict()
     for name, param in sig.parameters.items():
@@ -604,7 +1357,301 @@ def caller(func, a, b, **query_params):
                 raise KeyError("{} requires a parameter {} which was not "
                                "provided in the query"
                                "".format(func.__name__, name))
-    return func(**kwargs)
+    with timed('diff'):
+        return func(**kwargs)
+
+
+def _make_payload(response):
+    "Create a ``DiffPayload`` for a response, spooling its body if large."
+    return DiffPayload.from_response(response, SPOOL_DIRECTORY,
+                                     response_hash(response))
+
+
+def _run_diff_task(runner, func, a, b, params, cpu_time, memory,
+                   budget_per_differ=False):
+    """
+    Run a diff in a worker process, within a budget of CPU time and memory.
+    Returns the result, timings, and how much memory the worker is using.
+
+    If ``budget_per_differ`` is true, the runner enforces the budget around
+    each differ it calls (see ``multi_payload_caller()``).
+    """
+    if budget_per_differ:
+        run = functools.partial(runner, func, a, b,
+                                budget=(cpu_time, memory), **params)
+    else:
+        run = functools.partial(call_with_budget, cpu_time, memory, runner,
+                                func, a, b, **params)
+
+    if DIFFER_WINDOW_PARALLELISM > 0:
+        apply_window = functools.partial(_apply_window_task, cpu_time, memory)
+        with parallel_windows(apply_window):
+            result, timings = run()
+    else:
+        result, timings = run()
+    return result, timings, current_memory()
+
+
+# Pool of processes for matching windows of changes in parallel in a diff
+# worker process (see `DIFFER_WINDOW_PARALLELISM`).
+_window_pool = None
+
+
+def _apply_window_task(cpu_time, memory, function, args):
+    """
+    Start running a task for ``parallel_windows()`` in the current worker's
+    window pool, within a budget of CPU time and memory.
+    """
+    global _window_pool
+    if _window_pool is None:
+        # Pool processes are daemons, so they are stopped when the worker
+        # exits. (A ProcessPoolExecutor's processes would keep it waiting.)
+        _window_pool = multiprocessing.Pool(DIFFER_WINDOW_PARALLELISM)
+    return _window_pool.apply_async(call_with_budget,
+                                    (cpu_time, memory, function, *args))
+
+
+def _initialize_diff_worker():
+    """
+    Warm up a new diff worker process, so its first diff isn't slow.
+    """
+    # Make sure everything the differs use is imported and initialized.
+    for module in ('bs4', 'diff_match_patch', 'lxml.etree'):
+        importlib.import_module(module)
+    html5_parser.parse('<p>Hello</p>', treebuilder='soup')
+
+
+def payload_caller(func, a, b, **query_params):
+    """
+    Open two ``DiffPayload`` objects and call ``caller()`` with them. This is
+    how diffs are run in worker processes.
+
+    Returns
+    -------
+    tuple of (dict, dict)
+        The result of the differ and the time spent on each stage of the diff
+        (see ``web_monitoring.diff.timing``).
+    """
+    with collect_timings() as timings:
+        with a.open() as a_response, b.open() as b_response:
+            result = _call_differ(func, a_response, b_response, query_params)
+    return result, timings
+
+
+def multi_payload_caller(funcs, a, b, budget=(None, None), **query_params):
+    """
+    Open two ``DiffPayload`` objects and call several differs with them. The
+    decoded text and parsed documents are shared between all the differs.
+
+    Parameters
+    ----------
+    funcs : dict
+        Differ functions to call, keyed by name.
+    a : DiffPayload
+    b : DiffPayload
+    budget : tuple of (float, int), optional
+        Maximum CPU time and memory each differ can use (see
+        ``call_with_budget()``). A differ that goes over budget gets an error
+        object as its result, but doesn't stop the other differs.
+    **query_params
+        additional parameters parsed from the REST diffing request
+
+    Returns
+    -------
+    tuple of (dict, dict)
+        The result of each differ, keyed by name, and the time spent on each
+        stage of the diffs. If the content can't be diffed by a particular
+        differ, its result is an error object (with ``code`` and ``error``
+        keys) instead. Timings are like those from ``payload_caller()``,
+        except the time for each differ is in ``timings['differs'][name]``.
+    """
+    results = {}
+    differ_timings = {}
+    with collect_timings() as timings:
+        with a.open() as a_response, b.open() as b_response:
+            for name, func in funcs.items():
+                try:
+                    results[name] = call_with_budget(*budget, _call_differ,
+                                                     func, a_response,
+                                                     b_response, query_params)
+                except (UndiffableContentError,
+                        UndecodableContentError) as error:
+                    results[name] = {'code': 422, 'error': str(error)}
+                except DiffBudgetExceededError as error:
+                    results[name] = public_error_details(error)
+                differ_timings[name] = timings.pop('diff', 0)
+    timings['differs'] = differ_timings
+    return results, timings
+
+
+class MultiDiffHandler(DiffHandler):
+    """
+    Run several differs on the same content, e.g.
+    ``/multi?types=html_token,links_json,length&a=...&b=...``. The content is
+    only fetched and parsed once, and all the differs run in the same worker.
+    The response has each differ's result keyed by its name.
+    """
+    # subclass must define `differs` attribute
+
+    async def get(self):
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+
+        query_params = self.decode_query_params()
+        types = [name.strip()
+                 for name in query_params.pop('types', '').split(',')
+                 if name.strip()]
+        if not types:
+            raise PublicError(400, 'You must provide a comma-separated list '
+                                   'of diff types as the value for the '
+                                   '`types` query parameter.')
+
+        funcs = {}
+        for differ in types:
+            try:
+                funcs[differ] = self.differs[differ]
+            except KeyError:
+                raise PublicError(404, f'Unknown diffing method: `{differ}`. '
+                                       f'You can get a list of '
+                                       f'supported differs from '
+                                       f'the `/` endpoint.')
+
+        serialized = await self.fetch_and_diff(
+            f'multi:{",".join(funcs)}', query_params,
+            lambda a, b, result_key: self.multi_diff_and_serialize(
+                funcs, a, b, query_params, result_key),
+            require_html=all(requires_html(func, query_params)
+                             for func in funcs.values()))
+        self.write_serialized_result(serialized)
+
+    async def multi_diff_and_serialize(self, funcs, a, b, query_params,
+                                       result_key):
+        results, timings = await self.diff(funcs, a, b, query_params,
+                                           runner=multi_payload_caller,
+                                           budget_per_differ=True)
+        metrics = self.settings['metrics']
+        for differ, result in results.items():
+            result['version'] = web_monitoring.__version__
+            if 'code' not in result:
+                result.setdefault('type', differ)
+            metrics.diff_seconds.observe(timings['differs'][differ],
+                                         differ=differ)
+        # Like degraded results, results that went over budget depend on the
+        # budget settings, so don't cache them.
+        over_budget = any(result.get('type') == 'DIFF_BUDGET_EXCEEDED'
+                          for result in results.values())
+        return await self.serialize_and_cache(results, result_key, 'multi',
+                                              cache=not over_budget)
+
+
+class BulkDiffHandler(DiffHandler):
+    """
+    Run many diffs in one request. POST a JSON array of jobs like::
+
+        [{"differ": "html_token", "a": "<URL>", "b": "<URL>",
+          "a_hash": "<SHA-256>", "b_hash": "<SHA-256>",
+          "params": {"include": "all"}, "id": "anything"}, ...]
+
+    Only ``differ``, ``a``, and ``b`` are required. Each job is like a GET
+    request to ``/<differ>?a=<a>&b=<b>&a_hash=...&<params>``.
+
+    Results are streamed back as newline-delimited JSON as each diff finishes
+    (not in the order the jobs were listed). Each line has the ``index`` of the
+    job in the request, its ``id`` (if provided), and either a ``result`` or
+    an ``error`` object::
+
+        {"index": 1, "id": "anything", "result": {...}}
+        {"index": 0, "id": null, "error": {"code": 422, "error": "..."}}
+    """
+    # subclass must define `differs` attribute
+    SUPPORTED_METHODS = ('POST', 'OPTIONS')
+    # Jobs are POSTed as JSON, so browsers send a preflight request that must
+    # allow both the method and the `Content-Type` header.
+    cors_allowed_methods = 'POST, OPTIONS'
+    cors_allowed_headers = 'content-type, x-requested-with'
+    default_priority = BATCH
+
+    async def post(self):
+        self.check_queue()
+        try:
+            jobs = json.loads(self.request.body)
+        except ValueError:
+            raise PublicError(400, 'The request body must be a JSON array.')
+        if not isinstance(jobs, list) or not all(isinstance(job, dict)
+                                                 for job in jobs):
+            raise PublicError(400, 'The request body must be a JSON array of '
+                                   'job objects.')
+
+        # Run jobs that diff the same content near each other, so they can
+        # share cached fetches and results.
+        def content_key(item):
+            job = item[1]
+            return (str(job.get('a_hash') or job.get('a')),
+                    str(job.get('b_hash') or job.get('b')))
+        pending = iter(sorted(enumerate(jobs), key=content_key))
+
+        self.set_header('Content-Type', 'application/x-ndjson; charset=UTF-8')
+        write_lock = asyncio.Lock()
+
+        async def work():
+            for index, job in pending:
+                line = await self.run_job(index, job)
+                async with write_lock:
+                    self.write(line)
+                    try:
+                        await self.flush()
+                    except tornado.iostream.StreamClosedError:
+                        # The client went away, so stop working on its jobs.
+                        for _ in pending:
+                            pass
+                        return
+
+        await asyncio.gather(*(work() for _ in
+                               range(min(BULK_CONCURRENCY, len(jobs)))))
+
+    async def run_job(self, index, job):
+        """
+        Run one job from a bulk request and return its result as a line of
+        serialized JSON.
+        """
+        head = json_encode({'index': index, 'id': job.get('id')})
+        try:
+            differ = job.get('differ')
+            func = self.differs.get(differ) if isinstance(differ, str) else None
+            if func is None:
+                raise PublicError(404, f'Unknown diffing method: `{differ}`. '
+                                       f'You can get a list of '
+                                       f'supported differs from '
+                                       f'the `/` endpoint.')
+            params = job.get('params') or {}
+            if not isinstance(params, dict):
+                raise PublicError(400, 'Job `params` must be an object.')
+
+            query_params = dict(params)
+            for key in ('a', 'b', 'a_hash', 'b_hash'):
+                query_params.pop(key, None)
+                if job.get(key):
+                    query_params[key] = job[key]
+            serialized = await self.fetch_and_diff(
+                differ, query_params,
+                lambda a, b, result_key: self.diff_and_serialize(
+                    func, differ, a, b, query_params, result_key),
+                require_html=requires_html(func, query_params))
+            if serialized[:2] == GZIP_MAGIC_NUMBER:
+                serialized = gzip.decompress(serialized)
+            return (f'{head[:-1]}, "result": '.encode('utf-8')
+                    + serialized + b'}\n')
+        except Exception as error:
+            details = public_error_details(error)
+            if not details:
+                logger.error(f'Error in bulk diff job {index}', exc_info=error)
+                sentry_sdk.capture_exception(error)
+                details = {'code': 500, 'error': responses[500]}
+            return f'{head[:-1]}, "error": {json_encode(details)}}}\n'.encode(
+                'utf-8')
 
 
 class IndexHandler(BaseHandler):
@@ -616,29 +1663,64 @@ class IndexHandler(BaseHandler):
         self.write(info)
 
 
+class MetricsHandler(BaseHandler):
+
+    async def get(self):
+        settings = self.settings
+        caches = {name: settings[f'{name}_cache']
+                  for name in ('fetch', 'result')
+                  if settings.get(f'{name}_cache') is not None}
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(settings['metrics'].render(settings['diff_scheduler'],
+                                              caches))
+
+
 class HealthCheckHandler(BaseHandler):
 
     async def get(self):
         # TODO Include more information about health here.
-        # The 200 repsonse code with an empty object is just a liveness check.
-        self.write({})
+        # The 200 repsonse code is just a liveness check.
+        self.write({'queue': self.settings['diff_scheduler'].stats()})
 
 
 def make_app():
     class BoundDiffHandler(DiffHandler):
         differs = DIFF_ROUTES
 
+    class BoundMultiDiffHandler(MultiDiffHandler):
+        differs = DIFF_ROUTES
+
+    class BoundBulkDiffHandler(BulkDiffHandler):
+        differs = DIFF_ROUTES
+
     return DiffServer([
         (r"/healthcheck", HealthCheckHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/multi", BoundMultiDiffHandler),
+        (r"/bulk", BoundBulkDiffHandler),
         (r"/([A-Za-z0-9_]+)", BoundDiffHandler),
         (r"/", IndexHandler),
     ], debug=DEBUG_MODE, compress_response=True,
-       diff_executor=None)
+       diff_executor=None,
+       fetch_cache=LruCache(FETCH_CACHE_SIZE,
+                            FETCH_CACHE_DIRECTORY,
+                            FETCH_CACHE_DISK_SIZE,
+                            size_of=CachedResponse.cache_size,
+                            to_bytes=CachedResponse.to_bytes,
+                            from_bytes=CachedResponse.from_bytes),
+       result_cache=LruCache(RESULT_CACHE_SIZE,
+                             RESULT_CACHE_DIRECTORY,
+                             RESULT_CACHE_DISK_SIZE),
+       in_flight_fetches=SingleFlight(),
+       in_flight_diffs=SingleFlight(),
+       diff_scheduler=DiffScheduler(DIFFER_PARALLELISM, DIFFER_QUEUE_SIZE),
+       metrics=DiffMetrics())
 
 
 def start_app(port):
     app = make_app()
     print(f'Starting server on port {port}')
+    app.start_diff_executor()
     app.listen(port)
     with Signal((signal.SIGINT, signal.SIGTERM), app.handle_signal):
         tornado.ioloop.IOLoop.current().start()
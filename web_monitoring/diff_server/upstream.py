@@ -0,0 +1,533 @@
+"""
+Tools for fetching content to diff from upstream servers.
+
+Tornado's HTTP clients buffer a whole response before handing it back, so we
+can't tell whether a response is worth diffing until it has all arrived. The
+``StreamingFetch`` class here receives a response piece by piece instead, so
+it can give up on a response as soon as its headers show it isn't diffable or
+its body grows too big.
+
+``UpstreamClient`` wraps one of Tornado's HTTP clients to add the things we
+need for fetching lots of content from a few hosts: DNS caching, a limit on
+concurrent requests to each host, brotli compression, and support for
+stopping streaming fetches early with every backend.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+import hashlib
+import importlib.util
+from io import BytesIO
+import logging
+import socket
+import sys
+import time
+from urllib.parse import urlparse
+import zlib
+from tornado.httpclient import HTTPClientError, HTTPRequest
+from tornado.httputil import HTTPHeaders, parse_response_start_line
+from tornado.netutil import DefaultExecutorResolver, Resolver
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from ..diff.content_type import is_not_html
+from ..diff.diff_errors import UndiffableContentError
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Names of the HTTP client backends ``UpstreamClient`` can use.
+BACKENDS = ('simple', 'curl')
+
+
+class FetchAbortedError(Exception):
+    """
+    Raised inside a fetch's callbacks to stop receiving the response. The
+    error that explains why is available as ``StreamingFetch.error``.
+    """
+
+
+class _AbortedFetchFilter(logging.Filter):
+    """
+    Tornado logs any exception raised in a fetch's callbacks as "uncaught,"
+    even though stopping a fetch that way is intentional. This filters out
+    those log messages.
+    """
+    def filter(self, record):
+        error = record.exc_info and record.exc_info[1]
+        if error is None:
+            return True
+        # Tornado sometimes logs a second error that was raised while handling
+        # ours, so check the error's context, too.
+        return not (isinstance(error, FetchAbortedError)
+                    or isinstance(error.__context__, FetchAbortedError))
+
+
+logging.getLogger('tornado.application').addFilter(_AbortedFetchFilter())
+
+
+class ResponseTooLargeError(Exception):
+    """
+    Raised when an upstream response is bigger than the maximum size that can
+    be diffed.
+
+    Parameters
+    ----------
+    url : str
+    max_size : int
+        Maximum size of a response body, in bytes.
+    size : int, optional
+        Size of the response body, if known.
+    """
+    def __init__(self, url, max_size, size=None):
+        self.url = url
+        self.max_size = max_size
+        self.size = size
+        super().__init__(f'The response from "{url}" is larger than the '
+                         f'maximum diffable response ({max_size} bytes)')
+
+
+class StreamingFetch:
+    """
+    Receives an upstream response as it arrives, hashing the body as it goes
+    and stopping early if the response can't be diffed. Pass the
+    ``header_callback`` and ``streaming_callback`` methods to
+    ``AsyncHTTPClient.fetch()``, then call ``finish()`` with the response
+    (or use ``error`` to find out why the fetch was stopped).
+
+    Parameters
+    ----------
+    url : str
+    max_size : int, optional
+        Stop if the body is bigger than this many bytes. If ``0`` or ``None``,
+        there is no limit.
+    require_html : bool, optional
+        Stop if the ``Content-Type`` header says the response isn't HTML.
+
+    Examples
+    --------
+    >>> stream = StreamingFetch(url, max_size=10 * 1024 * 1024)
+    >>> try:
+    >>>     response = await client.fetch(
+    >>>         url,
+    >>>         header_callback=stream.header_callback,
+    >>>         streaming_callback=stream.streaming_callback)
+    >>> except Exception:
+    >>>     if stream.error:
+    >>>         raise stream.error
+    >>>     raise
+    >>> body = stream.finish(response).body
+    """
+    def __init__(self, url, max_size=None, require_html=False):
+        self.url = url
+        self.max_size = max_size
+        self.require_html = require_html
+        self.error = None
+        self.code = None
+        self.headers = HTTPHeaders()
+        self.size = 0
+        self._chunks = []
+        self._hash = hashlib.sha256()
+        self._streamed = False
+
+    def header_callback(self, line):
+        self._streamed = True
+        if line.startswith('HTTP/'):
+            # A new response (e.g. after a redirect) is starting.
+            self.code = parse_response_start_line(line).code
+            self.headers = HTTPHeaders()
+        elif line.strip():
+            self.headers.parse_line(line)
+        else:
+            self._check(self.code, self.headers)
+
+    def streaming_callback(self, chunk):
+        self._streamed = True
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            self._abort(ResponseTooLargeError(self.url, self.max_size))
+        self._chunks.append(chunk)
+        self._hash.update(chunk)
+
+    @property
+    def body(self):
+        return b''.join(self._chunks)
+
+    @property
+    def content_hash(self):
+        "SHA-256 hash of the body, as a hex string."
+        return self._hash.hexdigest()
+
+    def finish(self, response):
+        """
+        Check a response that finished without being stopped. If the HTTP
+        client didn't support streaming, the response is checked here instead.
+
+        Parameters
+        ----------
+        response : tornado.httpclient.HTTPResponse
+
+        Returns
+        -------
+        StreamingFetch
+            This object, which holds the response body and its hash.
+        """
+        if self.error:
+            # Some clients can't stop a fetch, so it may have finished anyway.
+            raise self.error
+        if not self._streamed:
+            self._check(response.code, response.headers)
+            body = response.body or b''
+            self.size = len(body)
+            if self.max_size and self.size > self.max_size:
+                raise ResponseTooLargeError(self.url, self.max_size, self.size)
+            self._chunks = [body]
+            self._hash.update(body)
+        return self
+
+    def _check(self, code, headers):
+        # Error responses are reported as errors, not as undiffable content,
+        # unless they are archived (which makes them diffable).
+        if code and code >= 400 and 'Memento-Datetime' not in headers:
+            return
+
+        length = headers.get('Content-Length')
+        if self.max_size and length and length.isdigit():
+            if int(length) > self.max_size:
+                self._abort(ResponseTooLargeError(self.url, self.max_size,
+                                                  int(length)))
+
+        if self.require_html and is_not_html('', headers, 'nosniff'):
+            content_type = headers.get('Content-Type')
+            self._abort(UndiffableContentError(
+                f'"{self.url}" is not an HTML document (it has the '
+                f'Content-Type "{content_type}")'))
+
+    def _abort(self, error):
+        self.error = error
+        if self._streamed:
+            raise FetchAbortedError(str(error))
+        raise error
+
+
+class CachingResolver(Resolver):
+    """
+    A DNS resolver that remembers results for a while, so fetching lots of
+    content from the same host doesn't mean looking it up over and over.
+
+    Parameters
+    ----------
+    resolver : tornado.netutil.Resolver, optional
+        Resolver to actually look up hosts with. Defaults to Tornado's
+        ``DefaultExecutorResolver``.
+    ttl : float, optional
+        How long to remember results for, in seconds. Defaults to 300.
+    """
+    def initialize(self, resolver=None, ttl=300):
+        self.resolver = resolver or DefaultExecutorResolver()
+        self.ttl = ttl
+        self._cache = {}
+
+    async def resolve(self, host, port, family=socket.AF_UNSPEC):
+        key = (host, port, family)
+        now = time.monotonic()
+        cached = self._cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        result = await self.resolver.resolve(host, port, family)
+        # Drop anything that has expired so the cache doesn't grow forever.
+        self._cache = {key: value for key, value in self._cache.items()
+                       if value[0] > now}
+        self._cache[key] = (now + self.ttl, result)
+        return result
+
+    def close(self):
+        self.resolver.close()
+
+
+class HostLimiter:
+    """
+    Limits how many requests can be made to any one host at the same time.
+
+    Parameters
+    ----------
+    limit : int
+        Maximum concurrent requests per host. If ``0`` or ``None``, there is no
+        limit.
+
+    Examples
+    --------
+    >>> limiter = HostLimiter(4)
+    >>> async with limiter.limit('https://example.gov/some/page'):
+    >>>     await client.fetch('https://example.gov/some/page')
+    """
+    def __init__(self, limit):
+        self.limit_per_host = limit
+        # Map of host -> [semaphore, number of requests using it]
+        self._hosts = {}
+
+    @asynccontextmanager
+    async def limit(self, url):
+        if not self.limit_per_host:
+            yield
+            return
+
+        host = urlparse(url).netloc
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = [
+                asyncio.Semaphore(self.limit_per_host), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._hosts[host]
+
+    def active(self, url):
+        "Get the number of requests running or waiting for a URL's host."
+        entry = self._hosts.get(urlparse(url).netloc)
+        return entry[1] if entry else 0
+
+
+class _FetchWatcher:
+    """
+    Wraps a fetch's callbacks to enforce a maximum body size and to keep track
+    of whether they raised an exception to stop the fetch.
+    """
+    def __init__(self, url, max_size, header_callback, streaming_callback):
+        self.url = url
+        self.max_size = max_size
+        self.header_callback = header_callback
+        self.streaming_callback = streaming_callback
+        self.size = 0
+        self.aborted = False
+        self.too_large = False
+
+    def on_header(self, line):
+        if line.startswith('HTTP/'):
+            # A new response (e.g. after a redirect) is starting.
+            self.size = 0
+        if self.header_callback:
+            self._call(self.header_callback, line)
+
+    def on_chunk(self, chunk):
+        self.size += len(chunk)
+        if self.max_size and self.size > self.max_size:
+            self.aborted = self.too_large = True
+            raise FetchAbortedError(f'Response from "{self.url}" is too big')
+        self._call(self.streaming_callback, chunk)
+
+    def _call(self, callback, data):
+        try:
+            callback(data)
+        except Exception:
+            self.aborted = True
+            raise
+
+    def check_progress(self, download_total, downloaded, upload_total,
+                       uploaded):
+        "A curl progress callback that stops the fetch if it was aborted."
+        return 1 if self.aborted else 0
+
+
+class _ContentDecoder:
+    """
+    Wraps a fetch's callbacks to decompress gzip- or brotli-encoded bodies.
+    Tornado's simple HTTP client only asks for gzip when it decompresses
+    responses itself, so we turn that off and decompress here instead.
+    """
+    def __init__(self, header_callback, streaming_callback):
+        self.header_callback = header_callback
+        self.streaming_callback = streaming_callback
+        self.encoding = None
+        self.decompressor = None
+
+    def on_header(self, line):
+        if line.startswith('HTTP/'):
+            self.encoding = self.decompressor = None
+        elif line.lower().startswith('content-encoding:'):
+            encoding = line.split(':', 1)[1].strip().lower()
+            if encoding == 'gzip':
+                self.encoding = encoding
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif encoding == 'br' and brotli:
+                self.encoding = encoding
+                self.decompressor = brotli.Decompressor()
+        self.header_callback(line)
+
+    def on_chunk(self, chunk):
+        if self.decompressor:
+            if self.encoding == 'gzip':
+                chunk = self.decompressor.decompress(chunk)
+            else:
+                chunk = self.decompressor.process(chunk)
+            if not chunk:
+                return
+        self.streaming_callback(chunk)
+
+    def finish(self, response):
+        """
+        Send any remaining decompressed data and update a response's headers
+        to indicate the body was decompressed (the same way Tornado does).
+        """
+        if not self.decompressor:
+            return
+        if self.encoding == 'gzip':
+            tail = self.decompressor.flush()
+            if tail:
+                self.streaming_callback(tail)
+        del response.headers['Content-Encoding']
+        response.headers['X-Consumed-Content-Encoding'] = self.encoding
+
+
+class UpstreamClient:
+    """
+    An HTTP client for fetching content to diff. It works like Tornado's
+    ``AsyncHTTPClient`` (and wraps one), but adds:
+
+    - Connection reuse, when using the ``curl`` backend. (Tornado's ``simple``
+      client opens a new connection for every request.)
+    - DNS caching.
+    - A limit on how many requests can be made to each host at once.
+    - Brotli compression, if the ``brotli`` package is installed. (Tornado's
+      simple client only supports gzip, so we decompress responses ourselves
+      with that backend.)
+    - The ability to stop streaming fetches by raising an exception from their
+      ``header_callback`` or ``streaming_callback`` (like Tornado's simple
+      client supports) with every backend.
+    - A maximum body size that works the same way with every backend, and
+      raises ``ResponseTooLargeError`` when exceeded.
+
+    Parameters
+    ----------
+    backend : str, optional
+        Which of Tornado's HTTP clients to use: ``simple`` (the default) or
+        ``curl`` (which requires ``pycurl``).
+    max_clients : int, optional
+        Maximum number of requests to make at once. Defaults to 10.
+    max_per_host : int, optional
+        Maximum number of requests to make to one host at once. If ``0`` (the
+        default), only ``max_clients`` applies.
+    max_body_size : int, optional
+        Maximum size of response bodies, in bytes. If ``0`` or ``None`` (the
+        default), there is no limit.
+    dns_cache_ttl : float, optional
+        How long to cache DNS lookups for, in seconds. Defaults to 300. If
+        ``0``, lookups are not cached.
+    """
+    def __init__(self, backend='simple', max_clients=10, max_per_host=0,
+                 max_body_size=None, dns_cache_ttl=300):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown HTTP client "{backend}". Options are: '
+                             f'{", ".join(BACKENDS)}')
+        if backend == 'curl' and importlib.util.find_spec('pycurl') is None:
+            raise ValueError('The "curl" HTTP client requires pycurl')
+
+        self.backend = backend
+        self.max_clients = max_clients
+        self.max_body_size = max_body_size or None
+        self.dns_cache_ttl = dns_cache_ttl
+        self.hosts = HostLimiter(max_per_host)
+        self._client = None
+
+    @property
+    def client(self):
+        "The underlying Tornado client. It's created on first use."
+        if self._client is None:
+            if self.backend == 'curl':
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                self._client = CurlAsyncHTTPClient(
+                    force_instance=True,
+                    max_clients=self.max_clients)
+            else:
+                resolver = None
+                if self.dns_cache_ttl:
+                    resolver = CachingResolver(ttl=self.dns_cache_ttl)
+                # We enforce the maximum body size ourselves, so Tornado's
+                # check (which fails with an ambiguous error) shouldn't apply.
+                self._client = SimpleAsyncHTTPClient(
+                    force_instance=True,
+                    max_clients=self.max_clients,
+                    max_body_size=sys.maxsize,
+                    resolver=resolver)
+        return self._client
+
+    async def fetch(self, request, **kwargs):
+        """
+        Fetch a URL. This takes the same arguments as
+        ``AsyncHTTPClient.fetch()``.
+        """
+        url = request.url if isinstance(request, HTTPRequest) else request
+        headers = kwargs['headers'] = HTTPHeaders(kwargs.get('headers') or {})
+
+        # Always stream the body, so we can check its size as it arrives.
+        buffer = None
+        if not kwargs.get('streaming_callback'):
+            buffer = BytesIO()
+            kwargs['streaming_callback'] = buffer.write
+
+        watcher = _FetchWatcher(url, self.max_body_size,
+                                kwargs.get('header_callback'),
+                                kwargs['streaming_callback'])
+        kwargs['header_callback'] = watcher.on_header
+        kwargs['streaming_callback'] = watcher.on_chunk
+
+        decoder = None
+        if self.backend == 'curl':
+            self._prepare_curl(kwargs, watcher)
+        elif kwargs.get('decompress_response', True):
+            kwargs['decompress_response'] = False
+            if 'Accept-Encoding' not in headers:
+                headers['Accept-Encoding'] = 'gzip, br' if brotli else 'gzip'
+            decoder = _ContentDecoder(watcher.on_header, watcher.on_chunk)
+            kwargs['header_callback'] = decoder.on_header
+            kwargs['streaming_callback'] = decoder.on_chunk
+
+        try:
+            async with self.hosts.limit(url):
+                try:
+                    response = await self.client.fetch(request, **kwargs)
+                except HTTPClientError as error:
+                    if decoder and error.response is not None:
+                        decoder.finish(error.response)
+                    raise
+            if decoder:
+                decoder.finish(response)
+        except Exception:
+            if watcher.too_large:
+                raise ResponseTooLargeError(url, self.max_body_size) from None
+            raise
+
+        if buffer is not None:
+            buffer.seek(0)
+            response.buffer = buffer
+            response._body = None
+        return response
+
+    def _prepare_curl(self, kwargs, watcher):
+        """
+        Set up a fetch with the curl backend. Curl runs streaming callbacks
+        later on the event loop instead of while receiving the response, so
+        an exception in them can't stop the fetch directly. Instead, curl
+        checks whether to stop on every progress update.
+        """
+        import pycurl
+        prepare = kwargs.get('prepare_curl_callback')
+
+        def prepare_curl(curl):
+            # Accept any compression curl supports (including brotli, if curl
+            # was built with it).
+            curl.setopt(pycurl.ENCODING, '')
+            if self.dns_cache_ttl:
+                curl.setopt(pycurl.DNS_CACHE_TIMEOUT, int(self.dns_cache_ttl))
+            # Curl handles are reused, so always set this, even to 0.
+            curl.setopt(pycurl.MAXFILESIZE, self.max_body_size or 0)
+            curl.setopt(pycurl.NOPROGRESS, 0)
+            curl.setopt(pycurl.XFERINFOFUNCTION, watcher.check_progress)
+            if prepare:
+                prepare(curl)
+
+        kwargs['prepare_curl_callback'] = prepare_curl
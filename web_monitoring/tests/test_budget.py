@@ -0,0 +1,53 @@
+import pickle
+import pytest
+from web_monitoring.diff.diff_errors import DiffBudgetExceededError
+from web_monitoring.diff_server.budget import call_with_budget, enforce_budget
+
+
+def spin():
+    while True:
+        pass
+
+
+def use_memory(size):
+    chunks = []
+    while True:
+        chunks.append(bytearray(size))
+
+
+def test_stops_code_that_uses_too_much_cpu_time():
+    with pytest.raises(DiffBudgetExceededError) as info:
+        with enforce_budget(cpu_time=0.2):
+            spin()
+    assert info.value.resource == 'cpu_time'
+    assert info.value.limit == 0.2
+    assert info.value.used >= 0.2
+
+
+def test_stops_code_that_uses_too_much_memory():
+    with pytest.raises(DiffBudgetExceededError) as info:
+        with enforce_budget(memory=50 * 1024 * 1024):
+            use_memory(1024 * 1024)
+    assert info.value.resource == 'memory'
+    assert info.value.used > 50 * 1024 * 1024
+
+
+def test_does_nothing_without_limits():
+    with enforce_budget():
+        result = sum(range(1000))
+    assert result == 499500
+
+
+def test_call_with_budget():
+    assert call_with_budget(10, 0, sum, [1, 2, 3]) == 6
+    with pytest.raises(DiffBudgetExceededError):
+        call_with_budget(0.2, 0, spin)
+
+
+def test_budget_errors_can_be_pickled():
+    error = DiffBudgetExceededError('memory', 1024, 2048)
+    copy = pickle.loads(pickle.dumps(error))
+    assert copy.resource == 'memory'
+    assert copy.limit == 1024
+    assert copy.used == 2048
+    assert str(copy) == str(error)
@@ -0,0 +1,180 @@
+import asyncio
+import json
+from pathlib import Path
+import pytest
+import tempfile
+from web_monitoring.diff_server.cache import LruCache, SingleFlight
+
+
+def test_lru_cache_gets_and_sets():
+    cache = LruCache(100)
+    cache.set('a', b'abc')
+    assert cache.get('a') == b'abc'
+    assert cache.get('b') is None
+    assert cache.get('b', 'default') == 'default'
+    assert 'a' in cache
+    assert 'b' not in cache
+
+
+def test_lru_cache_evicts_least_recently_used_by_size():
+    cache = LruCache(10)
+    cache.set('a', b'aaaa')
+    cache.set('b', b'bbbb')
+    # Touch `a` so `b` is the least recently used.
+    cache.get('a')
+    cache.set('c', b'cccc')
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('b') is None
+    assert cache.get('c') == b'cccc'
+    assert cache.size == 8
+    assert cache.evictions == 1
+
+
+def test_lru_cache_does_not_store_values_bigger_than_max_size():
+    cache = LruCache(10)
+    cache.set('a', b'aaaa')
+    cache.set('b', b'b' * 11)
+    assert cache.get('a') == b'aaaa'
+    assert cache.get('b') is None
+
+
+def test_lru_cache_counts_hits_and_misses():
+    cache = LruCache(10)
+    cache.set('a', b'aaaa')
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 2 / 3
+
+
+def test_lru_cache_uses_custom_size():
+    cache = LruCache(10, size_of=lambda value: value['size'])
+    cache.set('a', {'size': 6})
+    cache.set('b', {'size': 6})
+    assert cache.get('a') is None
+    assert cache.get('b') == {'size': 6}
+
+
+def test_lru_cache_disk_tier():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LruCache(10, directory)
+        cache.set('a', b'aaaaaaaa')
+        cache.set('b', b'bbbbbbbb')
+        # `a` has been evicted from memory, but is still on disk.
+        assert len(cache) == 1
+        assert cache.get('a') == b'aaaaaaaa'
+        assert cache.stats()['disk_hits'] == 1
+
+        # A new cache should pick up the files that are already on disk.
+        new_cache = LruCache(10, directory)
+        assert new_cache.get('b') == b'bbbbbbbb'
+
+
+def test_lru_cache_disk_tier_is_bounded():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LruCache(0, directory, max_disk_size=1)
+        cache.set('a', b'aaaaaaaa')
+        assert cache.get('a') is None
+        assert cache.stats()['disk_size'] == 0
+
+
+def test_lru_cache_disk_tier_stores_raw_bytes():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LruCache(0, directory,
+                         to_bytes=lambda value: value.encode('utf-8'),
+                         from_bytes=lambda data: data.decode('utf-8'))
+        cache.set('a', 'some text')
+        files = list(Path(directory).iterdir())
+        assert [path.read_bytes() for path in files] == [b'some text']
+        assert cache.get('a') == 'some text'
+
+
+def test_lru_cache_disk_tier_drops_unreadable_files():
+    with tempfile.TemporaryDirectory() as directory:
+        cache = LruCache(0, directory, from_bytes=json.loads)
+        cache.set('a', b'not json')
+        assert cache.get('a') is None
+        assert cache.stats()['disk_entries'] == 0
+        assert list(Path(directory).iterdir()) == []
+
+
+def test_lru_cache_async_disk_tier():
+    async def run():
+        with tempfile.TemporaryDirectory() as directory:
+            cache = LruCache(10, directory, max_disk_size=20)
+            await cache.set_async('a', b'aaaaaaaa')
+            await cache.set_async('b', b'bbbbbbbb')
+            assert len(cache) == 1
+            assert await cache.get_async('a') == b'aaaaaaaa'
+            assert cache.stats()['disk_hits'] == 1
+
+            # Writing `c` pushes the least recently used file (`b`) out of
+            # the disk tier.
+            await cache.set_async('c', b'cccccccc')
+            assert cache.stats()['disk_size'] == 16
+            assert len(list(Path(directory).iterdir())) == 2
+            assert await cache.get_async('b') is None
+            assert await cache.get_async('b', 'default') == 'default'
+
+    asyncio.run(run())
+
+
+def test_single_flight_shares_in_progress_work():
+    calls = []
+
+    async def work(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async def run_all():
+        in_flight = SingleFlight()
+        results = await asyncio.gather(
+            in_flight.run('a', lambda: work(1)),
+            in_flight.run('a', lambda: work(2)),
+            in_flight.run('b', lambda: work(3)))
+        assert in_flight.coalesced == 1
+        assert len(in_flight) == 0
+        # Once work is done, it is not shared anymore.
+        assert await in_flight.run('a', lambda: work(4)) == 4
+        return results
+
+    assert asyncio.run(run_all()) == [1, 1, 3]
+    assert calls == [1, 3, 4]
+
+
+def test_single_flight_shares_exceptions():
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError('Oops')
+
+    async def run_all():
+        in_flight = SingleFlight()
+        return await asyncio.gather(in_flight.run('a', work),
+                                    in_flight.run('a', work),
+                                    return_exceptions=True)
+
+    first, second = asyncio.run(run_all())
+    assert isinstance(first, ValueError)
+    assert second is first
+
+
+def test_single_flight_is_not_cancelled_by_one_caller():
+    async def work():
+        await asyncio.sleep(0.01)
+        return 'done'
+
+    async def run_all():
+        in_flight = SingleFlight()
+        first = asyncio.ensure_future(in_flight.run('a', work))
+        second = asyncio.ensure_future(in_flight.run('a', work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run_all()) == 'done'
@@ -1,13 +1,19 @@
+import gzip
 import json
 import os
 import unittest
 from pathlib import Path
 import re
 import tempfile
+import threading
+import time
+from tornado import gen
 from tornado.testing import AsyncHTTPTestCase, bind_unused_port
 from unittest.mock import patch
 import web_monitoring.diff_server.server as df
+from web_monitoring.diff.html_diff_render import html_diff_render
 from web_monitoring.diff.diff_errors import UndecodableContentError
+from web_monitoring.utils import hash_content
 import web_monitoring
 from tornado.escape import utf8
 from tornado.httpclient import HTTPResponse, AsyncHTTPClient
@@ -110,6 +116,156 @@ class DiffingServerFetchTest(DiffingServerTestCase):
             assert b_headers.get('Accept') != 'application/json'
 
 
+class DiffingServerFetchCacheTest(DiffingServerTestCase):
+
+    def test_does_not_refetch_content_with_known_hash(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='<p>Hello</p>')
+            mock.respond_to(r'/b$', body='<p>Goodbye</p>')
+            a_hash = web_monitoring.utils.hash_content(b'<p>Hello</p>')
+            b_hash = web_monitoring.utils.hash_content(b'<p>Goodbye</p>')
+            query = (f'a=https://example.org/a&a_hash={a_hash}&'
+                     f'b=https://example.org/b&b_hash={b_hash}')
+
+            first = self.fetch(f'/html_source_dmp?{query}')
+            assert first.code == 200
+            assert len(mock.requests) == 2
+
+            # Use a different differ so we don't just get a cached result.
+            mock.requests.clear()
+            second = self.fetch(f'/html_text_dmp?{query}')
+            assert second.code == 200
+            assert len(mock.requests) == 0
+
+            stats = self._app.settings['fetch_cache'].stats()
+            assert stats['hits'] == 2
+            assert stats['misses'] == 2
+
+    def test_does_not_cache_content_with_bad_hash(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='<p>Hello</p>')
+            bad_hash = web_monitoring.utils.hash_content(b'Something else')
+            url = ('/html_source_dmp?'
+                   f'a=https://example.org/a&a_hash={bad_hash}&'
+                   f'b=https://example.org/a')
+
+            assert self.fetch(url).code == 502
+            mock.requests.clear()
+            assert self.fetch(url).code == 502
+            assert 'https://example.org/a' in mock.requests
+
+    def test_does_not_cache_content_without_hash(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='<p>Hello</p>')
+            mock.respond_to(r'/b$', body='<p>Goodbye</p>')
+            query = 'a=https://example.org/a&b=https://example.org/b'
+
+            assert self.fetch(f'/html_source_dmp?{query}').code == 200
+            mock.requests.clear()
+            assert self.fetch(f'/html_text_dmp?{query}').code == 200
+            assert len(mock.requests) == 2
+            assert len(self._app.settings['fetch_cache']) == 0
+
+
+class DiffingServerResultCacheTest(DiffingServerTestCase):
+
+    def test_caches_diff_results(self):
+        url = ('/html_source_dmp?'
+               f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+               f'b=file://{fixture_path("unknown_encoding.html")}')
+        first = self.fetch(url)
+        assert first.code == 200
+        second = self.fetch(url)
+        assert second.code == 200
+        assert json.loads(second.body) == json.loads(first.body)
+
+        stats = self._app.settings['result_cache'].stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+
+    def test_result_cache_is_keyed_by_parameters(self):
+        url = ('/html_token?'
+               f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+               f'b=file://{fixture_path("unknown_encoding.html")}')
+        combined = self.fetch(url)
+        insertions = self.fetch(f'{url}&include=insertions')
+        assert 'combined' in json.loads(combined.body)
+        assert 'insertions' in json.loads(insertions.body)
+        assert self._app.settings['result_cache'].stats()['hits'] == 0
+
+    def test_serves_cached_results_without_gzip(self):
+        url = ('/html_source_dmp?'
+               f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+               f'b=file://{fixture_path("unknown_encoding.html")}')
+        first = self.fetch(url)
+        second = self.fetch(url, decompress_response=False)
+        assert second.code == 200
+        assert 'Content-Encoding' not in second.headers
+        assert json.loads(second.body) == json.loads(first.body)
+
+    def test_caches_serialized_results_on_disk(self):
+        url = ('/html_source_dmp?'
+               f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+               f'b=file://{fixture_path("unknown_encoding.html")}')
+        with tempfile.TemporaryDirectory() as directory:
+            cache = df.LruCache(0, directory)
+            self._app.settings['result_cache'] = cache
+            first = self.fetch(url)
+            assert first.code == 200
+            # The file on disk is just the serialized (gzipped) JSON result.
+            files = list(Path(directory).iterdir())
+            assert len(files) == 1
+            data = files[0].read_bytes()
+            if df.RESULT_CACHE_COMPRESSION:
+                data = gzip.decompress(data)
+            assert json.loads(data) == json.loads(first.body)
+
+            second = self.fetch(url)
+            assert json.loads(second.body) == json.loads(first.body)
+            assert cache.stats()['disk_hits'] == 1
+
+    def test_skips_fetching_for_cached_results_with_known_hashes(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='<p>Hello</p>')
+            mock.respond_to(r'/b$', body='<p>Goodbye</p>')
+            a_hash = web_monitoring.utils.hash_content(b'<p>Hello</p>')
+            b_hash = web_monitoring.utils.hash_content(b'<p>Goodbye</p>')
+            url = ('/html_source_dmp?'
+                   f'a=https://example.org/a&a_hash={a_hash}&'
+                   f'b=https://example.org/b&b_hash={b_hash}')
+
+            assert self.fetch(url).code == 200
+            # Clear the fetch cache to make sure the result cache is used.
+            self._app.settings['fetch_cache'] = None
+            mock.requests.clear()
+            assert self.fetch(url).code == 200
+            assert len(mock.requests) == 0
+
+
+class DiffingServerCoalescingTest(DiffingServerTestCase):
+
+    def test_coalesces_concurrent_identical_diffs(self):
+        url = self.get_url(
+            '/html_source_dmp?'
+            f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+            f'b=file://{fixture_path("unknown_encoding.html")}')
+        responses = self.io_loop.run_sync(lambda: gen.multi(
+            [self.http_client.fetch(url) for _ in range(3)]))
+
+        bodies = [json.loads(response.body) for response in responses]
+        assert bodies[0] == bodies[1] == bodies[2]
+        # Every request after the first either waited for the first one's
+        # result or used the cached result, but never ran its own diff.
+        coalesced = self._app.settings['in_flight_diffs'].coalesced
+        stats = self._app.settings['result_cache'].stats()
+        assert coalesced + stats['hits'] == 2
+        assert len(self._app.settings['in_flight_diffs']) == 0
+
+
 class DiffingServerExceptionHandlingTest(DiffingServerTestCase):
 
     def test_local_file_disallowed_in_production(self):
@@ -180,6 +336,14 @@ class DiffingServerExceptionHandlingTest(DiffingServerTestCase):
         with self.assertRaises(KeyError):
             df.caller(mock_diffing_method, response, response)
 
+    def test_caller_injects_parsed_documents(self):
+        def differ(a_soup, b_soup):
+            return {'a': a_soup.p.string, 'b': b_soup.p.string}
+
+        a = df.MockResponse('http://example.org/a', b'<p>Hello</p>')
+        b = df.MockResponse('http://example.org/b', b'<p>Goodbye</p>')
+        assert df.caller(differ, a, b) == {'a': 'Hello', 'b': 'Goodbye'}
+
     def test_a_is_404(self):
         response = self.fetch('/html_token?format=json&include=all'
                               '&a=http://httpstat.us/404'
@@ -265,6 +429,45 @@ class DiffingServerExceptionHandlingTest(DiffingServerTestCase):
         response = mock_tornado_request('unknown_encoding.html')
         df._decode_body(response, 'a')
 
+    def test_decoded_bodies_are_reused_by_hash(self):
+        body = '<p>¡Olé!</p>'.encode('utf-8')
+        response = df.CachedResponse('https://example.gov/', body,
+                                     HTTPHeaders(), hash_content(body))
+        with patch.object(df, '_decode_text', wraps=df._decode_text) as mock:
+            assert df._decode_body(response, 'a') == '<p>¡Olé!</p>'
+            assert df._decode_body(response, 'b') == '<p>¡Olé!</p>'
+            assert mock.call_count == 1
+
+    def test_cached_response_round_trips_through_bytes(self):
+        headers = HTTPHeaders({'Content-Type': 'text/html'})
+        headers.add('Set-Cookie', 'a=1')
+        headers.add('Set-Cookie', 'b=2')
+        body = b'<p>Hello</p>\n<p>World</p>'
+        response = df.CachedResponse('https://example.gov/', body, headers,
+                                     hash_content(body))
+        loaded = df.CachedResponse.from_bytes(response.to_bytes())
+        assert loaded.request.url == 'https://example.gov/'
+        assert loaded.body == body
+        assert loaded.content_hash == hash_content(body)
+        assert loaded.headers.get_list('Set-Cookie') == ['a=1', 'b=2']
+        assert loaded.headers['Content-Type'] == 'text/html'
+
+    def test_decode_text_counts_null_characters_as_undecodable(self):
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        text, _, is_binary = df._decode_text(headers, b'Hello\x00world')
+        assert text == 'Hello\ufffdworld'
+        assert not is_binary
+        text, _, is_binary = df._decode_text(headers, b'\x00\x00\x00a')
+        assert text == '\ufffd\ufffd\ufffda'
+        assert is_binary
+
+    def test_reused_undecodable_content_is_still_undecodable(self):
+        response = mock_tornado_request('simple.pdf')
+        response.content_hash = hash_content(response.body)
+        df._decode_body(response, 'a', raise_if_binary=False)
+        with self.assertRaises(UndecodableContentError):
+            df._decode_body(response, 'a')
+
     def test_extract_encoding_bad_headers(self):
         headers = {'Content-Type': '  text/html; charset=iso-8859-7'}
         assert df._extract_encoding(headers, b'') == 'iso-8859-7'
@@ -282,6 +485,13 @@ class DiffingServerExceptionHandlingTest(DiffingServerTestCase):
         <body></body>""".encode('iso-8859-2')
         assert df._extract_encoding(headers, body) == 'iso-8859-2'
 
+    def test_extract_encoding_prefers_meta_tag_to_xml_prolog(self):
+        body = (b'<?xml version="1.0" encoding="iso-8859-2"?>'
+                b'<html><head><meta charset="koi8-r"></head></html>')
+        assert df._extract_encoding({}, body) == 'koi8-r'
+        body = b'<?xml version="1.0" encoding="iso-8859-2"?><html></html>'
+        assert df._extract_encoding({}, body) == 'iso-8859-2'
+
     def test_diff_content_with_null_bytes(self):
         response = self.fetch('/html_source_dmp?format=json&'
                               f'a=file://{fixture_path("has_null_byte.txt")}&'
@@ -369,6 +579,519 @@ class DiffingServerResponseSizeTest(DiffingServerTestCase):
                 assert len(result['diff'][0][1]) == 1024
 
 
+class DiffingServerStreamingFetchTest(DiffingServerTestCase):
+    def test_rejects_non_html_content_type_before_downloading(self):
+        async def responder(handler):
+            handler.set_header('Content-Type', 'application/pdf')
+            for _ in range(20):
+                handler.write((10 * 1024) * b'x')
+                await handler.flush()
+
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        with patch.object(df, 'client', client):
+            with SimpleHttpServer(responder) as server:
+                response = self.fetch('/html_token?'
+                                      f'a={server.url("/whatever1")}&'
+                                      f'b={server.url("/whatever2")}')
+                self.json_check(response)
+                assert response.code == 422
+                assert 'is not an HTML document' in json.loads(
+                    response.body)['error']
+
+    def test_non_html_content_type_is_fine_for_non_html_differs(self):
+        async def responder(handler):
+            handler.set_header('Content-Type', 'application/pdf')
+            handler.write(b'%PDF-1.4')
+
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        with patch.object(df, 'client', client):
+            with SimpleHttpServer(responder) as server:
+                response = self.fetch('/identical_bytes?'
+                                      f'a={server.url("/whatever1")}&'
+                                      f'b={server.url("/whatever2")}')
+                assert response.code == 200
+                assert json.loads(response.body)['diff'] is True
+
+    @patch.object(df, 'MAX_BODY_SIZE', 100 * 1024)
+    def test_rejects_oversize_content_length(self):
+        async def responder(handler):
+            handler.write((110 * 1024) * b'x')
+
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        with patch.object(df, 'client', client):
+            with SimpleHttpServer(responder) as server:
+                response = self.fetch('/html_source_dmp?'
+                                      f'a={server.url("/whatever1")}&'
+                                      f'b={server.url("/whatever2")}')
+                self.json_check(response)
+                assert response.code == 502
+                result = json.loads(response.body)
+                assert result['type'] == 'RESPONSE_TOO_LARGE'
+                assert result['max_size'] == 100 * 1024
+
+    @patch.object(df, 'MAX_BODY_SIZE', 100 * 1024)
+    def test_stops_streaming_oversize_content(self):
+        async def responder(handler):
+            # Without a Content-Length, the size can only be checked while
+            # the body is arriving.
+            for _ in range(11):
+                handler.write((10 * 1024) * b'x')
+                await handler.flush()
+
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        with patch.object(df, 'client', client):
+            with SimpleHttpServer(responder) as server:
+                response = self.fetch('/html_source_dmp?'
+                                      f'a={server.url("/whatever1")}&'
+                                      f'b={server.url("/whatever2")}')
+                assert response.code == 502
+                assert json.loads(response.body)['type'] == \
+                    'RESPONSE_TOO_LARGE'
+
+    @patch.object(df, 'MAX_BODY_SIZE', 100 * 1024)
+    def test_upstream_client_enforces_limits(self):
+        async def responder(handler):
+            if handler.request.path == '/big':
+                for _ in range(11):
+                    handler.write((10 * 1024) * b'x')
+                    await handler.flush()
+            else:
+                handler.write(b'<p>Hello</p>')
+
+        client = df.UpstreamClient(max_per_host=1,
+                                   max_body_size=100 * 1024)
+        with patch.object(df, 'client', client):
+            with SimpleHttpServer(responder) as server:
+                response = self.fetch('/html_source_dmp?'
+                                      f'a={server.url("/a")}&'
+                                      f'b={server.url("/b")}')
+                assert response.code == 200
+
+                response = self.fetch('/html_source_dmp?'
+                                      f'a={server.url("/a")}&'
+                                      f'b={server.url("/big")}')
+                assert response.code == 502
+                assert json.loads(response.body)['type'] == \
+                    'RESPONSE_TOO_LARGE'
+
+    def test_validates_hash_of_streamed_content(self):
+        async def responder(handler):
+            handler.write(b'<p>Hello</p>')
+
+        good_hash = web_monitoring.utils.hash_content(b'<p>Hello</p>')
+        bad_hash = web_monitoring.utils.hash_content(b'<p>Goodbye</p>')
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+        with patch.object(df, 'client', client):
+            with SimpleHttpServer(responder) as server:
+                response = self.fetch('/html_source_dmp?'
+                                      f'a={server.url("/a")}&'
+                                      f'a_hash={good_hash}&'
+                                      f'b={server.url("/b")}')
+                assert response.code == 200
+
+                response = self.fetch('/html_source_dmp?'
+                                      f'a={server.url("/a2")}&'
+                                      f'a_hash={bad_hash}&'
+                                      f'b={server.url("/b")}')
+                assert response.code == 502
+                assert json.loads(response.body)['actual_hash'] == good_hash
+
+
+class DiffingServerMultiDiffTest(DiffingServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content_params = (
+            f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+            f'b=file://{fixture_path("unknown_encoding.html")}')
+
+    def test_runs_several_differs(self):
+        response = self.fetch('/multi?types=html_token,links_json,length&'
+                              f'{self.content_params}')
+        assert response.code == 200
+        result = json.loads(response.body)
+        assert list(result.keys()) == ['html_token', 'links_json', 'length']
+        for differ, differ_result in result.items():
+            single = self.fetch(f'/{differ}?{self.content_params}')
+            assert differ_result == json.loads(single.body)
+
+    def test_reports_undiffable_content_for_each_differ(self):
+        response = self.fetch('/multi?types=html_token,identical_bytes&'
+                              f'a=file://{fixture_path("simple.pdf")}&'
+                              f'b=file://{fixture_path("simple.pdf")}')
+        assert response.code == 200
+        result = json.loads(response.body)
+        assert result['html_token']['code'] == 422
+        assert result['identical_bytes']['diff'] is True
+
+    @patch.object(df, 'DIFFER_CPU_TIME_LIMIT', 0.2)
+    def test_enforces_budget_for_each_differ(self):
+        with patch.dict(df.DIFF_ROUTES, {'slow': slow_diffing_method}):
+            response = self.fetch('/multi?types=slow,length&'
+                                  f'{self.content_params}')
+        assert response.code == 200
+        result = json.loads(response.body)
+        assert result['slow']['code'] == 422
+        assert result['slow']['type'] == 'DIFF_BUDGET_EXCEEDED'
+        assert result['slow']['resource'] == 'cpu_time'
+        assert 'diff' in result['length']
+
+    def test_requires_types(self):
+        response = self.fetch(f'/multi?{self.content_params}')
+        self.json_check(response)
+        assert response.code == 400
+
+    def test_unknown_types_are_not_found(self):
+        response = self.fetch('/multi?types=length,not_a_differ&'
+                              f'{self.content_params}')
+        self.json_check(response)
+        assert response.code == 404
+
+
+class DiffingServerBulkDiffTest(DiffingServerTestCase):
+    def fetch_bulk(self, jobs):
+        return self.fetch('/bulk', method='POST', body=json.dumps(jobs))
+
+    def test_streams_results_for_each_job(self):
+        a = f'file://{fixture_path("poorly_encoded_utf8.txt")}'
+        b = f'file://{fixture_path("unknown_encoding.html")}'
+        jobs = [
+            {'differ': 'html_token', 'a': a, 'b': b, 'id': 'first'},
+            {'differ': 'length', 'a': a, 'b': b},
+            {'differ': 'html_token', 'a': a, 'b': b,
+             'params': {'include': 'insertions'}},
+            {'differ': 'not_a_differ', 'a': a, 'b': b},
+        ]
+        response = self.fetch_bulk(jobs)
+        assert response.code == 200
+        assert response.headers['Content-Type'].startswith(
+            'application/x-ndjson')
+
+        lines = response.body.decode('utf-8').splitlines()
+        assert len(lines) == 4
+        results = {}
+        for line in lines:
+            result = json.loads(line)
+            results[result['index']] = result
+
+        assert results[0]['id'] == 'first'
+        assert results[0]['result'] == json.loads(
+            self.fetch(f'/html_token?a={a}&b={b}').body)
+        assert results[1]['id'] is None
+        assert results[1]['result'] == json.loads(
+            self.fetch(f'/length?a={a}&b={b}').body)
+        assert 'insertions' in results[2]['result']
+        assert results[3]['error']['code'] == 404
+
+    def test_reports_errors_for_each_job(self):
+        pdf = f'file://{fixture_path("simple.pdf")}'
+        response = self.fetch_bulk([
+            {'differ': 'html_token', 'a': pdf, 'b': pdf},
+            {'differ': 'identical_bytes', 'a': pdf, 'b': pdf},
+            {'differ': 'length', 'a': pdf},
+        ])
+        assert response.code == 200
+        results = {}
+        for line in response.body.decode('utf-8').splitlines():
+            result = json.loads(line)
+            results[result['index']] = result
+        assert results[0]['error']['code'] == 422
+        assert results[1]['result']['diff'] is True
+        assert results[2]['error']['code'] == 400
+
+    def test_requires_an_array_of_jobs(self):
+        response = self.fetch('/bulk', method='POST', body='{"a": "b"}')
+        self.json_check(response)
+        assert response.code == 400
+
+        response = self.fetch('/bulk', method='POST', body='not json')
+        self.json_check(response)
+        assert response.code == 400
+
+    def test_empty_requests_have_no_results(self):
+        response = self.fetch_bulk([])
+        assert response.code == 200
+        assert response.body == b''
+
+    @patch('web_monitoring.diff_server.server.access_control_allow_origin_header', '*')
+    def test_allows_cross_origin_posts(self):
+        response = self.fetch('/bulk', method='OPTIONS',
+                              headers={'Origin': 'http://test.com',
+                                       'Access-Control-Request-Method': 'POST'})
+        assert response.code == 204
+        assert response.headers.get('Access-Control-Allow-Origin') == 'http://test.com'
+        assert 'POST' in response.headers.get('Access-Control-Allow-Methods')
+        assert 'content-type' in response.headers.get('Access-Control-Allow-Headers')
+
+
+class DiffingServerSchedulingTest(DiffingServerTestCase):
+    def test_rejects_diffs_when_queue_is_full(self):
+        scheduler = self._app.settings['diff_scheduler']
+        with patch.object(scheduler, 'running', scheduler.concurrency), \
+                patch.object(scheduler, 'max_queue_size', 0):
+            response = self.fetch('/html_token?'
+                                  f'a=file://{fixture_path("empty.txt")}&'
+                                  f'b=file://{fixture_path("empty.txt")}')
+        self.json_check(response)
+        assert response.code == 503
+        assert int(response.headers['Retry-After']) >= 1
+        result = json.loads(response.body)
+        assert result['type'] == 'QUEUE_FULL'
+        assert result['priority'] == 'interactive'
+
+    def test_priority_can_be_set_by_header(self):
+        scheduler = self._app.settings['diff_scheduler']
+        with patch.object(scheduler, 'running', scheduler.concurrency), \
+                patch.object(scheduler, 'max_queue_size', 0):
+            response = self.fetch('/html_token?'
+                                  f'a=file://{fixture_path("empty.txt")}&'
+                                  f'b=file://{fixture_path("empty.txt")}',
+                                  headers={'X-Diff-Priority': 'batch'})
+        assert response.code == 503
+        assert json.loads(response.body)['priority'] == 'batch'
+
+    def test_rejects_unknown_priorities(self):
+        response = self.fetch('/html_token?priority=urgent&'
+                              f'a=file://{fixture_path("empty.txt")}&'
+                              f'b=file://{fixture_path("empty.txt")}')
+        self.json_check(response)
+        assert response.code == 400
+
+    def test_priority_does_not_change_results(self):
+        url = ('/html_source_dmp?'
+               f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+               f'b=file://{fixture_path("unknown_encoding.html")}')
+        first = self.fetch(url)
+        second = self.fetch(f'{url}&priority=batch')
+        assert second.code == 200
+        assert json.loads(second.body) == json.loads(first.body)
+        assert self._app.settings['result_cache'].stats()['hits'] == 1
+
+    def test_healthcheck_includes_queue_stats(self):
+        response = self.fetch('/healthcheck')
+        queue = json.loads(response.body)['queue']
+        assert queue['queued'] == {'interactive': 0, 'batch': 0}
+
+
+class DiffingServerMetricsTest(DiffingServerTestCase):
+    def test_metrics(self):
+        mock = MockAsyncHttpClient()
+        with patch.object(df, 'client', wraps=mock):
+            mock.respond_to(r'/a$', body='<p>Hello</p>')
+            mock.respond_to(r'/b$', body='<p>Goodbye</p>')
+            response = self.fetch('/html_token?'
+                                  'a=https://example.org/a&'
+                                  'b=https://example.org/b')
+            assert response.code == 200
+
+        response = self.fetch('/metrics')
+        assert response.code == 200
+        assert response.headers['Content-Type'].startswith('text/plain')
+        lines = response.body.decode('utf-8').splitlines()
+        assert 'diff_fetch_seconds_count{host="example.org"} 2' in lines
+        assert 'diff_decode_seconds_count 1' in lines
+        assert 'diff_parse_seconds_count 1' in lines
+        assert 'diff_duration_seconds_count{differ="html_token"} 1' in lines
+        assert 'diff_response_size_bytes_count{differ="html_token"} 1' in lines
+        assert 'diff_serialize_seconds_count 1' in lines
+        assert 'diff_queue_depth{priority="interactive"} 0' in lines
+        assert 'diff_cache_misses_total{cache="result"} 1' in lines
+
+
+class DiffingServerTimingTest(DiffingServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = ('/html_token?'
+                    f'a=file://{fixture_path("poorly_encoded_utf8.txt")}&'
+                    f'b=file://{fixture_path("unknown_encoding.html")}')
+
+    def parse_server_timing(self, response):
+        timings = {}
+        for entry in response.headers['Server-Timing'].split(', '):
+            stage, duration = entry.split(';dur=')
+            timings[stage] = float(duration)
+        return timings
+
+    def test_reports_server_timing(self):
+        response = self.fetch(self.url)
+        assert response.code == 200
+        timings = self.parse_server_timing(response)
+        for stage in ('fetch_a', 'fetch_b', 'decode', 'parse', 'tokenize',
+                      'match', 'assemble', 'diff', 'serialize'):
+            assert timings[stage] >= 0
+        assert 'timing' not in json.loads(response.body)
+
+        stats = response.headers['X-Diff-Stats']
+        assert 'cache=miss' in stats
+        assert 'a_bytes=' in stats
+
+    def test_includes_timing_in_result_if_requested(self):
+        response = self.fetch(f'{self.url}&timing=true')
+        assert response.code == 200
+        result = json.loads(response.body)
+        assert result['timing'] == self.parse_server_timing(response)
+        assert 'combined' in result
+
+    def test_timing_does_not_affect_result_caching(self):
+        self.fetch(self.url)
+        response = self.fetch(f'{self.url}&timing=true')
+        assert 'cache=hit' in response.headers['X-Diff-Stats']
+        result = json.loads(response.body)
+        assert 'diff' not in result['timing']
+        assert 'fetch_a' in result['timing']
+
+
+class DiffingServerSpoolTest(DiffingServerTestCase):
+    def test_spools_large_bodies_off_the_event_loop(self):
+        threads = []
+        from_response = df.DiffPayload.from_response
+
+        def record_thread(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return from_response(*args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as spool_directory, \
+                tempfile.NamedTemporaryFile() as a, \
+                tempfile.NamedTemporaryFile() as b, \
+                patch.object(df, 'SPOOL_DIRECTORY', spool_directory), \
+                patch.object(df.DiffPayload, 'from_response', record_thread):
+            a.write(b'a' * 1024 * 1024)
+            a.flush()
+            b.write(b'b' * 1024 * 1024 * 2)
+            b.flush()
+            response = self.fetch(f'/length?a=file://{a.name}&'
+                                  f'b=file://{b.name}')
+            assert response.code == 200
+            assert json.loads(response.body)['diff'] == 1024 * 1024
+            assert len(threads) == 2
+            assert threading.main_thread() not in threads
+            assert os.listdir(spool_directory) == []
+
+class DiffingServerBudgetTest(DiffingServerTestCase):
+    def fetch_slow_diff(self, method=None):
+        method = method or slow_diffing_method
+        with patch.dict(df.DIFF_ROUTES, {'slow': method}):
+            return self.fetch('/slow?'
+                              f'a=file://{fixture_path("empty.txt")}&'
+                              f'b=file://{fixture_path("empty.txt")}')
+
+    @patch.object(df, 'DIFFER_CPU_TIME_LIMIT', 0.2)
+    def test_diff_over_cpu_time_budget_is_stopped(self):
+        response = self.fetch_slow_diff()
+        self.json_check(response)
+        assert response.code == 422
+        result = json.loads(response.body)
+        assert result['type'] == 'DIFF_BUDGET_EXCEEDED'
+        assert result['resource'] == 'cpu_time'
+        assert result['limit'] == 0.2
+
+    @patch.object(df, 'DIFFER_CPU_TIME_LIMIT', 0.2)
+    @patch.object(df, 'DIFFER_BUDGET_FALLBACK', 'identical_bytes')
+    def test_diff_over_budget_falls_back_to_cheaper_differ(self):
+        response = self.fetch_slow_diff()
+        assert response.code == 200
+        result = json.loads(response.body)
+        assert result['type'] == 'identical_bytes'
+        assert result['diff'] is True
+        assert result['degraded']['requested_type'] == 'slow'
+        assert result['degraded']['resource'] == 'cpu_time'
+
+    @patch.object(df, 'DIFFER_BUDGET_FALLBACK', 'identical_bytes')
+    def test_degraded_results_are_not_cached(self):
+        with patch.object(df, 'DIFFER_CPU_TIME_LIMIT', 0.2):
+            response = self.fetch_slow_diff(finite_slow_diffing_method)
+            assert json.loads(response.body)['type'] == 'identical_bytes'
+
+        with patch.object(df, 'DIFFER_CPU_TIME_LIMIT', 10):
+            response = self.fetch_slow_diff(finite_slow_diffing_method)
+        assert response.code == 200
+        result = json.loads(response.body)
+        assert result['type'] == 'slow'
+        assert 'degraded' not in result
+
+
+class DiffingServerWorkerRecyclingTest(DiffingServerTestCase):
+    def fetch_diff(self, a, b):
+        return self.fetch('/identical_bytes?'
+                          f'a=file://{fixture_path(a)}&'
+                          f'b=file://{fixture_path(b)}')
+
+    def recycle_count(self, reason):
+        metrics = self.fetch('/metrics').body.decode()
+        match = re.search(rf'^diff_pool_recycles_total{{reason="{reason}"}} '
+                          r'(\d+)$', metrics, re.MULTILINE)
+        return int(match.group(1)) if match else 0
+
+    @patch.object(df, 'DIFFER_PARALLELISM', 1)
+    @patch.object(df, 'DIFFER_MAX_TASKS_PER_CHILD', 2)
+    def test_pool_is_replaced_after_max_tasks(self):
+        self.fetch_diff('empty.txt', 'empty.txt')
+        executor = self._app.settings['diff_executor']
+        self.fetch_diff('empty.txt', 'has_null_byte.txt')
+        assert self._app.settings['diff_executor'] is not executor
+        assert self.recycle_count('tasks') == 1
+
+        # The new pool should work normally.
+        response = self.fetch_diff('has_null_byte.txt', 'empty.txt')
+        assert response.code == 200
+
+    @patch.object(df, 'DIFFER_MAX_WORKER_MEMORY', 1)
+    def test_pool_is_replaced_when_a_worker_uses_too_much_memory(self):
+        response = self.fetch_diff('empty.txt', 'empty.txt')
+        assert response.code == 200
+        executor = self._app.settings['diff_executor']
+        response = self.fetch_diff('empty.txt', 'has_null_byte.txt')
+        assert response.code == 200
+        assert self._app.settings['diff_executor'] is not executor
+        assert self.recycle_count('memory') == 2
+
+    def test_pool_is_not_replaced_without_limits(self):
+        self.fetch_diff('empty.txt', 'empty.txt')
+        executor = self._app.settings['diff_executor']
+        self.fetch_diff('empty.txt', 'has_null_byte.txt')
+        assert self._app.settings['diff_executor'] is executor
+        assert self.recycle_count('tasks') == 0
+        assert self.recycle_count('memory') == 0
+
+
+class DiffingServerWindowParallelismTest(DiffingServerTestCase):
+    @patch.object(df, 'DIFFER_WINDOW_PARALLELISM', 2)
+    @patch('web_monitoring.diff.sequence_diff.PARALLEL_WINDOW_SIZE', 1)
+    def test_windows_matched_in_parallel_give_the_same_result(self):
+        a_text = ''.join(f'<p>Paragraph {index} is here.</p>'
+                         for index in range(20))
+        b_text = a_text.replace('Paragraph 3 ', 'Paragraph three ')
+        b_text = b_text.replace('Paragraph 15 is', 'Paragraph 15 was')
+        expected = html_diff_render(a_text, b_text, include='all',
+                                    segmentation='blocks')
+
+        with tempfile.TemporaryDirectory() as directory:
+            a_path = Path(directory, 'a.html')
+            a_path.write_text(a_text)
+            b_path = Path(directory, 'b.html')
+            b_path.write_text(b_text)
+            response = self.fetch('/html_token?format=json&include=all&'
+                                  'segmentation=blocks&'
+                                  f'a=file://{a_path}&b=file://{b_path}')
+
+        assert response.code == 200
+        result = json.loads(response.body)
+        for diff_type in ('combined', 'insertions', 'deletions'):
+            assert result[diff_type] == expected[diff_type]
+        assert result['change_count'] == expected['change_count']
+
+
+def slow_diffing_method(a_body, b_body):
+    while True:
+        pass
+
+
+def finite_slow_diffing_method(a_body, b_body):
+    start = time.process_time()
+    while time.process_time() - start < 0.5:
+        pass
+    return {'diff': 'finished'}
+
+
 def mock_diffing_method(c_body):
     return
 
@@ -12,7 +12,12 @@ import html5_parser
 import pytest
 import re
 from web_monitoring.diff.diff_errors import UndiffableContentError
-from web_monitoring.diff.html_diff_render import html_diff_render
+from web_monitoring.diff.html_diff_render import (
+    html_diff_render, _customize_tokens, _intern_tokens, href_token,
+    ImgTagToken, InsensitiveSequenceMatcher, tokenize, TokenTable, TokenType,
+    UrlRules)
+from web_monitoring.diff.parsing import parse_html_document
+from web_monitoring.diff.timing import collect_timings
 
 
 # TODO: extend these to other html differs via parameterization, a la
@@ -69,10 +74,9 @@ def test_html_diff_render_doesnt_move_script_content_into_page_text():
 
 def test_deactivate_deleted_active_elements():
     '''
-    Method `_deactivate_deleted_active_elements` is used by `html_diff_render`
-    internally to encapsulate `del > script` and `del > style` elements with a
-    `<template class="wm-diff-deleted-inert">` tag. The result for each deleted
-    tag should be like:
+    `html_diff_render` encapsulates `del > script` and `del > style` elements
+    in the combined diff with a `<template class="wm-diff-deleted-inert">` tag.
+    The result for each deleted tag should be like:
 
     <del class="wm-diff">
         <template class="wm-diff-deleted-inert">
@@ -92,6 +96,25 @@ def test_deactivate_deleted_active_elements():
     assert len(elements) == 2
 
 
+def test_deactivate_deleted_nested_active_elements():
+    '''
+    Active elements nested inside other deleted elements should also be
+    encapsulated in a `<template class="wm-diff-deleted-inert">` tag.
+    '''
+    a = '''<body>
+           <svg><g><script>alert(1)</script></g></svg>
+           <div><style>p { color: red; }</style></div>
+           <p>test</p></body>'''
+    b = '''<body><p>test2</p></body>'''
+    result = html_diff_render(a, b)['combined']
+    soup = html5_parser.parse(result, treebuilder='soup', return_root=False)
+    for element in soup.find_all(['script', 'style']):
+        if element.find_parent('del'):
+            assert element.find_parent('template',
+                                       class_='wm-diff-deleted-inert')
+    assert len(soup.select('template.wm-diff-deleted-inert')) == 2
+
+
 @pytest.mark.skip(reason='lxml parser does not support CDATA in html')
 def test_html_diff_render_preserves_cdata_content():
     html = '<foo>A CDATA section: <![CDATA[ <hi>yes</hi> ]]> {}.</foo>'
@@ -299,3 +322,237 @@ def test_html_diff_compound_comparisons_works():
         include='all', url_rules='jsessionid,wayback,wayback_uk')
 
     assert results['change_count'] == 0
+
+
+def test_url_comparators_canonicalize_urls():
+    comparator = UrlRules.get_comparator('jsessionid,wayback')
+    assert comparator.canonicalize(
+        'http://web.archive.org/web/20190525141538/https://www.noaa.gov/'
+        'api;jsessionid=AAA') == '\x00wayback:noaa.gov/api'
+    # URLs that differ in ways either rule ignores are equivalent.
+    assert comparator.compare(
+        'http://web.archive.org/web/20190525141538/https://noaa.gov/a;'
+        'jsessionid=AAA',
+        'http://web.archive.org/web/20181231224558/https://noaa.gov/a;'
+        'jsessionid=BBB')
+    assert not comparator.compare('https://noaa.gov/a', 'https://noaa.gov/b')
+    # Comparators are shared for the same rules.
+    assert comparator is UrlRules.get_comparator('jsessionid,wayback')
+
+
+def test_archived_urls_do_not_equal_unarchived_urls():
+    archived = ('http://web.archive.org/web/20190525141538/'
+                'https://www.noaa.gov/about')
+    for rules in ('wayback', 'jsessionid,wayback', 'wayback,wayback_uk'):
+        comparator = UrlRules.get_comparator(rules)
+        assert not comparator.compare(archived, 'noaa.gov/about')
+
+    archived_uk = ('https://www.webarchive.org.uk/wayback/en/archive/'
+                   '20190525141538/https://www.noaa.gov/about')
+    comparator = UrlRules.get_comparator('wayback,wayback_uk')
+    assert not comparator.compare(archived_uk, 'noaa.gov/about')
+    assert not comparator.compare(archived_uk, archived)
+
+
+def test_href_tokens_hash_like_their_canonical_urls():
+    comparator = UrlRules.get_comparator('jsessionid')
+    token_a = href_token('/a;jsessionid=AAA', comparator)
+    token_b = href_token('/a;jsessionid=BBB', comparator)
+    assert token_a == token_b
+    assert hash(token_a) == hash(token_b)
+    assert len({token_a, token_b}) == 1
+
+
+def test_equal_img_tokens_hash_the_same():
+    comparator = UrlRules.get_comparator('jsessionid')
+    token_a = ImgTagToken('img', ['/a.png', '/b.png;jsessionid=AAA'],
+                          '<img src="/a.png">', comparator)
+    token_b = ImgTagToken('img', ['/b.png;jsessionid=BBB', '/c.png'],
+                          '<img src="/c.png">', comparator)
+    assert token_a == token_b
+    assert hash(token_a) == hash(token_b)
+    assert len({token_a, token_b}) == 1
+
+
+def test_compare_array_matches_any_equivalent_urls():
+    comparator = UrlRules.get_comparator('jsessionid')
+    assert UrlRules.compare_array(['/a.png', '/b.png;jsessionid=AAA'],
+                                  ['/b.png;jsessionid=BBB'], comparator)
+    assert not UrlRules.compare_array(['/a.png'], ['/b.png'], comparator)
+    assert UrlRules.compare_array(['/a.png', '/b.png'], ['/b.png'], None)
+    assert not UrlRules.compare_array(['/a.png;jsessionid=AAA'],
+                                      ['/a.png;jsessionid=BBB'], None)
+
+
+def test_intern_tokens_honors_url_comparators():
+    comparator = UrlRules.get_comparator('jsessionid')
+    old_tokens = TokenTable(comparator)
+    old_tokens.append(TokenType.word, '/a')
+    old_tokens.append(TokenType.href, '/a;jsessionid=AAA')
+    old_tokens.append(TokenType.href, '/b;jsessionid=AAA')
+    new_tokens = TokenTable(comparator)
+    new_tokens.append(TokenType.href, '/b;jsessionid=BBB')
+    new_tokens.append(TokenType.href, '/a;jsessionid=BBB')
+    new_tokens.append(TokenType.word, '/a')
+
+    old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+
+    assert old_ids[0] == new_ids[2]
+    assert old_ids[1] == new_ids[1]
+    assert old_ids[2] == new_ids[0]
+    assert len(set(old_ids)) == 3
+
+
+def test_intern_tokens_gives_images_the_id_of_the_first_equal_image():
+    comparator = UrlRules.get_comparator('jsessionid')
+    old_tokens = TokenTable(comparator)
+    old_tokens.append(TokenType.img, '<img>', image_sources=['/a.png'])
+    old_tokens.append(TokenType.img, '<img>', image_sources=['/b.png'])
+    new_tokens = TokenTable(comparator)
+    new_tokens.append(TokenType.img, '<img>',
+                      image_sources=['/b.png;jsessionid=X', '/a.png'])
+    new_tokens.append(TokenType.img, '<img>', image_sources=['/c.png'])
+
+    old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+
+    assert old_ids[0] != old_ids[1]
+    assert new_ids[0] == old_ids[0]
+    assert new_ids[1] not in old_ids
+
+
+def test_intern_tokens_gives_chained_images_the_same_id():
+    # A={x}, B={x,y}, and C={y}: B is equal to both A and C, so B and C must
+    # share an ID even though B got A's ID first.
+    old_tokens = TokenTable()
+    old_tokens.append(TokenType.img, '<img>', image_sources=['/x.png'])
+    old_tokens.append(TokenType.img, '<img>',
+                      image_sources=['/x.png', '/y.png'])
+    new_tokens = TokenTable()
+    new_tokens.append(TokenType.img, '<img>', image_sources=['/y.png'])
+
+    old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+
+    assert old_ids[1] == old_ids[0]
+    assert new_ids[0] == old_ids[1]
+
+
+def test_intern_tokens_lets_matcher_find_runs_of_equivalent_links():
+    # These links are only equal under the URL rules, and there is no text
+    # around them to anchor a match, so they can only be matched up if equal
+    # tokens are indexed together.
+    comparator = UrlRules.get_comparator('jsessionid')
+    old_tokens = TokenTable(comparator)
+    old_tokens.append(TokenType.word, 'Alpha')
+    new_tokens = TokenTable(comparator)
+    new_tokens.append(TokenType.word, 'Beta')
+    for index in range(4):
+        old_tokens.append(TokenType.href, f'/page{index};jsessionid=AAA')
+        new_tokens.append(TokenType.href, f'/page{index};jsessionid=BBB')
+
+    old_ids, new_ids = _intern_tokens(old_tokens, new_tokens)
+    matcher = InsensitiveSequenceMatcher(a=old_ids, b=new_ids, autojunk=False)
+    assert matcher.get_opcodes() == [('replace', 0, 1, 0, 1),
+                                     ('equal', 1, 5, 1, 5)]
+
+
+def test_token_table_stores_tokens_compactly():
+    tokens = tokenize(parse_html_document(
+        '<p>Hello <a href="/there">there</a></p><p>Hello again</p>').body,
+        comparator=None)
+
+    assert [str(token) for token in tokens] == [
+        'Hello', 'there', '/there', 'Hello', 'again']
+    assert tokens[0].pre_tags == ['<p>']
+    assert tokens[0].trailing_whitespace == ' '
+    assert tokens[1].pre_tags == ['<a href="/there">']
+    assert isinstance(tokens[2], href_token)
+    assert tokens[2].post_tags == ['</a>', '</p>']
+    assert tokens[3].pre_tags == ['<p>']
+    assert tokens[4].post_tags == ['</p>']
+    # Repeated strings are only stored once.
+    assert tokens.text_ids[0] == tokens.text_ids[3]
+    assert len(tokens.strings) == len(set(tokens.strings))
+
+
+def test_customize_tokens_rebalances_tags_and_adds_spacers():
+    tokens = tokenize(parse_html_document(
+        '<div><p><em>Hello!</em></p><div>there.</div></div>').body,
+        comparator=None)
+    customized = [(token.pre_tags, str(token), token.post_tags)
+                  for token in _customize_tokens(tokens)]
+
+    assert customized == [
+        (['<div>'], '\nSPACER', []),
+        ([], '\nSPACER', []),
+        ([], '\nSPACER', []),
+        (['<p>', '<em>'], 'Hello!', ['</em>', '</p>']),
+        (['<div>'], 'there.', ['</div>', '</div>']),
+    ]
+
+
+def test_tokenize_can_customize_tokens_while_tokenizing():
+    html = ('<ul><li>One <a href="/one">link</a></li><li><a></a></li>'
+            '<li>Two</li></ul><p>Para<em>graph</em></p>')
+
+    def describe(tokens):
+        return [(token.pre_tags, str(token), token.post_tags)
+                for token in tokens]
+
+    customized = tokenize(parse_html_document(html).body, comparator=None,
+                          customize=True)
+    expected = _customize_tokens(tokenize(parse_html_document(html).body,
+                                          comparator=None))
+    assert describe(customized) == describe(expected)
+    assert customized.kinds.count(TokenType.spacer.value) == 15
+
+    limited = tokenize(parse_html_document(html).body, comparator=None,
+                       customize=True, max_spacers=4)
+    assert limited.kinds.count(TokenType.spacer.value) == 4
+    assert [str(token) for token in limited if str(token) != '\nSPACER'] == [
+        'One', 'link', '/one', 'Two', 'Para', 'graph']
+
+
+def test_html_diff_render_all_matches_each_diff_type():
+    a_text = ('<ul><li>One</li><li>Two</li></ul><p>Some <em>old</em> text'
+              '<script>var a = 1;</script></p><p>Same</p>')
+    b_text = ('<ul><li>One</li><li>Three</li><li>Four</li></ul><p>Some '
+              'new text<script>var a = 2;</script></p><p>Same</p>')
+    everything = html_diff_render(a_text, b_text, include='all')
+
+    for diff_type in ('combined', 'insertions', 'deletions'):
+        single = html_diff_render(a_text, b_text, include=diff_type)
+        assert list(single) == ['change_count', 'deletions_count',
+                                'insertions_count', diff_type]
+        assert single[diff_type] == everything[diff_type]
+
+
+def test_html_diff_render_does_not_modify_parsed_documents():
+    a_text = ('<html><head><!-- A comment --><title>Old</title></head>'
+              '<body><p>Hello <!-- Hi --><ins>there</ins></p></body></html>')
+    b_text = ('<html><head><title>New</title></head>'
+              '<body><p>Goodbye <del>there</del></p></body></html>')
+    a_soup = parse_html_document(a_text)
+    b_soup = parse_html_document(b_text)
+    a_source = str(a_soup)
+    b_source = str(b_soup)
+
+    results = html_diff_render(a_text, b_text, include='all',
+                               a_soup=a_soup, b_soup=b_soup)
+
+    assert str(a_soup) == a_source
+    assert str(b_soup) == b_source
+    assert results == html_diff_render(a_text, b_text, include='all')
+
+
+def test_html_diff_render_does_not_turn_escaped_text_into_markup():
+    results = html_diff_render('Some &lt;b&gt;text&lt;/b&gt;',
+                               'Some &lt;b&gt;words&lt;/b&gt;',
+                               include='combined')
+    assert '<b>' not in results['combined']
+    assert '&lt;b&gt;' in results['combined']
+
+
+def test_html_diff_render_reports_stage_timings():
+    with collect_timings() as timings:
+        html_diff_render('<p>Hello there</p>', '<p>Goodbye there</p>')
+    assert set(timings) == {'parse', 'tokenize', 'match', 'assemble'}
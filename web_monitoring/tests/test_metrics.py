@@ -0,0 +1,61 @@
+import pytest
+from web_monitoring.diff_server.cache import LruCache
+from web_monitoring.diff_server.metrics import (Counter, DiffMetrics, Gauge,
+                                                Histogram)
+from web_monitoring.diff_server.scheduler import DiffScheduler
+
+
+def test_counter():
+    counter = Counter('things_total', 'Number of things.', labels=('kind',))
+    counter.increment(kind='a')
+    counter.increment(2, kind='a')
+    counter.increment(kind='b "quoted"')
+    assert counter.render() == [
+        '# HELP things_total Number of things.',
+        '# TYPE things_total counter',
+        'things_total{kind="a"} 3',
+        'things_total{kind="b \\"quoted\\""} 1',
+    ]
+
+
+def test_gauge():
+    gauge = Gauge('rate', 'A rate.')
+    gauge.set(0.5)
+    assert gauge.render()[-1] == 'rate 0.5'
+
+
+def test_histogram():
+    histogram = Histogram('size', 'Sizes.', buckets=(1, 10))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+    assert histogram.render()[2:] == [
+        'size_bucket{le="1"} 2',
+        'size_bucket{le="10"} 3',
+        'size_bucket{le="+Inf"} 4',
+        'size_sum 56.5',
+        'size_count 4',
+    ]
+
+
+def test_metrics_require_all_labels():
+    counter = Counter('things_total', 'Number of things.', labels=('kind',))
+    with pytest.raises(ValueError):
+        counter.increment()
+
+
+def test_diff_metrics_include_queue_and_cache_stats():
+    metrics = DiffMetrics()
+    metrics.diff_seconds.observe(0.2, differ='html_token')
+    cache = LruCache(100)
+    cache.set('a', b'abc')
+    cache.get('a')
+    cache.get('b')
+    text = metrics.render(DiffScheduler(4, 10), {'result': cache})
+
+    lines = text.splitlines()
+    assert 'diff_duration_seconds_count{differ="html_token"} 1' in lines
+    assert 'diff_pool_restarts_total 0' in lines
+    assert 'diff_concurrency 4' in lines
+    assert 'diff_queue_depth{priority="batch"} 0' in lines
+    assert 'diff_cache_hits_total{cache="result"} 1' in lines
+    assert 'diff_cache_hit_rate{cache="result"} 0.5' in lines
@@ -0,0 +1,93 @@
+import os
+import pickle
+import tempfile
+from unittest.mock import patch
+from tornado.httputil import HTTPHeaders
+from web_monitoring.diff_server.payload import DiffPayload, SPOOL_THRESHOLD
+from web_monitoring.diff_server.server import (MockResponse, caller,
+                                               payload_caller)
+
+
+def body_of_size(size):
+    text = '<p>Hello there, this is some text. ¡Olé!</p>'
+    count = size // len(text.encode('utf-8')) + 1
+    return (text * count).encode('utf-8')
+
+
+def test_small_bodies_are_sent_directly():
+    response = MockResponse('https://example.gov/', b'<p>Hello</p>')
+    payload = DiffPayload.from_response(response)
+    assert payload.spool_path is None
+    with payload.open() as opened:
+        assert opened.request.url == 'https://example.gov/'
+        assert opened.headers['content-type'] == 'text/html'
+        assert opened.body == b'<p>Hello</p>'
+
+
+def test_large_bodies_are_spooled():
+    body = body_of_size(SPOOL_THRESHOLD * 2)
+    response = MockResponse('https://example.gov/', body)
+    with tempfile.TemporaryDirectory() as directory:
+        payload = DiffPayload.from_response(response, directory)
+        assert payload.spool_path.startswith(directory)
+
+        # The spooled body should not be part of the pickled payload.
+        assert len(pickle.dumps(payload)) < 1024
+        with pickle.loads(pickle.dumps(payload)).open() as opened:
+            assert isinstance(opened.body, memoryview)
+            assert opened.body == body
+
+        payload.discard()
+        assert os.listdir(directory) == []
+
+
+def test_large_bodies_are_sent_directly_if_they_cannot_be_spooled():
+    body = body_of_size(SPOOL_THRESHOLD * 2)
+    response = MockResponse('https://example.gov/', body)
+    with tempfile.TemporaryDirectory() as directory:
+        full_disk = OSError(28, 'No space left on device')
+        with patch('web_monitoring.diff_server.payload.open',
+                   side_effect=full_disk, create=True):
+            payload = DiffPayload.from_response(response, directory)
+        assert payload.spool_path is None
+        assert os.listdir(directory) == []
+        with payload.open() as opened:
+            assert opened.body == body
+
+
+def test_payload_caller_diffs_spooled_payloads():
+    a_body = body_of_size(SPOOL_THRESHOLD * 2)
+    b_body = a_body + b'<p>More!</p>'
+    a = DiffPayload.from_response(MockResponse('https://example.gov/a', a_body))
+    b = DiffPayload.from_response(MockResponse('https://example.gov/b', b_body))
+    try:
+        def differ(a_text, b_text, a_body, b_url):
+            return {'a_text': a_text, 'b_text': b_text, 'a_body': a_body,
+                    'b_url': b_url}
+
+        result, timings = payload_caller(differ, a, b)
+        assert set(timings) == {'decode', 'parse', 'diff'}
+        expected = caller(differ,
+                          MockResponse('https://example.gov/a', a_body),
+                          MockResponse('https://example.gov/b', b_body))
+        assert result == expected
+        assert isinstance(result['a_body'], bytes)
+    finally:
+        a.discard()
+        b.discard()
+
+
+def test_payload_headers_are_case_insensitive():
+    headers = HTTPHeaders({'content-type': 'text/plain; charset=utf-8'})
+    response = MockResponse('https://example.gov/', b'Hi', headers)
+    with DiffPayload.from_response(response).open() as opened:
+        assert opened.headers['Content-Type'] == 'text/plain; charset=utf-8'
+
+
+def test_content_hash_is_passed_to_opened_responses():
+    for size in (10, SPOOL_THRESHOLD * 2):
+        response = MockResponse('https://example.gov/', body_of_size(size))
+        payload = DiffPayload.from_response(response, content_hash='abc123')
+        with pickle.loads(pickle.dumps(payload)).open() as opened:
+            assert opened.content_hash == 'abc123'
+        payload.discard()
@@ -0,0 +1,111 @@
+import asyncio
+import pytest
+from web_monitoring.diff_server.scheduler import (BATCH, INTERACTIVE,
+                                                  DiffScheduler,
+                                                  QueueFullError)
+
+
+async def run_job(scheduler, priority, name, order, gate=None):
+    async with scheduler.slot(priority):
+        order.append(name)
+        if gate:
+            await gate.wait()
+        else:
+            await asyncio.sleep(0)
+
+
+def test_limits_concurrency():
+    async def run_all():
+        scheduler = DiffScheduler(2, 10)
+        running = []
+        most_running = 0
+
+        async def job():
+            nonlocal most_running
+            async with scheduler.slot():
+                running.append(1)
+                most_running = max(most_running, len(running))
+                await asyncio.sleep(0.01)
+                running.pop()
+
+        await asyncio.gather(*(job() for _ in range(6)))
+        return scheduler, most_running
+
+    scheduler, most_running = asyncio.run(run_all())
+    assert most_running == 2
+    assert scheduler.running == 0
+    assert scheduler.completed == 6
+
+
+def test_runs_interactive_diffs_before_batch_diffs():
+    async def run_all():
+        scheduler = DiffScheduler(1, 10)
+        order = []
+        gate = asyncio.Event()
+        first = asyncio.ensure_future(
+            run_job(scheduler, BATCH, 'first', order, gate))
+        await asyncio.sleep(0)
+        jobs = [asyncio.ensure_future(run_job(scheduler, priority, name,
+                                              order))
+                for priority, name in ((BATCH, 'batch 1'),
+                                       (INTERACTIVE, 'interactive 1'),
+                                       (BATCH, 'batch 2'),
+                                       (INTERACTIVE, 'interactive 2'))]
+        await asyncio.sleep(0)
+        assert scheduler.stats()['queued'] == {INTERACTIVE: 2, BATCH: 2}
+        gate.set()
+        await asyncio.gather(first, *jobs)
+        return order
+
+    assert asyncio.run(run_all()) == ['first', 'interactive 1',
+                                      'interactive 2', 'batch 1', 'batch 2']
+
+
+def test_rejects_diffs_when_queue_is_full():
+    async def run_all():
+        scheduler = DiffScheduler(1, 1)
+        order = []
+        gate = asyncio.Event()
+        jobs = [asyncio.ensure_future(run_job(scheduler, BATCH, name, order,
+                                              gate))
+                for name in ('running', 'queued')]
+        await asyncio.sleep(0)
+
+        with pytest.raises(QueueFullError) as info:
+            await run_job(scheduler, BATCH, 'rejected', order)
+        assert info.value.retry_after >= 1
+        # Other priorities have their own queue.
+        scheduler.check(INTERACTIVE)
+
+        gate.set()
+        await asyncio.gather(*jobs)
+        return scheduler, order
+
+    scheduler, order = asyncio.run(run_all())
+    assert order == ['running', 'queued']
+    assert scheduler.rejected == {INTERACTIVE: 0, BATCH: 1}
+
+
+def test_cancelled_diffs_leave_the_queue():
+    async def run_all():
+        scheduler = DiffScheduler(1, 10)
+        order = []
+        gate = asyncio.Event()
+        running = asyncio.ensure_future(
+            run_job(scheduler, BATCH, 'running', order, gate))
+        cancelled = asyncio.ensure_future(
+            run_job(scheduler, BATCH, 'cancelled', order))
+        waiting = asyncio.ensure_future(
+            run_job(scheduler, BATCH, 'waiting', order))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.stats()['queued'][BATCH] == 1
+
+        gate.set()
+        await asyncio.gather(running, waiting)
+        return scheduler, order
+
+    scheduler, order = asyncio.run(run_all())
+    assert order == ['running', 'waiting']
+    assert scheduler.running == 0
@@ -0,0 +1,198 @@
+from difflib import SequenceMatcher
+import multiprocessing
+import random
+import pytest
+from web_monitoring.diff.html_diff_render import html_diff_render
+from web_monitoring.diff.sequence_diff import (
+    ALGORITHMS, HISTOGRAM_MAX_OCCURRENCES, get_algorithm, get_matching_blocks,
+    get_segmented_matching_blocks, parallel_windows, _histogram_region)
+
+
+def assert_valid_blocks(a, b, blocks):
+    """
+    Check that a list of matching blocks is in order, only covers items that
+    are actually equal, and ends with a sentinel.
+    """
+    a_end = b_end = 0
+    for i, j, size in blocks[:-1]:
+        assert i >= a_end and j >= b_end
+        assert size > 0
+        assert a[i:i + size] == b[j:j + size]
+        a_end, b_end = i + size, j + size
+    assert tuple(blocks[-1]) == (len(a), len(b), 0)
+
+
+def matched_size(blocks):
+    return sum(size for _, _, size in blocks)
+
+
+def random_sequences(count, seed=0):
+    generator = random.Random(seed)
+    for _ in range(count):
+        alphabet = generator.randint(1, 8)
+        yield (
+            [generator.randrange(alphabet)
+             for _ in range(generator.randint(0, 40))],
+            [generator.randrange(alphabet)
+             for _ in range(generator.randint(0, 40))])
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS.keys())
+def test_matching_blocks_are_valid(algorithm):
+    for a, b in random_sequences(500):
+        assert_valid_blocks(a, b, get_matching_blocks(a, b, algorithm))
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS.keys())
+@pytest.mark.parametrize('a, b', [
+    ([], []),
+    ([1, 2, 3], []),
+    ([], [1, 2, 3]),
+    ([1, 2, 3], [1, 2, 3]),
+    ([1, 2, 3], [4, 5, 6]),
+    ([1, 2, 3, 4, 5], [1, 2, 9, 4, 5]),
+    ([1, 2, 3, 4, 5], [1, 2, 4, 5]),
+    ([1, 2, 4, 5], [1, 2, 3, 4, 5]),
+])
+def test_simple_matching_blocks_are_same_as_difflib(algorithm, a, b):
+    expected = SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks()
+    assert get_matching_blocks(a, b, algorithm) == expected
+
+
+def test_myers_finds_at_least_as_many_matches_as_difflib():
+    for a, b in random_sequences(500, seed=1):
+        expected = SequenceMatcher(None, a, b, autojunk=False)
+        assert (matched_size(get_matching_blocks(a, b, 'myers'))
+                >= matched_size(expected.get_matching_blocks()))
+
+
+def test_myers_gives_up_on_minimal_diff_when_too_expensive(monkeypatch):
+    monkeypatch.setattr('web_monitoring.diff.sequence_diff.MYERS_MAX_COST', 2)
+    for a, b in random_sequences(500, seed=2):
+        assert_valid_blocks(a, b, get_matching_blocks(a, b, 'myers'))
+
+
+def test_histogram_only_anchors_on_items_up_to_max_occurrences(monkeypatch):
+    fallbacks = []
+    monkeypatch.setattr('web_monitoring.diff.sequence_diff._myers_region',
+                        lambda *args: fallbacks.append(args) or [])
+
+    a = [1] * HISTOGRAM_MAX_OCCURRENCES
+    assert _histogram_region(a, 0, len(a), [1], 0, 1) == [(0, 0, 1)]
+    assert fallbacks == []
+
+    a = [1] * (HISTOGRAM_MAX_OCCURRENCES + 1)
+    assert _histogram_region(a, 0, len(a), [1], 0, 1) == []
+    assert len(fallbacks) == 1
+
+
+def test_get_algorithm_raises_for_unknown_algorithms():
+    with pytest.raises(KeyError):
+        get_algorithm('not_an_algorithm')
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS.keys())
+def test_segmented_matching_blocks_are_valid(algorithm):
+    generator = random.Random(3)
+    for a, b in random_sequences(500, seed=3):
+        a_starts = sorted(generator.sample(range(len(a) + 1),
+                                           generator.randint(0, len(a) // 4)))
+        b_starts = sorted(generator.sample(range(len(b) + 1),
+                                           generator.randint(0, len(b) // 4)))
+        blocks = get_segmented_matching_blocks(a, b, a_starts, b_starts,
+                                               algorithm)
+        assert_valid_blocks(a, b, blocks)
+
+
+def test_segmented_matching_blocks_only_diff_changed_segments(monkeypatch):
+    a = list(range(100))
+    b = list(range(100))
+    b[52] = 'changed'
+    starts = list(range(0, 100, 10))
+    calls = []
+
+    def record(a, b):
+        calls.append((list(a), list(b)))
+        return SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks()
+
+    monkeypatch.setitem(ALGORITHMS, 'recording', record)
+    blocks = get_segmented_matching_blocks(a, b, starts, starts, 'recording')
+
+    assert blocks == [(0, 0, 52), (53, 53, 47), (100, 100, 0)]
+    # The first call matches segments, the second diffs the changed one.
+    assert len(calls) == 2
+    assert calls[1] == (a[50:60], b[50:60])
+
+
+def test_segmented_matching_blocks_are_the_same_in_parallel():
+    a = list(range(100))
+    b = list(range(100))
+    for index in (5, 33, 34, 71, 98):
+        b[index] = 'changed'
+    starts = list(range(0, 100, 10))
+    serial = get_segmented_matching_blocks(a, b, starts, starts)
+
+    sent = []
+
+    class Pool:
+        "Runs tasks right away, but records them."
+        def apply_async(self, function, args):
+            sent.append(args)
+            result = function(*args)
+            return type('Result', (), {'get': lambda self: result})()
+
+    with parallel_windows(Pool().apply_async, min_size=1):
+        parallel = get_segmented_matching_blocks(a, b, starts, starts)
+
+    assert parallel == serial
+    # One window is always matched locally.
+    assert len(sent) == 3
+    assert sent[0] == (a[30:40], b[30:40], 'difflib')
+
+
+def test_html_diff_render_is_the_same_with_parallel_windows():
+    a_text = ''.join(f'<p>Paragraph {index} is here.</p>'
+                     for index in range(20))
+    b_text = a_text.replace('Paragraph 3 ', 'Paragraph three ')
+    b_text = b_text.replace('Paragraph 15 is', 'Paragraph 15 was')
+    expected = html_diff_render(a_text, b_text, include='all',
+                                segmentation='blocks')
+
+    with multiprocessing.Pool(2) as pool:
+        with parallel_windows(pool.apply_async, min_size=1):
+            result = html_diff_render(a_text, b_text, include='all',
+                                      segmentation='blocks')
+    assert result == expected
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS.keys())
+def test_html_diff_render_supports_diff_algorithms(algorithm):
+    a_text = '<p>Here is some text.</p><ul><li>One</li><li>Two</li></ul>'
+    b_text = '<p>Here is some new text.</p><ul><li>One</li><li>2</li></ul>'
+    expected = html_diff_render(a_text, b_text, include='all')
+    result = html_diff_render(a_text, b_text, include='all',
+                              diff_algorithm=algorithm)
+    assert result == expected
+
+
+def test_html_diff_render_raises_for_unknown_diff_algorithms():
+    with pytest.raises(KeyError):
+        html_diff_render('<p>Hello</p>', '<p>Goodbye</p>',
+                         diff_algorithm='not_an_algorithm')
+
+
+def test_html_diff_render_can_segment_blocks():
+    a_text = ('<p>Here is some text.</p><ul><li>One</li><li>Two</li></ul>'
+              '<p>The end.</p>')
+    b_text = ('<p>Here is some new text.</p><ul><li>One</li><li>2</li></ul>'
+              '<p>The end.</p>')
+    whole = html_diff_render(a_text, b_text, include='all')
+    segmented = html_diff_render(a_text, b_text, include='all',
+                                 segmentation='blocks')
+    assert segmented == whole
+
+
+def test_html_diff_render_raises_for_unknown_segmentation():
+    with pytest.raises(ValueError):
+        html_diff_render('<p>Hello</p>', '<p>Goodbye</p>',
+                         segmentation='sentences')
@@ -0,0 +1,229 @@
+import asyncio
+import gzip
+import pytest
+from tornado.httpserver import HTTPServer
+from tornado.httputil import HTTPHeaders
+from tornado.netutil import Resolver
+from tornado.testing import bind_unused_port
+import tornado.web
+from web_monitoring.diff.diff_errors import UndiffableContentError
+from web_monitoring.diff_server.upstream import (CachingResolver,
+                                                 FetchAbortedError,
+                                                 HostLimiter,
+                                                 ResponseTooLargeError,
+                                                 StreamingFetch,
+                                                 UpstreamClient)
+from web_monitoring.utils import hash_content
+
+
+class MockRequest:
+    def __init__(self, url):
+        self.url = url
+
+
+class MockResponse:
+    def __init__(self, body, headers=None, code=200):
+        self.request = MockRequest('https://example.gov/')
+        self.code = code
+        self.body = body
+        self.headers = HTTPHeaders(headers or {})
+
+
+def send_headers(stream, status, headers):
+    stream.header_callback(f'{status}\r\n')
+    for name, value in headers.items():
+        stream.header_callback(f'{name}: {value}\r\n')
+    stream.header_callback('\r\n')
+
+
+def test_streamed_body_is_collected_and_hashed():
+    stream = StreamingFetch('https://example.gov/')
+    send_headers(stream, 'HTTP/1.1 200 OK', {'Content-Type': 'text/html'})
+    stream.streaming_callback(b'<p>Hello, ')
+    stream.streaming_callback(b'world!</p>')
+    stream.finish(MockResponse(b''))
+    assert stream.body == b'<p>Hello, world!</p>'
+    assert stream.content_hash == hash_content(b'<p>Hello, world!</p>')
+    assert stream.headers['Content-Type'] == 'text/html'
+
+
+def test_rejects_non_html_content_type():
+    stream = StreamingFetch('https://example.gov/', require_html=True)
+    with pytest.raises(FetchAbortedError):
+        send_headers(stream, 'HTTP/1.1 200 OK',
+                     {'Content-Type': 'application/pdf'})
+    assert isinstance(stream.error, UndiffableContentError)
+
+
+def test_allows_non_html_content_type_if_html_is_not_required():
+    stream = StreamingFetch('https://example.gov/')
+    send_headers(stream, 'HTTP/1.1 200 OK',
+                 {'Content-Type': 'application/pdf'})
+    assert stream.error is None
+
+
+def test_does_not_reject_error_responses():
+    stream = StreamingFetch('https://example.gov/', require_html=True)
+    send_headers(stream, 'HTTP/1.1 404 Not Found',
+                 {'Content-Type': 'application/json'})
+    assert stream.error is None
+
+
+def test_rejects_oversize_content_length():
+    stream = StreamingFetch('https://example.gov/', max_size=10)
+    with pytest.raises(FetchAbortedError):
+        send_headers(stream, 'HTTP/1.1 200 OK', {'Content-Length': '11'})
+    assert isinstance(stream.error, ResponseTooLargeError)
+    assert stream.error.size == 11
+
+
+def test_stops_streaming_oversize_body():
+    stream = StreamingFetch('https://example.gov/', max_size=10)
+    send_headers(stream, 'HTTP/1.1 200 OK', {'Content-Type': 'text/html'})
+    stream.streaming_callback(b'123456')
+    with pytest.raises(FetchAbortedError):
+        stream.streaming_callback(b'789012')
+    assert isinstance(stream.error, ResponseTooLargeError)
+
+
+def test_checks_responses_from_clients_that_do_not_stream():
+    stream = StreamingFetch('https://example.gov/', require_html=True)
+    with pytest.raises(UndiffableContentError):
+        stream.finish(MockResponse(b'%PDF-', {'Content-Type': 'image/png'}))
+
+    stream = StreamingFetch('https://example.gov/')
+    stream.finish(MockResponse(b'<p>Hi</p>', {'Content-Type': 'text/html'}))
+    assert stream.body == b'<p>Hi</p>'
+    assert stream.content_hash == hash_content(b'<p>Hi</p>')
+
+
+class CountingResolver(Resolver):
+    def initialize(self):
+        self.lookups = 0
+
+    async def resolve(self, host, port, family=0):
+        self.lookups += 1
+        return [(family, (f'10.0.0.{self.lookups}', port))]
+
+
+def test_caching_resolver_caches_lookups():
+    async def resolve_all():
+        counter = CountingResolver()
+        resolver = CachingResolver(resolver=counter, ttl=60)
+        first = await resolver.resolve('example.gov', 80)
+        second = await resolver.resolve('example.gov', 80)
+        assert first == second
+        assert counter.lookups == 1
+
+        await resolver.resolve('example.org', 80)
+        assert counter.lookups == 2
+
+    asyncio.run(resolve_all())
+
+
+def test_caching_resolver_expires_lookups():
+    async def resolve_all():
+        counter = CountingResolver()
+        resolver = CachingResolver(resolver=counter, ttl=0.01)
+        await resolver.resolve('example.gov', 80)
+        await asyncio.sleep(0.02)
+        await resolver.resolve('example.gov', 80)
+        assert counter.lookups == 2
+
+    asyncio.run(resolve_all())
+
+
+def test_host_limiter_limits_requests_per_host():
+    async def run_all():
+        limiter = HostLimiter(2)
+        running = {}
+        most_running = {}
+
+        async def request(url):
+            host = url.split('/')[2]
+            async with limiter.limit(url):
+                running[host] = running.get(host, 0) + 1
+                most_running[host] = max(most_running.get(host, 0),
+                                         running[host])
+                await asyncio.sleep(0.01)
+                running[host] -= 1
+
+        await asyncio.gather(*(request(f'https://{host}/{index}')
+                               for host in ('a.gov', 'b.gov')
+                               for index in range(5)))
+        assert most_running == {'a.gov': 2, 'b.gov': 2}
+        assert limiter.active('https://a.gov/') == 0
+
+    asyncio.run(run_all())
+
+
+def test_upstream_client_rejects_unknown_backends():
+    with pytest.raises(ValueError):
+        UpstreamClient('not_a_real_client')
+
+
+class BodyHandler(tornado.web.RequestHandler):
+    async def get(self, size):
+        for _ in range(int(size)):
+            self.write(1024 * b'x')
+            await self.flush()
+
+
+class EncodedBodyHandler(tornado.web.RequestHandler):
+    def get(self, encoding):
+        body = b'<p>Hello, compressed world!</p>' * 100
+        if encoding == 'br':
+            import brotli
+            body = brotli.compress(body)
+        else:
+            body = gzip.compress(body)
+        self.set_header('Content-Encoding', encoding)
+        self.set_header('X-Accepted-Encoding',
+                        self.request.headers.get('Accept-Encoding', ''))
+        self.write(body)
+
+
+def fetch_from_server(client, path):
+    async def fetch():
+        sock, port = bind_unused_port()
+        app = tornado.web.Application([
+            (r'/(\d+)', BodyHandler),
+            (r'/encoded/(br|gzip)', EncodedBodyHandler)])
+        http_server = HTTPServer(app)
+        http_server.add_sockets([sock])
+        try:
+            return await client.fetch(f'http://127.0.0.1:{port}{path}')
+        finally:
+            http_server.stop()
+
+    return asyncio.run(fetch())
+
+
+def test_upstream_client_fetches_bodies():
+    client = UpstreamClient(max_body_size=10 * 1024)
+    response = fetch_from_server(client, '/10')
+    assert response.body == 10 * 1024 * b'x'
+
+
+def test_upstream_client_enforces_max_body_size():
+    client = UpstreamClient(max_body_size=10 * 1024)
+    with pytest.raises(ResponseTooLargeError):
+        fetch_from_server(client, '/11')
+
+
+def test_upstream_client_decodes_gzip_bodies():
+    client = UpstreamClient()
+    response = fetch_from_server(client, '/encoded/gzip')
+    assert response.body == b'<p>Hello, compressed world!</p>' * 100
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['X-Consumed-Content-Encoding'] == 'gzip'
+
+
+def test_upstream_client_decodes_brotli_bodies():
+    pytest.importorskip('brotli')
+    client = UpstreamClient()
+    response = fetch_from_server(client, '/encoded/br')
+    assert 'br' in response.headers['X-Accepted-Encoding']
+    assert response.body == b'<p>Hello, compressed world!</p>' * 100
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['X-Consumed-Content-Encoding'] == 'br'